@@ -0,0 +1,258 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Latency and input shapes of variable-resolution inference, per mode.
+
+The SavedModel of --saved_model_dir is run, as by mnasnet_serve.py, on JPEGs
+of various aspect ratios (those of --jpeg_dir, or synthetic ones) sent one
+per request by --concurrency clients for --duration_secs, in three modes:
+
+  - 'fixed': every image center-cropped to the square resolution of the
+    export, in a graph of static shapes;
+  - 'dynamic': every image at its own aspect ratio, at about the pixel count
+    of the export, in one graph of dynamic shapes, one image per batch;
+  - 'buckets': every image at the bucket of --resolution_buckets nearest to
+    its aspect ratio (--letterbox to pad instead of cropping), in a graph of
+    static shapes and a batcher of --batch_sizes per bucket.
+
+The images are decoded beforehand, so the latencies are those of batching
+and of the model. Every mode is first warmed up on the shapes it can know
+in advance: every bucket and batch size, or the square resolution for
+'dynamic'. The report gives the throughput, the p50 and p99 latency, overall
+and per bucket, and the input shapes run, i.e. the shapes the graph is
+planned for, cuDNN autotuned for and, with tf.function, retraced for:
+'new_shapes' are those first seen while serving.
+
+    python benchmark_buckets.py --saved_model_dir=/export/mnasnet-d1-320 \
+        --resolution_buckets=1:1,3:4,4:3,9:16,16:9 --concurrency=16 \
+        --output_file=buckets.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import functools
+import json
+import os
+import threading
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_serve
+import preprocessing
+from utils import dynamic_batching
+from utils import resolution_buckets
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'jpeg_dir', default=None,
+    help='Directory of the JPEGs to send; synthetic JPEGs without it.')
+
+flags.DEFINE_integer(
+    'num_jpegs', default=256, help='Number of distinct JPEGs sent.')
+
+flags.DEFINE_integer(
+    'concurrency', default=16, help='Number of concurrent clients.')
+
+flags.DEFINE_float(
+    'duration_secs', default=10., help='Duration of every mode.')
+
+flags.DEFINE_list(
+    'modes', default=['fixed', 'dynamic', 'buckets'],
+    help='Modes to compare: fixed, dynamic and buckets.')
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the results as JSON.')
+
+# Without --resolution_buckets.
+_DEFAULT_BUCKETS = ['1:1', '3:4', '4:3', '9:16', '16:9']
+
+_DYNAMIC = (None, None)
+
+
+def read_jpegs():
+  """--num_jpegs JPEGs of --jpeg_dir, or synthetic ones."""
+  if not FLAGS.jpeg_dir:
+    return preprocessing.synthetic_jpegs(FLAGS.num_jpegs)
+  jpegs = []
+  for filename in sorted(tf.gfile.ListDirectory(FLAGS.jpeg_dir)):
+    with tf.gfile.GFile(os.path.join(FLAGS.jpeg_dir, filename), 'rb') as f:
+      jpegs.append(f.read())
+    if len(jpegs) == FLAGS.num_jpegs:
+      break
+  return jpegs
+
+
+def decode(mode, jpegs, buckets, image_size):
+  """The (bucket, image) of every JPEG in a mode."""
+  decoder = mnasnet_serve.BucketJpegDecoder(buckets, FLAGS.letterbox)
+  requests = []
+  for jpeg in jpegs:
+    height, width = decoder.shape(jpeg)
+    if mode == 'dynamic':
+      # The aspect ratio of the image, without rounding to a bucket.
+      size = resolution_buckets.aspect_bucket(height, width, image_size,
+                                              multiple=1)
+      image = decoder.decode(jpeg, size, (height, width))
+      requests.append((_DYNAMIC, image))
+    else:
+      bucket = resolution_buckets.nearest_bucket(height, width, buckets)
+      requests.append((bucket, decoder.decode(jpeg, bucket, (height, width))))
+  decoder.sess.close()
+  return requests
+
+
+def _client(batchers, requests, end_time, latencies, seed):
+  """Sends requests back to back until `end_time`."""
+  rng = np.random.RandomState(seed)
+  while time.time() < end_time:
+    bucket, image = requests[rng.randint(len(requests))]
+    start = time.time()
+    try:
+      batchers[bucket].predict(image[np.newaxis])
+    except dynamic_batching.QueueFullError:
+      time.sleep(0.001)
+      continue
+    except dynamic_batching.RequestTimeoutError:
+      latencies.append((bucket, None))
+      continue
+    latencies.append((bucket, time.time() - start))
+
+
+def _latency_ms(seconds):
+  ms = 1e3 * np.array(seconds)
+  return {'p50': float(np.percentile(ms, 50)),
+          'p99': float(np.percentile(ms, 99))}
+
+
+def run_mode(mode, runner, jpegs):
+  """Serves the JPEGs in a mode for --duration_secs; returns its stats."""
+  image_size = runner.image_size
+  if mode == 'fixed':
+    buckets, batch_sizes = [(image_size, image_size)], FLAGS.batch_sizes
+  elif mode == 'dynamic':
+    # Images of different shapes are not batched together.
+    buckets, batch_sizes = [_DYNAMIC], ['1']
+  elif mode == 'buckets':
+    buckets = resolution_buckets.parse_buckets(
+        FLAGS.resolution_buckets or _DEFAULT_BUCKETS, image_size)
+    batch_sizes = FLAGS.batch_sizes
+  else:
+    raise ValueError('Unknown mode %s.' % mode)
+  requests = decode(mode, jpegs, buckets if mode != 'dynamic' else
+                    [(image_size, image_size)], image_size)
+
+  bucketed = mnasnet_serve.BucketedRunner(
+      runner, buckets, intra_op_threads=FLAGS.intra_op_threads,
+      inter_op_threads=FLAGS.inter_op_threads)
+  batchers = {}
+  for bucket in buckets:
+    batchers[bucket] = dynamic_batching.DynamicBatcher(
+        functools.partial(bucketed, bucket), batch_sizes,
+        max_queue_delay_ms=FLAGS.max_queue_delay_ms,
+        max_queue_size=FLAGS.max_queue_size,
+        timeout_ms=FLAGS.timeout_ms,
+        num_workers=FLAGS.num_batch_threads)
+  for bucket, batcher in batchers.items():
+    if bucket == _DYNAMIC:
+      warmup_images = [np.zeros([image_size, image_size, 3], np.uint8)]
+    else:
+      warmup_images = [image for b, image in requests if b == bucket][:1] or [
+          np.zeros(bucket + (3,), np.uint8)]
+    for batch_size in batcher.batch_sizes:
+      batcher.run_fn(np.stack(warmup_images * batch_size))
+  warm_shapes = len(bucketed.input_shapes)
+
+  latencies = []
+  end_time = time.time() + FLAGS.duration_secs
+  clients = [threading.Thread(target=_client, args=(
+      batchers, requests, end_time, latencies, i))
+             for i in range(FLAGS.concurrency)]
+  start = time.time()
+  for client in clients:
+    client.start()
+  for client in clients:
+    client.join()
+  elapsed = time.time() - start
+  for batcher in batchers.values():
+    batcher.stop()
+  bucketed.close()
+
+  by_bucket = collections.defaultdict(list)
+  for bucket, latency in latencies:
+    if latency is not None:
+      by_bucket[bucket].append(latency)
+  ok = [latency for _, latency in latencies if latency is not None]
+  batches = sum(b.metrics.snapshot()['batches'] for b in batchers.values())
+  result = {
+      'mode': mode,
+      'buckets': ['dynamic' if b == _DYNAMIC else '%dx%d' % b
+                  for b in buckets],
+      'images_per_sec': len(ok) / elapsed,
+      'timed_out': len(latencies) - len(ok),
+      'mean_batch_size': len(ok) / batches if batches else None,
+      'input_shapes': len(bucketed.input_shapes),
+      'new_shapes': len(bucketed.input_shapes) - warm_shapes,
+      'bucket_share': {('dynamic' if b == _DYNAMIC else '%dx%d' % b):
+                       sum(1 for r, _ in requests if r == b) / len(requests)
+                       for b in buckets},
+  }
+  if ok:
+    result['latency_ms'] = _latency_ms(ok)
+    result['bucket_latency_ms'] = {
+        ('dynamic' if b == _DYNAMIC else '%dx%d' % b): _latency_ms(v)
+        for b, v in by_bucket.items()}
+  return result
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  jpegs = read_jpegs()
+  runner = mnasnet_serve.SavedModelRunner(
+      mnasnet_serve.latest_saved_model(FLAGS.saved_model_dir))
+  results = []
+  try:
+    for mode in FLAGS.modes:
+      result = run_mode(mode, runner, jpegs)
+      tf.logging.info('%s', json.dumps(result))
+      results.append(result)
+  finally:
+    runner.close()
+
+  tf.logging.info('%-8s %-12s %-10s %-10s %-8s %s', 'mode', 'images/sec',
+                  'p50 ms', 'p99 ms', 'shapes', 'new shapes')
+  for result in results:
+    latency = result.get('latency_ms', {})
+    tf.logging.info('%-8s %-12.1f %-10s %-10s %-8d %d', result['mode'],
+                    result['images_per_sec'],
+                    '%.2f' % latency['p50'] if latency else '-',
+                    '%.2f' % latency['p99'] if latency else '-',
+                    result['input_shapes'], result['new_shapes'])
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump({'saved_model_dir': FLAGS.saved_model_dir,
+                 'letterbox': FLAGS.letterbox,
+                 'batch_sizes': FLAGS.batch_sizes,
+                 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,212 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Accuracy and latency of a model with early exits, per exit threshold.
+
+The model is trained with --early_exits, jointly with the backbone or post
+hoc on a frozen one:
+
+    python mnasnet_main_hvd.py --model_name=mnasnet-a1 --early_exits=3,4 \
+        --init_checkpoint=/models/mnasnet-a1/model.ckpt-437000 \
+        --early_exit_freeze_backbone ...
+
+and run here with `MnasNetModel` early exits: after every exit, the images
+whose top softmax probability reaches the threshold stop there, and the
+rest of the batch goes on through the next blocks as a smaller batch. For
+every threshold of --thresholds, the first --num_images validation images
+are run in batches of --batch_size and the report gives the top-1 accuracy,
+the share of images leaving at every exit, and the mean latency per batch
+and per image, against the full network (no image exits):
+
+    python benchmark_early_exit.py --checkpoint_path=/models/a1-exits \
+        --model_name=mnasnet-a1 --early_exits=3,4 --data_dir=/data/imagenet \
+        --thresholds=0.6,0.8,0.9 --output_file=early_exit.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_models_v1 as mnasnet_models
+import mnasnet_utils
+import preprocessing
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'checkpoint_path', default=None,
+    help='Checkpoint, or directory of checkpoints, of a model with early exits.')
+
+flags.DEFINE_string(
+    'model_name', default='mnasnet-a1', help='The model name to select.')
+
+flags.DEFINE_list(
+    'early_exits', default=['3', '4'],
+    help='Reduction endpoints of the early exits the model was trained with.')
+
+flags.DEFINE_string(
+    'data_dir', default=None,
+    help='Directory of the validation-* TFRecords of ImageNet.')
+
+flags.DEFINE_integer(
+    'num_images', default=5000, help='Validation images to evaluate.')
+
+flags.DEFINE_integer('batch_size', default=32, help='Batch size.')
+
+flags.DEFINE_integer('image_size', default=224, help='Input image size.')
+
+flags.DEFINE_string(
+    'data_format', default='channels_last',
+    help=('A flag to override the data format used in the model. The value'
+          ' is either channels_first or channels_last.'))
+
+flags.DEFINE_bool(
+    'use_moving_average', default=True,
+    help='Restore the moving averages of the weights when there are any.')
+
+flags.DEFINE_list(
+    'thresholds', default=['0.5', '0.6', '0.7', '0.8', '0.9', '0.95', '0.99'],
+    help='Top softmax probabilities from which an image exits.')
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the results as JSON.')
+
+# No softmax probability reaches it: the full network for every image.
+_FULL_NETWORK = 2.
+
+
+def make_validation_dataset():
+  """Batches of (uint8 images, labels) of the first validation images."""
+  filenames = sorted(tf.gfile.Glob(os.path.join(FLAGS.data_dir,
+                                                'validation-*')))
+  if not filenames:
+    raise ValueError('No validation-* files in %s' % FLAGS.data_dir)
+
+  def parse(record):
+    parsed = tf.parse_single_example(record, {
+        'image/encoded': tf.FixedLenFeature((), tf.string, ''),
+        'image/class/label': tf.FixedLenFeature([], tf.int64, -1),
+    })
+    image = preprocessing.preprocess_image(
+        parsed['image/encoded'], is_training=False,
+        image_size=FLAGS.image_size, defer_to_batch=True)
+    # Labels are 1-based in the ImageNet TFRecords.
+    return image, parsed['image/class/label'] - 1
+
+  dataset = tf.data.TFRecordDataset(filenames).take(FLAGS.num_images)
+  return dataset.map(parse, num_parallel_calls=16).batch(
+      FLAGS.batch_size).prefetch(2)
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  early_exits = tuple(int(r) for r in FLAGS.early_exits)
+  images, labels = make_validation_dataset().make_one_shot_iterator().get_next()
+  inputs = tf.placeholder(tf.uint8, [None, FLAGS.image_size, FLAGS.image_size,
+                                     3])
+  threshold = tf.placeholder(tf.float32, [])
+  logits, exits = mnasnet_models.build_mnasnet_early_exit_model(
+      preprocessing.augment_batch(inputs, is_training=False,
+                                  data_format=FLAGS.data_format),
+      FLAGS.model_name, threshold, override_params={
+          'data_format': FLAGS.data_format,
+          'early_exits': early_exits,
+      })
+  classes = tf.argmax(logits, axis=1, output_type=tf.int32)
+
+  config = tf.ConfigProto(allow_soft_placement=True)
+  config.gpu_options.allow_growth = True
+  sess = tf.Session(config=config)
+  mnasnet_utils.restore_model(sess, FLAGS.checkpoint_path,
+                              FLAGS.use_moving_average)
+  run = sess.make_callable([classes, exits], feed_list=[inputs, threshold])
+
+  thresholds = [_FULL_NETWORK] + [float(t) for t in FLAGS.thresholds]
+  stats = {t: collections.Counter() for t in thresholds}
+  num_batches = 0
+  while True:
+    try:
+      batch_images, batch_labels = sess.run([images, labels])
+    except tf.errors.OutOfRangeError:
+      break
+    for t in thresholds:
+      start = time.time()
+      batch_classes, batch_exits = run(batch_images, t)
+      elapsed = time.time() - start
+      counter = stats[t]
+      counter['images'] += len(batch_labels)
+      counter['correct'] += int(np.sum(batch_classes == batch_labels))
+      counter.update('exit_%d' % e if e else 'full' for e in batch_exits)
+      # The first batch pays for the first runs of the graph.
+      if num_batches:
+        counter['timed_batches'] += 1
+        counter['timed_images'] += len(batch_labels)
+        counter['timed_secs'] += elapsed
+    num_batches += 1
+  sess.close()
+
+  results = []
+  for t in thresholds:
+    counter = stats[t]
+    result = {
+        'threshold': None if t == _FULL_NETWORK else t,
+        'accuracy': counter['correct'] / counter['images'],
+        'exit_rates': {name: counter[name] / counter['images']
+                       for name in ['exit_%d' % r for r in early_exits] +
+                       ['full']},
+        'ms_per_batch': (1e3 * counter['timed_secs'] / counter['timed_batches']
+                         if counter['timed_batches'] else None),
+        'ms_per_image': (1e3 * counter['timed_secs'] / counter['timed_images']
+                         if counter['timed_images'] else None),
+    }
+    if results:
+      full = results[0]
+      result['accuracy_delta'] = result['accuracy'] - full['accuracy']
+      if result['ms_per_image'] and full['ms_per_image']:
+        result['speedup'] = full['ms_per_image'] / result['ms_per_image']
+    results.append(result)
+
+  tf.logging.info('%-10s %-9s %-9s %-12s %-8s %s', 'threshold', 'top-1',
+                  'acc diff', 'ms/image', 'speedup', 'exits')
+  for result in results:
+    tf.logging.info(
+        '%-10s %-9.4f %-9s %-12s %-8s %s',
+        result['threshold'] if result['threshold'] is not None else 'full',
+        result['accuracy'],
+        '%+.4f' % result['accuracy_delta'] if 'accuracy_delta' in result
+        else '-',
+        '%.3f' % result['ms_per_image'] if result['ms_per_image'] else '-',
+        '%.2fx' % result['speedup'] if 'speedup' in result else '-',
+        ' '.join('%s=%.2f' % kv for kv in sorted(
+            result['exit_rates'].items())))
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump({'model_name': FLAGS.model_name,
+                 'early_exits': early_exits,
+                 'batch_size': FLAGS.batch_size,
+                 'results': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
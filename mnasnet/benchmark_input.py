@@ -0,0 +1,423 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Benchmarks the input pipelines in isolation, without the model.
+
+Drives each input backend for a fixed number of batches and reports
+images/sec, CPU efficiency, p50/p99 batch latency and peak RSS as JSON.
+Every configuration runs in its own process so that peak RSS is per
+configuration.
+
+Without --data_dir, synthetic TFRecord shards are generated first. They use
+the schema read by `ImageNetInput` and `image_processing._deserialize_image_record`,
+with JPEG sizes and aspect ratios close to ImageNet's, and come with DALI index
+files.
+
+    python benchmark_input.py --backends=imagenet,tfrecords \
+        --num_threads=8,16 --output_file=input_benchmark.json
+
+--batch_augmentation=none,host,device compares the per-image CPU cost of the
+per-image preprocessing with `preprocessing.augment_batch` run in the input
+pipeline or after it (on the GPU when there is one).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'data_dir', default=None,
+    help=('Directory of TFRecord shards to benchmark. If not set, synthetic'
+          ' shards are generated in --synthetic_dir.'))
+
+flags.DEFINE_string(
+    'index_dir', default=None,
+    help=('Directory of DALI index files. Defaults to <data_dir>/index_files.'))
+
+flags.DEFINE_string(
+    'synthetic_dir', default=os.path.join(tempfile.gettempdir(),
+                                          'mnasnet_input_benchmark'),
+    help='Where the synthetic shards are generated.')
+
+flags.DEFINE_integer(
+    'num_shards', default=16, help='Number of synthetic shards to generate.')
+
+flags.DEFINE_integer(
+    'records_per_shard', default=512,
+    help='Number of records of each synthetic shard.')
+
+flags.DEFINE_bool(
+    'regenerate', default=False,
+    help='Generate the synthetic shards even if they already exist.')
+
+flags.DEFINE_enum(
+    'mode', 'train', ['train', 'eval'],
+    help='Benchmark the training or the evaluation pipelines.')
+
+flags.DEFINE_list(
+    'backends', default=['imagenet', 'tfrecords', 'dali'],
+    help=('Input backends to benchmark: imagenet (ImageNetInput.input_fn),'
+          ' tfrecords (data_utils.get_tfrecords_input_fn) and dali'
+          ' (data_utils.get_dali_input_fn).'))
+
+flags.DEFINE_list(
+    'num_threads', default=['8', '16'],
+    help='Parallelism of the input pipeline; one configuration per value.')
+
+flags.DEFINE_list(
+    'batch_augmentation', default=['none'],
+    help=('Where the imagenet backend flips, converts and normalizes: none'
+          ' (per image), host or device (per batch); one configuration per'
+          ' value.'))
+
+flags.DEFINE_integer('batch_size', default=256, help='Batch size.')
+
+flags.DEFINE_integer('image_size', default=224, help='Output image size.')
+
+flags.DEFINE_integer(
+    'num_batches', default=200, help='Number of timed batches per configuration.')
+
+flags.DEFINE_integer(
+    'warmup_batches', default=20,
+    help='Number of batches run before timing starts.')
+
+flags.DEFINE_string(
+    'output_file', default=None,
+    help='Where to write the JSON report. Printed to stdout if not set.')
+
+flags.DEFINE_string(
+    'single_config', default=None,
+    help=('Internal: run one <backend>:<num_threads>:<batch_augmentation>'
+          ' configuration.'))
+
+flags.DEFINE_string(
+    'result_file', default=None,
+    help='Internal: where a single configuration writes its result.')
+
+# Aspect ratios (width / height) of ImageNet training images and their
+# frequencies; 0 stands for any other ratio between 1:2 and 2:1.
+_ASPECT_RATIOS = [4. / 3., 3. / 4., 1., 16. / 9., 0.]
+_ASPECT_PROBS = [0.55, 0.15, 0.12, 0.08, 0.10]
+_NUM_CLASSES = 1000
+
+
+def _random_image_shape(rng):
+  """Returns a (height, width) distributed like ImageNet's, ~400x350."""
+  short_side = int(np.clip(rng.lognormal(np.log(360.), 0.25), 96, 1200))
+  aspect = _ASPECT_RATIOS[rng.choice(len(_ASPECT_RATIOS), p=_ASPECT_PROBS)]
+  if not aspect:
+    aspect = np.exp(rng.uniform(np.log(0.5), np.log(2.)))
+  long_side = int(short_side * max(aspect, 1. / aspect))
+  if aspect >= 1.:
+    return short_side, long_side
+  return long_side, short_side
+
+
+def _random_image(rng, height, width):
+  """Blocky colour noise, which compresses about as well as photos do."""
+  block = 16
+  coarse = rng.randint(0, 256, size=(height // block + 1, width // block + 1, 3))
+  image = np.repeat(np.repeat(coarse, block, axis=0), block, axis=1)
+  image = image[:height, :width].astype(np.float32)
+  image += rng.normal(0., 24., size=image.shape)
+  return np.clip(image, 0, 255).astype(np.uint8)
+
+
+def _bytes_feature(value):
+  return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
+
+
+def _int64_feature(value):
+  return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
+
+
+def _float_feature(value):
+  return tf.train.Feature(float_list=tf.train.FloatList(value=[value]))
+
+
+def _make_example(jpeg, label, height, width, rng):
+  xmin, ymin = rng.uniform(0., 0.3, size=2)
+  xmax, ymax = rng.uniform(0.7, 1., size=2)
+  return tf.train.Example(features=tf.train.Features(feature={
+      'image/encoded': _bytes_feature(jpeg),
+      'image/format': _bytes_feature(b'JPEG'),
+      'image/height': _int64_feature(height),
+      'image/width': _int64_feature(width),
+      # Labels are 1-based in the ImageNet TFRecords.
+      'image/class/label': _int64_feature(label + 1),
+      'image/class/text': _bytes_feature(b'synthetic %d' % label),
+      'image/object/bbox/xmin': _float_feature(xmin),
+      'image/object/bbox/ymin': _float_feature(ymin),
+      'image/object/bbox/xmax': _float_feature(xmax),
+      'image/object/bbox/ymax': _float_feature(ymax),
+  }))
+
+
+def generate_synthetic_shards(output_dir, prefix, num_shards, records_per_shard,
+                              seed=0):
+  """Writes synthetic JPEG TFRecord shards and their DALI index files.
+
+  Returns:
+    A dict describing the generated data.
+  """
+  index_dir = os.path.join(output_dir, 'index_files')
+  for directory in [output_dir, index_dir]:
+    if not tf.gfile.Exists(directory):
+      tf.gfile.MakeDirs(directory)
+
+  rng = np.random.RandomState(seed)
+  jpeg_bytes = []
+  with tf.Graph().as_default():
+    image = tf.placeholder(tf.uint8, [None, None, 3])
+    encoded = tf.image.encode_jpeg(image, quality=90)
+    with tf.Session() as sess:
+      for shard in range(num_shards):
+        filename = '%s-%05d-of-%05d' % (prefix, shard, num_shards)
+        path = os.path.join(output_dir, filename)
+        offset = 0
+        with tf.python_io.TFRecordWriter(path) as writer, \
+            tf.gfile.GFile(os.path.join(index_dir, filename + '.idx'), 'w') as index:
+          for _ in range(records_per_shard):
+            height, width = _random_image_shape(rng)
+            jpeg = sess.run(encoded, {image: _random_image(rng, height, width)})
+            record = _make_example(jpeg, rng.randint(_NUM_CLASSES), height, width,
+                                   rng).SerializeToString()
+            writer.write(record)
+            # A TFRecord is framed by a 12 byte header and a 4 byte footer.
+            index.write('%d %d\n' % (offset, len(record) + 16))
+            offset += len(record) + 16
+            jpeg_bytes.append(len(jpeg))
+        tf.logging.info('Wrote %s', path)
+
+  return {
+      'num_shards': num_shards,
+      'num_records': num_shards * records_per_shard,
+      'jpeg_bytes_mean': float(np.mean(jpeg_bytes)),
+      'jpeg_bytes_p50': float(np.percentile(jpeg_bytes, 50)),
+      'jpeg_bytes_p99': float(np.percentile(jpeg_bytes, 99)),
+  }
+
+
+def _data_files(data_dir, index_dir):
+  prefix = 'train' if FLAGS.mode == 'train' else 'validation'
+  filenames = sorted(tf.gfile.Glob(os.path.join(data_dir, '%s-*' % prefix)))
+  idx_filenames = [os.path.join(index_dir, os.path.basename(f) + '.idx')
+                   for f in filenames]
+  return filenames, idx_filenames
+
+
+def _imagenet_batches(data_dir, index_dir, num_threads, batch_augmentation):
+  import imagenet_input  # pylint: disable=g-import-not-at-top
+  import preprocessing  # pylint: disable=g-import-not-at-top
+  del index_dir  # Unused.
+  is_training = FLAGS.mode == 'train'
+  input_pipeline = imagenet_input.ImageNetInput(
+      is_training=is_training,
+      use_bfloat16=False,
+      transpose_input=False,
+      data_dir=data_dir,
+      image_size=FLAGS.image_size,
+      num_parallel_calls=num_threads,
+      batch_augmentation=batch_augmentation)
+  dataset = input_pipeline.input_fn({'batch_size': FLAGS.batch_size})
+  if not is_training:
+    # The evaluation input makes a single pass.
+    dataset = dataset.repeat()
+  images, labels = dataset.make_one_shot_iterator().get_next()
+  if batch_augmentation == 'device':
+    images = preprocessing.augment_batch(images, is_training)
+  return images, labels
+
+
+def _tfrecords_batches(data_dir, index_dir, num_threads, batch_augmentation):
+  del batch_augmentation  # Unused.
+  from utils import data_utils  # pylint: disable=g-import-not-at-top
+  filenames, _ = _data_files(data_dir, index_dir)
+  dataset = data_utils.get_tfrecords_input_fn(
+      filenames, FLAGS.batch_size, FLAGS.image_size, FLAGS.image_size,
+      training=FLAGS.mode == 'train', distort_color=False,
+      num_threads=num_threads, deterministic=False)
+  return dataset.make_one_shot_iterator().get_next()
+
+
+def _dali_batches(data_dir, index_dir, num_threads, batch_augmentation):
+  del batch_augmentation  # Unused.
+  import horovod.tensorflow as hvd  # pylint: disable=g-import-not-at-top
+  from utils import data_utils  # pylint: disable=g-import-not-at-top
+  hvd.init()
+  filenames, idx_filenames = _data_files(data_dir, index_dir)
+  return data_utils.get_dali_input_fn(
+      filenames, idx_filenames, FLAGS.batch_size, FLAGS.image_size,
+      FLAGS.image_size, training=FLAGS.mode == 'train', distort_color=False,
+      num_threads=num_threads, deterministic=False)
+
+
+_BACKENDS = {
+    'imagenet': _imagenet_batches,
+    'tfrecords': _tfrecords_batches,
+    'dali': _dali_batches,
+}
+
+
+def _cpu_seconds():
+  usage = resource.getrusage(resource.RUSAGE_SELF)
+  return usage.ru_utime + usage.ru_stime
+
+
+def run_config(backend, num_threads, batch_augmentation, data_dir, index_dir):
+  """Times one backend in the current process and returns its figures."""
+  with tf.Graph().as_default():
+    # Only run the pipeline; fetching the batches would time the copy to numpy.
+    next_batch = tf.group(*_BACKENDS[backend](data_dir, index_dir, num_threads,
+                                              batch_augmentation))
+    with tf.Session() as sess:
+      for _ in range(FLAGS.warmup_batches):
+        sess.run(next_batch)
+
+      latencies = []
+      start_cpu = _cpu_seconds()
+      start_time = time.time()
+      for _ in range(FLAGS.num_batches):
+        batch_start = time.time()
+        sess.run(next_batch)
+        latencies.append(time.time() - batch_start)
+      wall_secs = time.time() - start_time
+      cpu_secs = _cpu_seconds() - start_cpu
+
+  images = FLAGS.num_batches * FLAGS.batch_size
+  latencies_ms = 1e3 * np.array(latencies)
+  return {
+      'images_per_sec': images / wall_secs,
+      'batch_latency_ms': {
+          'mean': float(np.mean(latencies_ms)),
+          'p50': float(np.percentile(latencies_ms, 50)),
+          'p99': float(np.percentile(latencies_ms, 99)),
+      },
+      # Cores kept busy on average, and images per second of CPU time.
+      'cpu_cores_busy': cpu_secs / wall_secs,
+      'images_per_core_sec': images / cpu_secs if cpu_secs else None,
+      'cpu_ms_per_image': 1e3 * cpu_secs / images,
+      # ru_maxrss is in KiB on Linux.
+      'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.,
+  }
+
+
+def _run_config_in_subprocess(backend, num_threads, batch_augmentation,
+                              data_dir, index_dir):
+  with tempfile.NamedTemporaryFile(suffix='.json') as result_file:
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        '--single_config=%s:%d:%s' % (backend, num_threads,
+                                      batch_augmentation or 'none'),
+        '--result_file=%s' % result_file.name,
+        '--data_dir=%s' % data_dir,
+        '--index_dir=%s' % index_dir,
+        '--mode=%s' % FLAGS.mode,
+        '--batch_size=%d' % FLAGS.batch_size,
+        '--image_size=%d' % FLAGS.image_size,
+        '--num_batches=%d' % FLAGS.num_batches,
+        '--warmup_batches=%d' % FLAGS.warmup_batches,
+    ]
+    returncode = subprocess.call(command)
+    result = {'backend': backend, 'num_threads': num_threads,
+              'batch_augmentation': batch_augmentation or 'none'}
+    if returncode:
+      result['error'] = 'exited with status %d' % returncode
+      return result
+    with open(result_file.name) as f:
+      result.update(json.load(f))
+    return result
+
+
+def main(unused_argv):
+  data_dir = FLAGS.data_dir
+
+  if FLAGS.single_config:
+    backend, num_threads, batch_augmentation = FLAGS.single_config.split(':')
+    if batch_augmentation == 'none':
+      batch_augmentation = None
+    result = run_config(backend, int(num_threads), batch_augmentation, data_dir,
+                        FLAGS.index_dir)
+    with open(FLAGS.result_file, 'w') as f:
+      json.dump(result, f)
+    return
+
+  for backend in FLAGS.backends:
+    if backend not in _BACKENDS:
+      raise ValueError('Unknown backend %s, expected one of %s' %
+                       (backend, sorted(_BACKENDS)))
+  for batch_augmentation in FLAGS.batch_augmentation:
+    if batch_augmentation not in ('none', 'host', 'device'):
+      raise ValueError('Unknown batch_augmentation %s' % batch_augmentation)
+
+  report = {
+      'time': time.time(),
+      'host': platform.node(),
+      'cpu_count': os.cpu_count(),
+      'tensorflow_version': tf.__version__,
+      'mode': FLAGS.mode,
+      'batch_size': FLAGS.batch_size,
+      'image_size': FLAGS.image_size,
+      'num_batches': FLAGS.num_batches,
+  }
+  if not data_dir:
+    data_dir = FLAGS.synthetic_dir
+    prefix = 'train' if FLAGS.mode == 'train' else 'validation'
+    if FLAGS.regenerate or not tf.gfile.Glob(os.path.join(data_dir, prefix + '-*')):
+      report['synthetic_data'] = generate_synthetic_shards(
+          data_dir, prefix, FLAGS.num_shards, FLAGS.records_per_shard)
+  index_dir = FLAGS.index_dir or os.path.join(data_dir, 'index_files')
+  report['data_dir'] = data_dir
+
+  results = []
+  for backend in FLAGS.backends:
+    # Only ImageNetInput can defer its augmentation to the batch.
+    augmentations = FLAGS.batch_augmentation if backend == 'imagenet' else ['none']
+    for num_threads in FLAGS.num_threads:
+      for batch_augmentation in augmentations:
+        result = _run_config_in_subprocess(
+            backend, int(num_threads),
+            None if batch_augmentation == 'none' else batch_augmentation,
+            data_dir, index_dir)
+        tf.logging.info('%s', json.dumps(result))
+        results.append(result)
+  report['results'] = results
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      f.write(output + '\n')
+  else:
+    print(output)
+
+
+if __name__ == '__main__':
+  tf.logging.set_verbosity(tf.logging.INFO)
+  app.run(main)
@@ -0,0 +1,259 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Load generator for mnasnet_serve.py.
+
+For every level of --concurrency, that many clients send synthetic JPEGs to
+the server back to back for --duration_secs, and the throughput, the latency
+percentiles, the errors by HTTP status and the mean batch size formed by the
+server are reported as JSON.
+
+Without --server_url, the server of --saved_model_dir is started in this
+process with the flags of mnasnet_serve.py, on CPU if no GPU is visible:
+
+    python benchmark_server.py --saved_model_dir=/export/mnasnet-a1 \
+        --concurrency=1,8,32 --max_queue_delay_ms=2
+
+    python benchmark_server.py --server_url=http://host:8501 \
+        --served_model_name=mnasnet
+
+With --compare_staged_decoding, the in-process server is run with and without
+--staged_decoding and the throughput gain of the staged pipeline is reported
+for every concurrency level.
+
+With --compare_warmup, the in-process server is started cold
+(--serving_warmup=none) and then warmed up with the warm-up requests of the
+export (--serving_warmup=requests), and the latency of the first request of
+every batch size of --batch_sizes is reported for both, with the startup
+time of the server:
+
+    python benchmark_server.py --saved_model_dir=/export/mnasnet-a1 \
+        --compare_warmup
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import collections
+import json
+import threading
+import time
+from urllib import error as urllib_error
+from urllib import request as urllib_request
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_serve
+import preprocessing
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'server_url', default=None,
+    help=('URL of a running server. If not set, serve --saved_model_dir in'
+          ' this process.'))
+
+flags.DEFINE_list(
+    'concurrency', default=['1', '4', '16', '64'],
+    help='Numbers of concurrent clients to sweep.')
+
+flags.DEFINE_integer(
+    'images_per_request', default=1, help='JPEGs sent in every request.')
+
+flags.DEFINE_float(
+    'duration_secs', default=10., help='Duration of every concurrency level.')
+
+flags.DEFINE_integer(
+    'num_jpegs', default=64, help='Number of distinct synthetic JPEGs.')
+
+flags.DEFINE_bool(
+    'compare_staged_decoding', default=False,
+    help=('Run the in-process server with and without --staged_decoding and'
+          ' report the throughput gain.'))
+
+flags.DEFINE_bool(
+    'compare_warmup', default=False,
+    help=('Start the in-process server without and with warm-up and report'
+          ' the latency of its first requests.'))
+
+flags.DEFINE_string(
+    'results_file', default=None, help='Writes the results as JSON.')
+
+
+def _get_json(url):
+  return json.loads(urllib_request.urlopen(url).read().decode('utf-8'))
+
+
+def _client(url, bodies, end_time, latencies, seed):
+  """Sends requests back to back until `end_time`."""
+  rng = np.random.RandomState(seed)
+  while time.time() < end_time:
+    body = bodies[rng.randint(len(bodies))]
+    request = urllib_request.Request(
+        url, data=body, headers={'Content-Type': 'application/json'})
+    start = time.time()
+    try:
+      urllib_request.urlopen(request).read()
+      status = 200
+    except urllib_error.HTTPError as e:
+      e.read()
+      status = e.code
+      if status == 503:
+        time.sleep(0.001)
+    latencies.append((status, time.time() - start))
+
+
+def run_level(server_url, bodies, concurrency):
+  """Runs `concurrency` clients for --duration_secs; returns their stats."""
+  predict_url = '%s/v1/models/%s:predict' % (server_url,
+                                             FLAGS.served_model_name)
+  before = _get_json(server_url + '/metrics?format=json')
+  latencies = []
+  end_time = time.time() + FLAGS.duration_secs
+  clients = [threading.Thread(target=_client, args=(
+      predict_url, bodies, end_time, latencies, i))
+             for i in range(concurrency)]
+  start = time.time()
+  for client in clients:
+    client.start()
+  for client in clients:
+    client.join()
+  elapsed = time.time() - start
+  after = _get_json(server_url + '/metrics?format=json')
+
+  statuses = collections.Counter(status for status, _ in latencies)
+  ok_ms = 1e3 * np.array([t for status, t in latencies if status == 200])
+  batches = after['batches'] - before['batches']
+  images = after['images'] - before['images']
+  result = {
+      'concurrency': concurrency,
+      'requests_per_sec': len(ok_ms) / elapsed,
+      'images_per_sec': FLAGS.images_per_request * len(ok_ms) / elapsed,
+      'statuses': {str(k): v for k, v in sorted(statuses.items())},
+      'mean_batch_size': images / batches if batches else None,
+      'padded_images': after['padded_images'] - before['padded_images'],
+  }
+  if len(ok_ms):
+    result['latency_ms'] = {
+        'p50': float(np.percentile(ok_ms, 50)),
+        'p90': float(np.percentile(ok_ms, 90)),
+        'p99': float(np.percentile(ok_ms, 99)),
+    }
+  return result
+
+
+def run_sweep(bodies, staged_decoding=None):
+  """Runs every concurrency level against one server."""
+  httpd = None
+  server_url = FLAGS.server_url
+  if not server_url:
+    httpd = mnasnet_serve.create_server(port=0,
+                                        staged_decoding=staged_decoding)
+    httpd.start()
+    server_url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+  results = []
+  try:
+    for concurrency in FLAGS.concurrency:
+      result = run_level(server_url, bodies, int(concurrency))
+      if staged_decoding is not None:
+        result['staged_decoding'] = staged_decoding
+      tf.logging.info('%s', json.dumps(result))
+      results.append(result)
+  finally:
+    if httpd:
+      httpd.shutdown()
+      httpd.close()
+  return results
+
+
+def first_requests(jpegs, serving_warmup):
+  """Starts the in-process server; times its first request per batch size."""
+  start = time.time()
+  httpd = mnasnet_serve.create_server(port=0, serving_warmup=serving_warmup)
+  startup_secs = time.time() - start
+  httpd.start()
+  predict_url = 'http://127.0.0.1:%d/v1/models/%s:predict' % (
+      httpd.server_address[1], FLAGS.served_model_name)
+  first_request_ms = {}
+  try:
+    for batch_size in sorted(int(b) for b in FLAGS.batch_sizes):
+      instances = [{'b64': base64.b64encode(
+          jpegs[i % len(jpegs)]).decode('ascii')} for i in range(batch_size)]
+      request = urllib_request.Request(
+          predict_url,
+          data=json.dumps({'instances': instances}).encode('utf-8'),
+          headers={'Content-Type': 'application/json'})
+      start = time.time()
+      urllib_request.urlopen(request).read()
+      first_request_ms[batch_size] = 1e3 * (time.time() - start)
+  finally:
+    httpd.shutdown()
+    httpd.close()
+  return {'serving_warmup': serving_warmup, 'startup_secs': startup_secs,
+          'first_request_ms': first_request_ms}
+
+
+def request_bodies():
+  """JSON predict requests of --images_per_request synthetic JPEGs."""
+  jpegs = preprocessing.synthetic_jpegs(FLAGS.num_jpegs)
+  bodies = []
+  for i in range(len(jpegs)):
+    instances = [{'b64': base64.b64encode(
+        jpegs[(i + j) % len(jpegs)]).decode('ascii')}
+                 for j in range(FLAGS.images_per_request)]
+    bodies.append(json.dumps({'instances': instances}).encode('utf-8'))
+  return bodies
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  bodies = request_bodies()
+
+  if FLAGS.compare_warmup:
+    if FLAGS.server_url:
+      raise ValueError('--compare_warmup needs an in-process server.')
+    jpegs = preprocessing.synthetic_jpegs(FLAGS.num_jpegs, seed=1)
+    results = [first_requests(jpegs, 'none'),
+               first_requests(jpegs, 'requests')]
+    for batch_size, cold_ms in sorted(results[0]['first_request_ms'].items()):
+      tf.logging.info('batch size %d: first request in %.1f ms cold, %.1f ms'
+                      ' after warm-up', batch_size, cold_ms,
+                      results[1]['first_request_ms'][batch_size])
+  elif not FLAGS.compare_staged_decoding:
+    results = run_sweep(bodies)
+  else:
+    if FLAGS.server_url:
+      raise ValueError('--compare_staged_decoding needs an in-process server.')
+    serial = run_sweep(bodies, staged_decoding=False)
+    staged = run_sweep(bodies, staged_decoding=True)
+    for s, r in zip(staged, serial):
+      s['images_per_sec_gain'] = s['images_per_sec'] / r['images_per_sec']
+      tf.logging.info('concurrency %d: %.1f -> %.1f images/sec with staged'
+                      ' decoding (%.2fx)', s['concurrency'],
+                      r['images_per_sec'], s['images_per_sec'],
+                      s['images_per_sec_gain'])
+    results = serial + staged
+
+  if FLAGS.results_file:
+    with tf.gfile.GFile(FLAGS.results_file, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,147 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Measures serving latency against the request batch size.
+
+Sends batches of synthetic JPEGs, sized like ImageNet's, and reports the
+p50/p99 latency and images/sec of every batch size as JSON.
+
+Without --saved_model_dirs, only the serving input receivers are timed, with
+every number of images preprocessed in parallel of --parallel_iterations (see
+`imagenet_input.build_image_serving_input_fn`):
+
+    python benchmark_serving.py --batch_sizes=1,8,32,128
+
+With --saved_model_dirs, the 'classify' signature of every SavedModel is
+timed end to end, e.g. of two exports with different
+--serving_preprocessing_parallelism:
+
+    python benchmark_serving.py --saved_model_dirs=/export/parallel_64/1,/export/parallel_10/1
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import imagenet_input
+import preprocessing
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    'saved_model_dirs', default=[],
+    help='SavedModels to time. If empty, only the preprocessing is timed.')
+
+flags.DEFINE_list(
+    'batch_sizes', default=['1', '2', '4', '8', '16', '32', '64', '128'],
+    help='Request batch sizes to time.')
+
+flags.DEFINE_integer('image_size', default=224, help='Input image size.')
+
+flags.DEFINE_list(
+    'parallel_iterations', default=['10', '64'],
+    help='Numbers of images preprocessed in parallel to time.')
+
+flags.DEFINE_integer(
+    'num_images', default=256, help='Number of distinct synthetic JPEGs.')
+
+flags.DEFINE_integer(
+    'num_requests', default=50, help='Timed requests per batch size.')
+
+flags.DEFINE_integer(
+    'warmup_requests', default=5, help='Untimed requests per batch size.')
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the results as JSON.')
+
+
+def time_requests(run_fn, jpegs, batch_size):
+  """Times `run_fn` on batches of `batch_size` images."""
+  latencies = []
+  for i in range(FLAGS.warmup_requests + FLAGS.num_requests):
+    start = (i * batch_size) % len(jpegs)
+    batch = [jpegs[(start + j) % len(jpegs)] for j in range(batch_size)]
+    begin = time.time()
+    run_fn(batch)
+    if i >= FLAGS.warmup_requests:
+      latencies.append(time.time() - begin)
+  latencies_ms = 1e3 * np.array(latencies)
+  return {
+      'batch_size': batch_size,
+      'latency_ms': {
+          'mean': float(np.mean(latencies_ms)),
+          'p50': float(np.percentile(latencies_ms, 50)),
+          'p99': float(np.percentile(latencies_ms, 99)),
+      },
+      'images_per_sec': batch_size * len(latencies) / float(np.sum(latencies)),
+  }
+
+
+def _receiver_run_fn(sess, parallel_iterations):
+  receiver = imagenet_input.build_image_serving_input_fn(
+      FLAGS.image_size, parallel_iterations=parallel_iterations)()
+  images = receiver.features
+  image_bytes = receiver.receiver_tensors['image_bytes']
+  # Only run the preprocessing; fetching the images would time the copy.
+  op = tf.group(images)
+  return lambda batch: sess.run(op, {image_bytes: batch})
+
+
+def _saved_model_run_fn(sess, saved_model_dir):
+  meta_graph = tf.saved_model.loader.load(
+      sess, [tf.saved_model.tag_constants.SERVING], saved_model_dir)
+  signature = meta_graph.signature_def['classify']
+  image_bytes = signature.inputs['image_bytes'].name
+  outputs = [output.name for output in signature.outputs.values()]
+  return lambda batch: sess.run(outputs, {image_bytes: batch})
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  jpegs = preprocessing.synthetic_jpegs(FLAGS.num_images)
+
+  if FLAGS.saved_model_dirs:
+    configs = [('saved_model', d) for d in FLAGS.saved_model_dirs]
+  else:
+    configs = [('parallel_iterations', int(p))
+               for p in FLAGS.parallel_iterations]
+
+  results = []
+  for kind, name in configs:
+    with tf.Graph().as_default(), tf.Session() as sess:
+      if kind == 'saved_model':
+        run_fn = _saved_model_run_fn(sess, name)
+      else:
+        run_fn = _receiver_run_fn(sess, name)
+      for batch_size in FLAGS.batch_sizes:
+        result = time_requests(run_fn, jpegs, int(batch_size))
+        result[kind] = name
+        tf.logging.info('%s', json.dumps(result))
+        results.append(result)
+
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
@@ -0,0 +1,305 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Benchmarks the TFLite models written by `export()` on CPU.
+
+For every model in --model_names, the export in <export_root>/<model_name>
+is expected to hold the `<model_name>.tflite` file and, when exported, the
+`<model_name>_postquant.tflite` (dynamic-range) and `<model_name>_int8.tflite`
+(full-integer, see --full_integer_quantization) files, and the timestamped
+SavedModel written by `export()`. Every TFLite file is loaded with the Python
+interpreter and, for every thread count and batch size, timed on
+validation images preprocessed as for evaluation:
+
+  - warm p50/p90/p99 latency per batch and images/sec;
+  - top-1 agreement with the float SavedModel, and top-1 accuracy, on all
+    --num_images images;
+  - for the quantized files, the top-1 accuracy delta and the speedup against
+    the float `.tflite` in the same thread count and batch size.
+
+    python benchmark_tflite.py --export_root=/export --data_dir=/data/imagenet \
+        --num_threads=1,4 --batch_sizes=1,8 --output_file=tflite.json
+
+The report is a JSON list with one entry per model, TFLite file, thread count
+and batch size; a summary table is logged side by side.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import preprocessing
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'export_root', default=None,
+    help='Directory holding one export() directory per model name.')
+
+flags.DEFINE_list(
+    'model_names',
+    default=['mnasnet-a1', 'mnasnet-b1', 'mnasnet-small', 'mnasnet-d1',
+             'mnasnet-d1-320'],
+    help='Models to benchmark; models without an export are skipped.')
+
+flags.DEFINE_string(
+    'data_dir', default=None,
+    help='Directory of the validation-* TFRecords of ImageNet.')
+
+flags.DEFINE_integer(
+    'num_images', default=500, help='Validation images to evaluate.')
+
+flags.DEFINE_list(
+    'num_threads', default=['1', '2', '4'],
+    help='Interpreter thread counts to sweep.')
+
+flags.DEFINE_list(
+    'batch_sizes', default=['1', '4', '16'], help='Batch sizes to sweep.')
+
+flags.DEFINE_integer(
+    'warmup_runs', default=5, help='Untimed runs per configuration.')
+
+flags.DEFINE_integer(
+    'timed_runs', default=50, help='Timed runs per configuration.')
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the results as JSON.')
+
+
+def read_validation_images(image_size):
+  """Returns the first validation images as (jpegs, uint8 images, labels)."""
+  filenames = sorted(tf.gfile.Glob(os.path.join(FLAGS.data_dir,
+                                                'validation-*')))
+  if not filenames:
+    raise ValueError('No validation-* files in %s' % FLAGS.data_dir)
+  jpegs, labels = [], []
+  for filename in filenames:
+    for record in tf.python_io.tf_record_iterator(filename):
+      example = tf.train.Example.FromString(record)
+      feature = example.features.feature
+      jpegs.append(feature['image/encoded'].bytes_list.value[0])
+      # Labels are 1-based in the ImageNet TFRecords.
+      labels.append(feature['image/class/label'].int64_list.value[0] - 1)
+      if len(jpegs) == FLAGS.num_images:
+        break
+    if len(jpegs) == FLAGS.num_images:
+      break
+
+  with tf.Graph().as_default(), tf.Session() as sess:
+    image_bytes = tf.placeholder(tf.string, [])
+    image = preprocessing.preprocess_image(
+        image_bytes, is_training=False, image_size=image_size,
+        defer_to_batch=True)
+    images = np.stack([sess.run(image, {image_bytes: jpeg})
+                       for jpeg in jpegs])
+  return jpegs, images, np.array(labels)
+
+
+def _normalized(images):
+  images = images.astype(np.float32)
+  return ((images - np.float32(preprocessing.MEAN_RGB)) /
+          np.float32(preprocessing.STDDEV_RGB))
+
+
+def _latest_saved_model(export_dir):
+  versions = [d for d in tf.gfile.ListDirectory(export_dir)
+              if d.strip('/').isdigit()]
+  if not versions:
+    return None
+  return os.path.join(export_dir, max(versions, key=lambda d: int(d.strip('/'))))
+
+
+def saved_model_classes(saved_model_dir, jpegs, images, batch_size=32):
+  """Top-1 classes of the float SavedModel, whichever its input signature."""
+  with tf.Graph().as_default(), tf.Session() as sess:
+    meta_graph = tf.saved_model.loader.load(
+        sess, [tf.saved_model.tag_constants.SERVING], saved_model_dir)
+    signature = meta_graph.signature_def['classify']
+    classes = signature.outputs['classes'].name
+    if 'image_bytes' in signature.inputs:
+      input_name, inputs = signature.inputs['image_bytes'].name, jpegs
+    else:
+      input_name, inputs = signature.inputs['images'].name, images
+    return np.concatenate([
+        sess.run(classes, {input_name: inputs[i:i + batch_size]})
+        for i in range(0, len(inputs), batch_size)])
+
+
+def _is_nchw(shape):
+  return shape[1] == 3 and shape[3] != 3
+
+
+def _image_size(model_path):
+  """The image size a TFLite file was exported with."""
+  shape = list(tf.lite.Interpreter(
+      model_path=model_path).get_input_details()[0]['shape'])
+  return int(shape[2] if _is_nchw(shape) else shape[1])
+
+
+class TFLiteModel(object):
+  """A TFLite interpreter resized to one batch size."""
+
+  def __init__(self, model_path, num_threads, batch_size):
+    self._interpreter = tf.lite.Interpreter(model_path=model_path,
+                                            num_threads=num_threads)
+    input_details = self._interpreter.get_input_details()[0]
+    self._input_index = input_details['index']
+    self._input_dtype = input_details['dtype']
+    # The uint8 images of a uint8 export are raw, with no quantization.
+    self._input_scale, self._input_zero_point = (
+        input_details['quantization'])
+    shape = list(input_details['shape'])
+    # The 'truediv' input of a channels_first model is NCHW.
+    self._nchw = _is_nchw(shape)
+    self._interpreter.resize_tensor_input(self._input_index,
+                                          [batch_size] + shape[1:])
+    self._interpreter.allocate_tensors()
+    self._output_index = self._interpreter.get_output_details()[0]['index']
+    self.batch_size = batch_size
+
+  def prepare(self, images):
+    """Converts uint8 images to the input of the model."""
+    if self._input_scale:
+      # The int8 input of a full-integer model quantizes normalized images.
+      info = np.iinfo(self._input_dtype)
+      images = np.clip(
+          np.round(_normalized(images) / self._input_scale +
+                   self._input_zero_point), info.min, info.max)
+      images = images.astype(self._input_dtype)
+    elif self._input_dtype != np.uint8:
+      images = _normalized(images).astype(self._input_dtype)
+    if self._nchw:
+      images = np.ascontiguousarray(images.transpose([0, 3, 1, 2]))
+    return images
+
+  def run(self, inputs):
+    self._interpreter.set_tensor(self._input_index, inputs)
+    self._interpreter.invoke()
+    return self._interpreter.get_tensor(self._output_index)
+
+
+def benchmark(model_path, num_threads, batch_size, images, reference_classes,
+              labels):
+  """Times one TFLite file in one configuration and checks its predictions."""
+  model = TFLiteModel(model_path, num_threads, batch_size)
+  # Only whole batches are evaluated.
+  num_images = len(images) // batch_size * batch_size
+  inputs = [model.prepare(images[i:i + batch_size])
+            for i in range(0, num_images, batch_size)]
+  classes = np.concatenate([np.argmax(model.run(x), axis=-1) for x in inputs])
+
+  for i in range(FLAGS.warmup_runs):
+    model.run(inputs[i % len(inputs)])
+  latencies = []
+  for i in range(FLAGS.timed_runs):
+    start = time.time()
+    model.run(inputs[i % len(inputs)])
+    latencies.append(time.time() - start)
+  latencies_ms = 1e3 * np.array(latencies)
+  return {
+      'num_threads': num_threads,
+      'batch_size': batch_size,
+      'latency_ms': {
+          'p50': float(np.percentile(latencies_ms, 50)),
+          'p90': float(np.percentile(latencies_ms, 90)),
+          'p99': float(np.percentile(latencies_ms, 99)),
+      },
+      'images_per_sec': batch_size * len(latencies) / float(np.sum(latencies)),
+      'top_1_agreement': (
+          float(np.mean(classes == reference_classes[:num_images]))
+          if reference_classes is not None else None),
+      'top_1_accuracy': float(np.mean(classes == labels[:num_images])),
+  }
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  validation = {}
+  results = []
+  for model_name in FLAGS.model_names:
+    export_dir = os.path.join(FLAGS.export_root, model_name)
+    tflite_files = [os.path.join(export_dir, model_name + suffix)
+                    for suffix in ['.tflite', '_postquant.tflite',
+                                   '_int8.tflite']]
+    tflite_files = [f for f in tflite_files if tf.gfile.Exists(f)]
+    if not tflite_files:
+      tf.logging.info('Skipping %s, no TFLite files in %s.', model_name,
+                      export_dir)
+      continue
+
+    image_size = _image_size(tflite_files[0])
+    if image_size not in validation:
+      validation[image_size] = read_validation_images(image_size)
+    jpegs, images, labels = validation[image_size]
+
+    reference_classes = None
+    saved_model_dir = _latest_saved_model(export_dir)
+    if saved_model_dir:
+      reference_classes = saved_model_classes(saved_model_dir, jpegs, images)
+    else:
+      tf.logging.info('No SavedModel in %s, skipping the agreement check.',
+                      export_dir)
+
+    # The float `.tflite`, first when it exists, is the baseline of the others.
+    float_results = {}
+    for tflite_file in tflite_files:
+      for num_threads in FLAGS.num_threads:
+        for batch_size in FLAGS.batch_sizes:
+          result = benchmark(tflite_file, int(num_threads), int(batch_size),
+                             images, reference_classes, labels)
+          result['model_name'] = model_name
+          result['tflite_file'] = os.path.basename(tflite_file)
+          key = (num_threads, batch_size)
+          if tflite_file.endswith(model_name + '.tflite'):
+            float_results[key] = result
+          float_result = float_results.get(key)
+          if float_result is not None and float_result is not result:
+            result['accuracy_delta_vs_float'] = (
+                result['top_1_accuracy'] - float_result['top_1_accuracy'])
+            result['speedup_vs_float'] = (
+                result['images_per_sec'] / float_result['images_per_sec'])
+          tf.logging.info('%s', json.dumps(result))
+          results.append(result)
+
+  tf.logging.info('%-16s %-32s %7s %5s %9s %9s %9s %10s %9s %8s',
+                  'model', 'file', 'threads', 'batch', 'p50 ms', 'p99 ms',
+                  'img/s', 'agreement', 'acc diff', 'speedup')
+  for r in results:
+    tf.logging.info('%-16s %-32s %7d %5d %9.2f %9.2f %9.1f %10s %9s %8s',
+                    r['model_name'], r['tflite_file'], r['num_threads'],
+                    r['batch_size'], r['latency_ms']['p50'],
+                    r['latency_ms']['p99'], r['images_per_sec'],
+                    '%.4f' % r['top_1_agreement']
+                    if r['top_1_agreement'] is not None else '-',
+                    '%+.4f' % r['accuracy_delta_vs_float']
+                    if 'accuracy_delta_vs_float' in r else '-',
+                    '%.2fx' % r['speedup_vs_float']
+                    if 'speedup_vs_float' in r else '-')
+
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
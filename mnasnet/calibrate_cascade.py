@@ -0,0 +1,181 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Calibrates the confidence threshold of a small-to-large model cascade.
+
+Runs the SavedModels of --small_model_dir (e.g. mnasnet-small) and
+--large_model_dir (e.g. mnasnet-a1 or mnasnet-d1) on the first --num_images
+validation images, and picks the confidence threshold of the small model
+that escalates the fewest images to the large model while the top-1 accuracy
+of the cascade stays within --max_accuracy_loss of the large model alone.
+See utils/cascade.py for the confidence measures.
+
+The cost of a model is its time per image on this host at --batch_size, the
+images being decoded beforehand, and the compute saved is the share of the
+cost of the large model alone that the cascade does not spend:
+
+    python calibrate_cascade.py --small_model_dir=/export/mnasnet-small \
+        --large_model_dir=/export/mnasnet-a1 --data_dir=/data/imagenet \
+        --max_accuracy_loss=0.005 --output_file=/export/cascade.json
+
+The output file is read by mnasnet_serve.py --cascade_calibration_file; it
+also holds the threshold, escalation rate and compute saved of every loss of
+--tradeoff_accuracy_losses.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_serve
+from utils import cascade
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'small_model_dir', default=None,
+    help='Export of the model run on every image.')
+
+flags.DEFINE_string(
+    'large_model_dir', default=None,
+    help='Export of the model the low-confidence images are escalated to.')
+
+flags.DEFINE_string(
+    'data_dir', default=None,
+    help='Directory of the validation-* TFRecords of ImageNet.')
+
+flags.DEFINE_integer(
+    'num_images', default=10000, help='Validation images to calibrate on.')
+
+flags.DEFINE_integer(
+    'batch_size', default=32,
+    help='Batch size the models are run and timed with.')
+
+flags.DEFINE_enum(
+    'confidence_measure', default='max_softmax', enum_values=cascade.MEASURES,
+    help='Confidence of the small model compared to the threshold.')
+
+flags.DEFINE_float(
+    'max_accuracy_loss', default=0.005,
+    help='Largest top-1 accuracy loss against the large model alone.')
+
+flags.DEFINE_list(
+    'tradeoff_accuracy_losses', default=['0', '0.0025', '0.005', '0.01', '0.02'],
+    help='Accuracy losses of the reported tradeoff curve.')
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the calibration as JSON.')
+
+
+def read_validation_jpegs():
+  """Returns the first --num_images validation JPEGs and their labels."""
+  filenames = sorted(tf.gfile.Glob(os.path.join(FLAGS.data_dir,
+                                                'validation-*')))
+  if not filenames:
+    raise ValueError('No validation-* files in %s' % FLAGS.data_dir)
+  jpegs, labels = [], []
+  for filename in filenames:
+    for record in tf.python_io.tf_record_iterator(filename):
+      feature = tf.train.Example.FromString(record).features.feature
+      jpegs.append(feature['image/encoded'].bytes_list.value[0])
+      # Labels are 1-based in the ImageNet TFRecords.
+      labels.append(feature['image/class/label'].int64_list.value[0] - 1)
+      if len(jpegs) == FLAGS.num_images:
+        return jpegs, np.array(labels)
+  return jpegs, np.array(labels)
+
+
+def run_model(model_dir, jpegs):
+  """Returns the probabilities of a model and its time per image in ms."""
+  runner = mnasnet_serve.SavedModelRunner(
+      mnasnet_serve.latest_saved_model(model_dir))
+  decoder = None
+  if runner.can_run_decoded:
+    decoder = mnasnet_serve.JpegDecoder(runner.image_size)
+  probabilities = []
+  elapsed, timed_images = 0., 0
+  try:
+    for i in range(0, len(jpegs), FLAGS.batch_size):
+      batch = jpegs[i:i + FLAGS.batch_size]
+      if decoder:
+        inputs, run_fn = decoder(batch), runner.run_decoded
+      else:
+        # Without a decoded input the time includes decoding.
+        inputs, run_fn = np.array(batch, dtype=object), runner
+      start = time.time()
+      probabilities.append(run_fn(inputs)['probabilities'])
+      # The first batch pays for the first run of the graph.
+      if i:
+        elapsed += time.time() - start
+        timed_images += len(batch)
+  finally:
+    runner.close()
+    if decoder:
+      decoder.sess.close()
+  ms_per_image = 1e3 * elapsed / timed_images if timed_images else None
+  return np.concatenate(probabilities), ms_per_image
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  jpegs, labels = read_validation_jpegs()
+  tf.logging.info('Calibrating on %d validation images.', len(jpegs))
+  small_probabilities, small_ms = run_model(FLAGS.small_model_dir, jpegs)
+  large_probabilities, large_ms = run_model(FLAGS.large_model_dir, jpegs)
+
+  def calibrate(max_accuracy_loss):
+    result = cascade.calibrate(small_probabilities, large_probabilities,
+                               labels, max_accuracy_loss,
+                               FLAGS.confidence_measure)
+    if small_ms and large_ms:
+      result['compute_saved'] = cascade.compute_saved(
+          result['escalation_rate'], small_ms, large_ms)
+    return result
+
+  calibration = calibrate(FLAGS.max_accuracy_loss)
+  calibration.update({
+      'small_model_dir': FLAGS.small_model_dir,
+      'large_model_dir': FLAGS.large_model_dir,
+      'small_ms_per_image': small_ms,
+      'large_ms_per_image': large_ms,
+      'batch_size': FLAGS.batch_size,
+      'tradeoff': [calibrate(float(loss))
+                   for loss in FLAGS.tradeoff_accuracy_losses],
+  })
+
+  tf.logging.info('%-10s %-10s %-10s %-10s %s', 'max loss', 'threshold',
+                  'escalated', 'accuracy', 'compute saved')
+  for result in calibration['tradeoff']:
+    tf.logging.info('%-10.4f %-10.4f %-10.3f %-10.4f %s',
+                    result['max_accuracy_loss'], result['threshold'],
+                    result['escalation_rate'], result['accuracy'],
+                    '%.3f' % result['compute_saved']
+                    if 'compute_saved' in result else '-')
+  tf.logging.info('%s', json.dumps(calibration))
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump(calibration, f, indent=2)
+
+
+if __name__ == '__main__':
+  app.run(main)
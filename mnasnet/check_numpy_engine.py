@@ -0,0 +1,155 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Compares the NumPy engine with TensorFlow for every predefined model.
+
+Each model of `mnasnet_models_v1.get_model_params` is built with random
+weights, including random batch norm statistics, and run by TensorFlow in
+inference mode. Its folded weights are packed with `mnasnet_numpy.save_weights`
+and run by `NumpyMnasNet` on the same images. The logits must agree within
+--tolerance; the report also has the time to load the packed weights and the
+CPU latency of both.
+
+    python check_numpy_engine.py --output_file=numpy_engine.json
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_inference
+import mnasnet_model
+import mnasnet_models_v1 as mnasnet_models
+import mnasnet_numpy
+from preprocessing import MEAN_RGB
+from preprocessing import STDDEV_RGB
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_list(
+    'model_names',
+    default=['mnasnet-a1', 'mnasnet-b1', 'mnasnet-small', 'mnasnet-d1',
+             'mnasnet-d1-320'],
+    help='Models to check.')
+
+flags.DEFINE_integer('image_size', default=224, help='Input image size.')
+
+flags.DEFINE_integer('batch_size', default=4, help='Images per check.')
+
+flags.DEFINE_float(
+    'tolerance', default=1e-3,
+    help=('Largest difference allowed between the logits, relative to the'
+          ' largest TensorFlow logit (or absolute below 1).'))
+
+flags.DEFINE_string(
+    'output_file', default=None, help='Writes the report as JSON.')
+
+
+def _randomize_batch_norms(sess, rng):
+  """Gives every batch norm random, non-trivial statistics."""
+  for v in tf.global_variables():
+    name = v.op.name.split('/')[-1]
+    shape = v.shape.as_list()
+    if name in ('gamma', 'moving_variance'):
+      value = rng.uniform(0.5, 1.5, shape)
+    elif name in ('beta', 'moving_mean'):
+      value = rng.normal(0., 0.1, shape)
+    else:
+      continue
+    v.load(value.astype(np.float32), sess)
+
+
+def check_model(model_name, images, weights_file, rng):
+  """Returns the comparison of TensorFlow and NumPy for one model."""
+  blocks_args, global_params = mnasnet_models.get_model_params(
+      model_name, {'data_format': 'channels_last'})
+  with tf.Graph().as_default(), tf.Session() as sess:
+    inputs = tf.placeholder(tf.uint8, [None, None, None, 3])
+    features = tf.cast(inputs, tf.float32)
+    features -= tf.constant(MEAN_RGB, shape=[1, 1, 3])
+    features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3])
+    with tf.variable_scope(model_name):
+      model = mnasnet_model.MnasNetModel(blocks_args, global_params)
+      logits = model(features, training=False)
+    sess.run(tf.global_variables_initializer())
+    _randomize_batch_norms(sess, rng)
+    tf_logits = sess.run(logits, {inputs: images})
+    start = time.time()
+    sess.run(logits, {inputs: images})
+    tf_latency = time.time() - start
+    weights = mnasnet_inference.extract_inference_weights(model, sess)
+
+  mnasnet_numpy.save_weights(weights, weights_file, model_name,
+                             MEAN_RGB, STDDEV_RGB)
+  start = time.time()
+  engine = mnasnet_numpy.NumpyMnasNet(weights_file)
+  load_secs = time.time() - start
+  numpy_logits = engine.predict(images)
+  start = time.time()
+  engine.predict(images)
+  numpy_latency = time.time() - start
+
+  return {
+      'model_name': model_name,
+      'max_abs_logits_diff': float(np.max(np.abs(numpy_logits - tf_logits))),
+      'max_rel_logits_diff': float(
+          np.max(np.abs(numpy_logits - tf_logits)) /
+          max(1., np.max(np.abs(tf_logits)))),
+      'weights_file_mb': os.path.getsize(weights_file) / 2.**20,
+      'numpy_load_ms': 1e3 * load_secs,
+      'tf_latency_ms': 1e3 * tf_latency,
+      'numpy_latency_ms': 1e3 * numpy_latency,
+  }
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  rng = np.random.RandomState(0)
+  images = rng.randint(0, 256, size=[FLAGS.batch_size, FLAGS.image_size,
+                                     FLAGS.image_size, 3]).astype(np.uint8)
+  weights_dir = tempfile.mkdtemp()
+  results = []
+  try:
+    for model_name in FLAGS.model_names:
+      weights_file = os.path.join(weights_dir, model_name + '.npw')
+      result = check_model(model_name, images, weights_file, rng)
+      tf.logging.info('%s', json.dumps(result))
+      results.append(result)
+  finally:
+    shutil.rmtree(weights_dir)
+
+  if FLAGS.output_file:
+    with tf.gfile.GFile(FLAGS.output_file, 'w') as f:
+      json.dump(results, f, indent=2)
+  failed = [r['model_name'] for r in results
+            if r['max_rel_logits_diff'] > FLAGS.tolerance]
+  if failed:
+    raise ValueError('The NumPy engine differs from TensorFlow by more than '
+                     '--tolerance=%g for %s.' % (FLAGS.tolerance,
+                                                 ', '.join(failed)))
+
+
+if __name__ == '__main__':
+  app.run(main)
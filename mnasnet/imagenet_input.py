@@ -47,6 +47,10 @@ import tensorflow as tf
 import preprocessing
 from utils import data_utils
 from utils import hvd_utils
+from utils import input_state
+from utils import record_index
+from utils import warmup_requests
+from utils import work_leases
 
 
 # for dali processing
@@ -82,8 +86,14 @@ def parse_dali_idx_dataset(data_idx_dir, mode):
         
     return filenames
 
-def build_image_serving_input_fn(image_size):
-  """Builds a serving input fn for raw images."""
+def build_image_serving_input_fn(image_size, parallel_iterations=10):
+  """Builds a serving input fn for raw images.
+
+  Args:
+    image_size: `int` for image size (both width and height).
+    parallel_iterations: number of images of a request decoded and resized
+      in parallel, as for evaluation.
+  """
   def _image_serving_input_fn():
     """Serving input fn for raw images."""
     def _preprocess_image(image_bytes):
@@ -97,12 +107,150 @@ def build_image_serving_input_fn(image_size):
         dtype=tf.string,
     )
     images = tf.map_fn(
-        _preprocess_image, image_bytes_list, back_prop=False, dtype=tf.float32)
+        _preprocess_image, image_bytes_list, back_prop=False,
+        dtype=tf.float32, parallel_iterations=parallel_iterations)
     return tf.estimator.export.ServingInputReceiver(
         images, {'image_bytes': image_bytes_list})
   return _image_serving_input_fn
 
 
+def build_uint8_serving_input_fn(image_size):
+  """Builds a serving input fn for decoded, resized uint8 NHWC images.
+
+  The model_fn folds the normalization of uint8 images into the stem conv.
+  """
+  def _uint8_serving_input_fn():
+    images = tf.placeholder(
+        shape=[None, image_size, image_size, 3],
+        dtype=tf.uint8,
+        name='images',
+    )
+    return tf.estimator.export.ServingInputReceiver(images, {'images': images})
+  return _uint8_serving_input_fn
+
+
+def build_representative_dataset(data_dir, image_size, num_images,
+                                 data_format='channels_last',
+                                 uint8_input=False):
+  """Builds the calibration images of a full-integer TFLite conversion.
+
+  Args:
+    data_dir: `str` for the directory of the validation data.
+    image_size: `int` for image size (both width and height).
+    num_images: `int` for the number of calibration images.
+    data_format: layout of the input of the exported model.
+    uint8_input: if true, the exported model takes uint8 NHWC images; else it
+      takes normalized float images in `data_format`.
+
+  Returns:
+    A generator function yielding one [1, ...] input at a time, for
+    `TFLiteConverter.representative_dataset`.
+  """
+  def _representative_dataset():
+    with tf.Graph().as_default():
+      # Evaluation preprocessing, as for serving.
+      images, _ = ImageNetInput(
+          is_training=False,
+          use_bfloat16=False,
+          transpose_input=False,
+          data_dir=data_dir,
+          image_size=image_size,
+          batch_augmentation='host' if not uint8_input else None,
+          data_format=data_format).input_fn(
+              {'batch_size': 1}).take(num_images).make_one_shot_iterator(
+              ).get_next()
+      if uint8_input:
+        images = tf.saturate_cast(tf.round(images), tf.uint8)
+      with tf.Session() as sess:
+        for _ in range(num_images):
+          try:
+            yield [sess.run(images)]
+          except tf.errors.OutOfRangeError:
+            return
+  return _representative_dataset
+
+
+def _sample_jpegs(data_dir, num_images):
+  """The first `num_images` validation JPEGs, or synthetic ones without any."""
+  filenames = []
+  if data_dir:
+    filenames = sorted(tf.gfile.Glob(os.path.join(data_dir, 'validation-*')))
+  jpegs = []
+  for filename in filenames:
+    for record in tf.python_io.tf_record_iterator(filename):
+      jpegs.append(tf.train.Example.FromString(
+          record).features.feature['image/encoded'].bytes_list.value[0])
+      if len(jpegs) == num_images:
+        return jpegs
+  if jpegs:
+    return [jpegs[i % len(jpegs)] for i in range(num_images)]
+  return preprocessing.synthetic_jpegs(num_images)
+
+
+def write_warmup_requests(filename, data_dir, image_size, batch_sizes,
+                          uint8_input=False, parallel_iterations=10,
+                          signature_name='classify'):
+  """Writes the warm-up requests of an export, one per batch size.
+
+  The requests hold validation JPEGs of `data_dir` (synthetic ones without
+  any), decoded by `build_image_serving_input_fn` so that an export never
+  ships requests its signature cannot run. See utils/warmup_requests.py.
+
+  Args:
+    filename: the TFRecord file to write, to be exported as
+      assets.extra/tf_serving_warmup_requests.
+    data_dir: `str` for the directory of the validation data, or None.
+    image_size: `int` for image size (both width and height).
+    batch_sizes: the batch sizes of the requests.
+    uint8_input: if true, the requests hold the decoded uint8 NHWC images of
+      the uint8 signature; else the JPEG bytes.
+    parallel_iterations: the `parallel_iterations` argument of the serving
+      input fn.
+    signature_name: the signature the requests run.
+  """
+  jpegs = _sample_jpegs(data_dir, max(batch_sizes))
+  with tf.Graph().as_default():
+    receiver = build_image_serving_input_fn(
+        image_size, parallel_iterations=parallel_iterations)()
+    # A features `Tensor` is wrapped as {'feature': ...}.
+    images = receiver.features['feature']
+    if uint8_input:
+      images = tf.saturate_cast(tf.round(images), tf.uint8)
+    with tf.Session() as sess:
+      images = sess.run(images, {receiver.receiver_tensors['image_bytes']:
+                                 jpegs})
+  with tf.python_io.TFRecordWriter(filename) as writer:
+    for batch_size in batch_sizes:
+      if uint8_input:
+        inputs = {'images': images[:batch_size]}
+      else:
+        inputs = {'image_bytes': jpegs[:batch_size]}
+      writer.write(warmup_requests.encode(
+          {k: tf.make_tensor_proto(v).SerializeToString()
+           for k, v in inputs.items()}, signature_name))
+
+
+def read_warmup_requests(saved_model_dir, input_key,
+                         signature_name='classify'):
+  """The warm-up request batches of a SavedModel for one signature input.
+
+  Returns a list of numpy arrays, empty if the SavedModel has no warm-up
+  requests.
+  """
+  filename = warmup_requests.path(saved_model_dir)
+  if not tf.gfile.Exists(filename):
+    return []
+  batches = []
+  for record in tf.python_io.tf_record_iterator(filename):
+    request = warmup_requests.decode(record)
+    if (request is None or request[0] != signature_name or
+        input_key not in request[1]):
+      continue
+    batches.append(tf.make_ndarray(
+        tf.TensorProto.FromString(request[1][input_key])))
+  return batches
+
+
 class ImageNetTFExampleInput(object):
   """Base class for ImageNet input_fn generator.
 
@@ -112,6 +260,15 @@ class ImageNetTFExampleInput(object):
     num_cores: `int` for the number of TPU cores
     image_size: `int` for image size (both width and height).
     transpose_input: 'bool' for whether to use the double transpose trick
+    input_stats: optional `input_stats.InputPipelineStats` used to instrument
+      the stages of the pipeline.
+    synthetic_data: if true, `input_fn` replays one random batch kept on the
+      compute device instead of reading any data.
+    batch_augmentation: None, 'host' or 'device'. If set, images are parsed
+      to uint8 and flipped, converted and normalized per batch by
+      `preprocessing.augment_batch`, in the input pipeline ('host') or by the
+      model_fn ('device').
+    data_format: layout of the batches augmented on the host.
   """
   __metaclass__ = abc.ABCMeta
 
@@ -120,13 +277,23 @@ class ImageNetTFExampleInput(object):
                use_bfloat16,
                num_cores=64,
                image_size=224,
-               transpose_input=False):
+               transpose_input=False,
+               input_stats=None,
+               synthetic_data=False,
+               batch_augmentation=None,
+               data_format='channels_last'):
+    if batch_augmentation not in (None, 'host', 'device'):
+      raise ValueError('Unknown batch_augmentation: %s' % batch_augmentation)
     self.image_preprocessing_fn = preprocessing.preprocess_image
     self.is_training = is_training
     self.use_bfloat16 = use_bfloat16
     self.num_cores = num_cores
     self.transpose_input = transpose_input
     self.image_size = image_size
+    self.input_stats = input_stats
+    self.synthetic_data = synthetic_data
+    self.batch_augmentation = batch_augmentation
+    self.data_format = data_format
 
   def set_shapes(self, batch_size, images, labels):
     """Statically set the batch_size dimension."""
@@ -164,7 +331,8 @@ class ImageNetTFExampleInput(object):
         image_bytes=image_bytes,
         is_training=self.is_training,
         image_size=self.image_size,
-        use_bfloat16=self.use_bfloat16)
+        use_bfloat16=self.use_bfloat16,
+        defer_to_batch=bool(self.batch_augmentation))
 
     # Subtract one so that labels are in [0, 1000).
     label = tf.cast(
@@ -196,17 +364,28 @@ class ImageNetTFExampleInput(object):
     Args:
       params: `dict` of parameters passed from the `TPUEstimator`.
           `params['batch_size']` is always provided and should be used as the
-          effective batch size.
+          effective batch size. `params['input_shard_index']` and
+          `params['input_num_shards']` optionally set the training shard of
+          this input, and `params['input_batches_per_step']` the number of
+          batches of it consumed per step, e.g. by the local replicas of a
+          `MirroredStrategy`.
 
     Returns:
       A `tf.data.Dataset` object.
     """
+    if self.synthetic_data:
+      return self.synthetic_input_fn(params)
+
     # Retrieves the batch size for the current shard. The # of shards is
     # computed according to the input pipeline deployment. See
     # tf.contrib.tpu.RunConfig for details.
     batch_size = params['batch_size']
     # Mnas optimize - added hvd to params to enable sharding for horovod
-    if 'hvd' in params and self.is_training:
+    exact_eval = not self.is_training and getattr(self, 'exact_eval', False)
+    if 'input_num_shards' in params and self.is_training:
+      current_host = params['input_shard_index']
+      num_hosts = params['input_num_shards']
+    elif 'hvd' in params and (self.is_training or exact_eval):
       tf.logging.info('Mnas optimize - hvd data sharding. Curr host: %d. Num hosts: %d', \
         params['hvd_curr_host'], params['hvd_num_hosts'])
       current_host = params['hvd_curr_host']
@@ -218,7 +397,36 @@ class ImageNetTFExampleInput(object):
       current_host = 0
       num_hosts = 1
 
-    dataset = self.make_source_dataset(current_host, num_hosts)
+    if exact_eval:
+      dataset, num_records = self.make_eval_shard_dataset(current_host,
+                                                          num_hosts)
+    elif self.is_training and getattr(self, 'resume_dir', None):
+      dataset = self.make_resumable_dataset(
+          current_host, num_hosts,
+          batch_size * params.get('input_batches_per_step', 1))
+    else:
+      dataset = self.make_source_dataset(current_host, num_hosts)
+
+    parser = self.dataset_parser
+    if self.input_stats:
+      parser = self.input_stats.wrap('parse', parser)
+
+    if exact_eval:
+      # Every validation record is read by exactly one host. The last batch
+      # is padded with label -1, which the metrics mask out.
+      dataset = dataset.map(parser, num_parallel_calls=self.num_cores)
+      def padding_element(_):
+        if self.batch_augmentation:
+          image = tf.zeros([self.image_size, self.image_size, 3], tf.uint8)
+        else:
+          image = self._get_null_input(None)
+        return image, tf.constant(-1, tf.int32)
+
+      padding = tf.data.Dataset.range((-num_records) % batch_size).map(
+          padding_element)
+      dataset = dataset.concatenate(padding).batch(
+          batch_size, drop_remainder=True)
+      return self._finish_batches(dataset, batch_size)
 
     # Use the fused map-and-batch operation.
     #
@@ -232,8 +440,73 @@ class ImageNetTFExampleInput(object):
     # exactly the same images will be used.
     dataset = dataset.apply(
         tf.contrib.data.map_and_batch(
-            self.dataset_parser, batch_size=batch_size,
+            parser, batch_size=batch_size,
             num_parallel_batches=self.num_cores, drop_remainder=True))
+    if self.input_stats:
+      dataset = self.input_stats.tap(dataset, 'batch')
+    return self._finish_batches(dataset, batch_size)
+
+  def synthetic_input_fn(self, params):
+    """Input function replaying a single random batch.
+
+    The batch is generated once into local variables on the compute device,
+    so training steps measure compute and communication only. TPUs need an
+    infeed and a distribution strategy a dataset to distribute, so there the
+    batch is replayed from a dataset instead. The batch has the dtype and
+    layout the model_fn expects from the real input: uint8 for
+    `batch_augmentation='device'`, and already in `data_format` for 'host'.
+
+    Args:
+      params: `dict` of parameters passed from the `TPUEstimator`.
+          `params['input_dataset']` requests a dataset.
+
+    Returns:
+      A tuple of (images, labels), or a `tf.data.Dataset` of it on TPU or
+      when requested.
+    """
+    batch_size = params['batch_size']
+    size = self.image_size
+    if self.batch_augmentation == 'device':
+      dtype = tf.uint8
+    else:
+      dtype = tf.bfloat16 if self.use_bfloat16 else tf.float32
+    if (self.batch_augmentation == 'host' and
+        self.data_format == 'channels_first'):
+      shape = [batch_size, 3, size, size]
+    else:
+      shape = [batch_size, size, size, 3]
+    if self.transpose_input:
+      shape = shape[1:] + shape[:1]
+    tf.logging.info('Using a synthetic %s batch of shape %s', dtype.name, shape)
+
+    def random_images():
+      if dtype == tf.uint8:
+        return tf.cast(tf.random_uniform(shape, 0, 256, tf.int32), tf.uint8)
+      return tf.cast(tf.truncated_normal(shape), dtype)
+
+    if 'context' in params or params.get('input_dataset'):
+      images = random_images()
+      labels = tf.random_uniform([batch_size], 0, 1000, dtype=tf.int32)
+      return tf.data.Dataset.from_tensors((images, labels)).repeat()
+
+    # The Estimator calls input_fn under a CPU device scope; clear it so the
+    # variables are placed with the model.
+    with tf.device(None):
+      images = tf.get_local_variable(
+          'synthetic_images', initializer=random_images())
+      labels = tf.get_local_variable(
+          'synthetic_labels',
+          initializer=tf.random_uniform([batch_size], 0, 1000, dtype=tf.int32))
+      return tf.identity(images), tf.identity(labels)
+
+  def _finish_batches(self, dataset, batch_size):
+    """Augments, transposes, shapes and prefetches a dataset of batches."""
+    if self.batch_augmentation == 'host':
+      dataset = dataset.map(
+          lambda images, labels: (preprocessing.augment_batch(
+              images, self.is_training, self.use_bfloat16, self.data_format),
+                                  labels),
+          num_parallel_calls=self.num_cores)
 
     # Transpose for performance on TPU
     if self.transpose_input:
@@ -245,6 +518,9 @@ class ImageNetTFExampleInput(object):
     dataset = dataset.map(functools.partial(self.set_shapes, batch_size), num_parallel_calls=self.num_cores)
     # Prefetch overlaps in-feed with training
     dataset = dataset.prefetch(tf.contrib.data.AUTOTUNE)
+    if self.input_stats:
+      dataset = self.input_stats.tap(dataset, 'prefetch')
+      dataset = self.input_stats.attach(dataset)
     return dataset
 
 
@@ -272,7 +548,18 @@ class ImageNetInput(ImageNetTFExampleInput):
                data_dir,
                image_size=224,
                num_parallel_calls=16,
-               cache=False):
+               cache=False,
+               input_stats=None,
+               resume_dir=None,
+               seed=0,
+               files_per_round=8,
+               index_dir=None,
+               lease_client=None,
+               shard_watcher=None,
+               exact_eval=False,
+               synthetic_data=False,
+               batch_augmentation=None,
+               data_format='channels_last'):
     """Create an input from TFRecord files.
 
     Args:
@@ -286,17 +573,54 @@ class ImageNetInput(ImageNetTFExampleInput):
       image_size: `int` for image size (both width and height).
       num_parallel_calls: concurrency level to use when reading data from disk.
       cache: if true, fill the dataset by repeating from its cache
+      input_stats: optional `input_stats.InputPipelineStats` used to
+          instrument the stages of the pipeline.
+      resume_dir: if set, read the training data in a deterministic order and
+          resume from the position saved with the latest checkpoint of this
+          model directory instead of starting a new pass. Disables `cache`.
+      seed: seed of the per-epoch file order of the resumable pipeline.
+      files_per_round: number of files the resumable pipeline interleaves
+          together. Resuming seeks each of them to its first unread record.
+      index_dir: optional directory of DALI index files, used to count the
+          records of each file without reading it.
+      lease_client: optional `work_leases.LeaseClient`. When set, training
+          files are leased on demand from the coordinator on rank 0 instead
+          of being statically sharded across hosts. Requires `cache=False`.
+      shard_watcher: optional `shard_watcher.ShardWatcher`. When set, the
+          training files are re-listed at every epoch boundary so that newly
+          arriving shards join the next epoch. Requires `cache=False`.
+      exact_eval: if true, evaluation splits the validation records exactly
+          across hosts and pads the last batch with label -1 instead of
+          dropping the remainder.
+      synthetic_data: if true, replay one random batch kept on the compute
+          device instead of reading `data_dir`.
+      batch_augmentation: None, 'host' or 'device'; where the per-batch
+          flip, dtype conversion and normalization run.
+      data_format: layout of the batches augmented on the host.
     """
     super(ImageNetInput, self).__init__(
         is_training=is_training,
         image_size=image_size,
         use_bfloat16=use_bfloat16,
-        transpose_input=transpose_input)
+        transpose_input=transpose_input,
+        input_stats=input_stats,
+        synthetic_data=synthetic_data,
+        batch_augmentation=batch_augmentation,
+        data_format=data_format)
     self.data_dir = data_dir
     if self.data_dir == 'null' or not self.data_dir:
       self.data_dir = None
     self.num_parallel_calls = num_parallel_calls
     self.cache = cache
+    self.resume_dir = resume_dir
+    self.seed = seed
+    self.files_per_round = files_per_round
+    self.index_dir = index_dir
+    self.input_state = None
+    self.lease_client = lease_client
+    self.shard_watcher = shard_watcher
+    self.exact_eval = exact_eval and bool(self.data_dir)
+    self._eval_record_counts = None
 
   def _get_null_input(self, data):
     """Returns a null image (all black pixels).
@@ -312,6 +636,20 @@ class ImageNetInput(ImageNetTFExampleInput):
     return tf.zeros([self.image_size, self.image_size, 3], tf.bfloat16
                     if self.use_bfloat16 else tf.float32)
 
+  def input_fn(self, params):
+    """See base class."""
+    if self.data_dir or self.synthetic_data:
+      return super(ImageNetInput, self).input_fn(params)
+
+    # A null pipeline yields the same zero batch, built once.
+    tf.logging.info('Undefined data_dir implies null input')
+    batch_size = params['batch_size']
+    images = tf.zeros([batch_size, self.image_size, self.image_size, 3],
+                      tf.bfloat16 if self.use_bfloat16 else tf.float32)
+    labels = tf.zeros([batch_size], tf.int32)
+    dataset = tf.data.Dataset.from_tensors((images, labels)).repeat()
+    return self._finish_batches(dataset, batch_size)
+
   def dataset_parser(self, value):
     """See base class."""
     if not self.data_dir:
@@ -328,34 +666,190 @@ class ImageNetInput(ImageNetTFExampleInput):
     file_pattern = os.path.join(
         self.data_dir, 'train-*' if self.is_training else 'validation-*')
 
-    # For multi-host training, we want each hosts to always process the same
-    # subset of files.  Each host only sees a subset of the entire dataset,
-    # allowing us to cache larger datasets in memory.
-    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=False)
-    dataset = dataset.shard(num_hosts, index)
+    if self.is_training and self.lease_client:
+      # Hosts that read faster lease more files, every file is still read
+      # once per epoch.
+      dataset = work_leases.make_leased_dataset(
+          self.lease_client, sorted(tf.gfile.Glob(file_pattern)),
+          cycle_length=self.num_parallel_calls)
+    elif self.is_training and self.shard_watcher:
+      # New shards are picked up at the epoch boundaries of this host.
+      dataset = tf.data.Dataset.from_generator(
+          functools.partial(self.shard_watcher.epoch_filenames, index,
+                            num_hosts, self.seed),
+          tf.string, tf.TensorShape([]))
+      dataset = dataset.apply(
+          tf.contrib.data.parallel_interleave(
+              lambda filename: tf.data.TFRecordDataset(
+                  filename, buffer_size=8 * 1024 * 1024),
+              cycle_length=self.num_parallel_calls, sloppy=True,
+              prefetch_input_elements=16))
+    else:
+      # For multi-host training, we want each hosts to always process the same
+      # subset of files.  Each host only sees a subset of the entire dataset,
+      # allowing us to cache larger datasets in memory.
+      dataset = tf.data.Dataset.list_files(file_pattern, shuffle=False)
+      dataset = dataset.shard(num_hosts, index)
+
+      if self.is_training and not self.cache:
+        dataset = dataset.repeat()
+
+      def fetch_dataset(filename):
+        buffer_size = 8 * 1024 * 1024  # 8 MiB per file
+        dataset = tf.data.TFRecordDataset(filename, buffer_size=buffer_size)
+        return dataset
+
+      # Read the data from disk in parallel
+      dataset = dataset.apply(
+          tf.contrib.data.parallel_interleave(
+              fetch_dataset, cycle_length=self.num_parallel_calls, sloppy=True, prefetch_input_elements=16))
+    if self.input_stats:
+      dataset = self.input_stats.tap(dataset, 'read')
 
-    if self.is_training and not self.cache:
-      dataset = dataset.repeat()
+    if self.cache:
+      dataset = dataset.cache().apply(
+          tf.contrib.data.shuffle_and_repeat(1024*16))
+    else:
+      dataset = dataset.shuffle(1024)
+    if self.input_stats:
+      dataset = self.input_stats.tap(dataset, 'shuffle')
+    return dataset
+
+  def make_resumable_dataset(self, index, num_hosts, batch_size):
+    """Makes a training dataset that resumes from the saved input position.
+
+    Every epoch reads the files of this host in a permutation seeded by
+    (seed, epoch), `files_per_round` files at a time. The records of a round
+    are interleaved in the order of `input_state.round_order`, so the order
+    only depends on the position. A restart skips straight to its round and
+    starts every file of it at its first unread record, at the byte offset
+    given by the record index, without reading the records before it.
+
+    Args:
+      index: current host index.
+      num_hosts: total number of hosts.
+      batch_size: records this host consumes per step, used to map steps to
+        records.
+
+    Returns:
+      A `tf.data.Dataset` of serialized TFExamples.
+    """
+    file_pattern = os.path.join(self.data_dir, 'train-*')
+    filenames = sorted(tf.gfile.Glob(file_pattern))[index::num_hosts]
+    state_dir = os.path.join(self.resume_dir, 'input_state')
+    record_counts = record_index.load_record_counts(
+        filenames,
+        index_dir=self.index_dir,
+        cache_file=os.path.join(state_dir, 'record_counts.host-%d.json' % index))
+    self.input_state = input_state.InputStateTracker(
+        state_dir, record_counts, index, num_hosts, self.seed,
+        self.files_per_round)
+
+    global_step = 0
+    checkpoint = tf.train.latest_checkpoint(self.resume_dir)
+    if checkpoint:
+      global_step = int(tf.train.load_variable(checkpoint, 'global_step'))
+    position = self.input_state.restore(global_step, batch_size)
+
+    seed = self.seed
+    files_per_round = self.files_per_round
+
+    def round_files(epoch, round_index):
+      return input_state.epoch_rounds(
+          len(filenames), seed, epoch, files_per_round)[round_index]
 
     def fetch_dataset(filename):
+      buffer_size = 8 * 1024 * 1024  # 8 MiB per file
+      return tf.data.TFRecordDataset(filename, buffer_size=buffer_size)
+
+    # The round the position is in, its files started at their first unread
+    # record.
+    files = round_files(position.epoch, position.round)
+    order = input_state.round_order([record_counts[i] for i in files], seed,
+                                    position.epoch, position.round)
+    starts = input_state.round_starts(order, position.offset, len(files))
+    datasets = []
+    for i, start in zip(files, starts):
+      if start:
+        offset = record_index.record_offset(filenames[i], int(start),
+                                            self.index_dir)
+        datasets.append(tf.data.Dataset.from_generator(
+            functools.partial(record_index.read_records, filenames[i], offset),
+            tf.string, tf.TensorShape([])))
+      else:
+        datasets.append(fetch_dataset(filenames[i]))
+    dataset = tf.contrib.data.choose_from_datasets(
+        datasets, tf.data.Dataset.from_tensor_slices(order[position.offset:]))
+
+    def rounds():
+      epoch, first_round = position.epoch, position.round + 1
+      while True:
+        num_rounds = len(input_state.epoch_rounds(
+            len(filenames), seed, epoch, files_per_round))
+        for round_index in range(first_round, num_rounds):
+          files = round_files(epoch, round_index)
+          order = input_state.round_order(
+              [record_counts[i] for i in files], seed, epoch, round_index)
+          # The last round may have fewer files; the padding is never chosen.
+          yield ([filenames[i] for i in files] +
+                 [filenames[files[0]]] * (files_per_round - len(files)), order)
+        epoch, first_round = epoch + 1, 0
+
+    def read_round(files, order):
+      return tf.contrib.data.choose_from_datasets(
+          [fetch_dataset(files[i]) for i in range(files_per_round)],
+          tf.data.Dataset.from_tensor_slices(order))
+
+    later_rounds = tf.data.Dataset.from_generator(
+        rounds, (tf.string, tf.int64),
+        (tf.TensorShape([files_per_round]), tf.TensorShape([None])))
+    dataset = dataset.concatenate(later_rounds.flat_map(read_round))
+    if self.input_stats:
+      dataset = self.input_stats.tap(dataset, 'read')
+    return dataset
+
+  def make_eval_shard_dataset(self, index, num_hosts):
+    """Makes the validation records of host `index`, split exactly.
+
+    The records of all validation files are split into contiguous ranges
+    whose sizes differ by at most one record.
+
+    Args:
+      index: current host index.
+      num_hosts: total number of hosts.
+
+    Returns:
+      A tuple of a `tf.data.Dataset` of serialized TFExamples and the number
+      of records in it.
+    """
+    filenames = sorted(tf.gfile.Glob(os.path.join(self.data_dir, 'validation-*')))
+    if self._eval_record_counts is None:
+      self._eval_record_counts = record_index.load_record_counts(
+          filenames, index_dir=self.index_dir)
+    segments = record_index.shard_records(self._eval_record_counts, index,
+                                          num_hosts)
+    tf.logging.info('Host %d evaluates %d records from %d files.', index,
+                    sum(take for _, _, take in segments), len(segments))
+
+    dataset = tf.data.Dataset.from_tensor_slices((
+        tf.constant([filenames[i] for i, _, _ in segments], tf.string),
+        tf.constant([skip for _, skip, _ in segments], tf.int64),
+        tf.constant([take for _, _, take in segments], tf.int64)))
+
+    def fetch_segment(filename, skip, take):
       buffer_size = 8 * 1024 * 1024  # 8 MiB per file
       dataset = tf.data.TFRecordDataset(filename, buffer_size=buffer_size)
-      return dataset
+      return dataset.skip(skip).take(take)
 
-    # Read the data from disk in parallel
     dataset = dataset.apply(
         tf.contrib.data.parallel_interleave(
-            fetch_dataset, cycle_length=self.num_parallel_calls, sloppy=True, prefetch_input_elements=16))
-
-    if self.cache:
-      dataset = dataset.cache().apply(
-          tf.contrib.data.shuffle_and_repeat(1024*16))
-    else:
-      dataset = dataset.shuffle(1024)
-    return dataset
+            fetch_segment, cycle_length=self.num_parallel_calls, sloppy=True))
+    return dataset, sum(take for _, _, take in segments)
 
   # for dali
   def train_data_fn(self, params):
+    if self.synthetic_data:
+      return self.synthetic_input_fn(params)
     data_dir = '/data'
     data_index_dir = '/data/index_files'
     if self.is_training:
@@ -0,0 +1,242 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Exports a checkpoint for CPU inference and checks it against the original.
+
+Every variant in --variants is built from the same checkpoint, run on the
+same random uint8 images and timed on CPU for every batch size:
+
+  float_input      the training model, normalizing its input with separate ops;
+  uint8_folded     the training model with the mean/stddev normalization
+                   folded into the stem conv (see `MnasNetModel._call_stem`);
+  optimized        the inference graph of `mnasnet_inference`: batch norms
+                   folded into the convs, squeeze and excitation as matmuls,
+                   no dropout, in the --data_format layout;
+  optimized_uint8  the same with the input normalization folded in too;
+  numpy            `mnasnet_numpy.NumpyMnasNet`, with --numpy_weights_file.
+
+The logits of every variant must agree with those of float_input within
+--tolerance. The report is logged as JSON, and --export_variant is exported
+to --export_dir as a SavedModel taking uint8 NHWC images.
+
+    python mnasnet_export.py --checkpoint_path=/models/mnasnet-a1 \
+        --export_dir=/export/mnasnet-a1-cpu
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_inference
+import mnasnet_models_v1 as mnasnet_models
+import mnasnet_numpy
+import mnasnet_utils
+from preprocessing import MEAN_RGB
+from preprocessing import STDDEV_RGB
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'checkpoint_path', default=None,
+    help='Checkpoint, or directory of checkpoints, to export.')
+
+flags.DEFINE_string(
+    'export_dir', default=None,
+    help='Where to write the SavedModel. If not set, only compare the models.')
+
+flags.DEFINE_string(
+    'model_name', default='mnasnet-a1', help='The model name to select.')
+
+flags.DEFINE_integer(
+    'num_label_classes', default=1000, help='Number of classes, at least 2')
+
+flags.DEFINE_integer('image_size', default=224, help='Input image size.')
+
+flags.DEFINE_bool(
+    'use_moving_average', default=True,
+    help='Export the moving averages of the weights when there are any.')
+
+flags.DEFINE_string(
+    'numpy_weights_file', default=None,
+    help=('Also pack the folded weights for mnasnet_numpy.NumpyMnasNet into'
+          ' this file, and check and time the NumPy engine as a variant.'))
+
+flags.DEFINE_list(
+    'variants',
+    default=['float_input', 'uint8_folded', 'optimized', 'optimized_uint8'],
+    help='Model variants to check and time.')
+
+flags.DEFINE_enum(
+    'export_variant', default='optimized_uint8',
+    enum_values=['float_input', 'uint8_folded', 'optimized', 'optimized_uint8'],
+    help='Model variant exported to --export_dir.')
+
+flags.DEFINE_enum(
+    'data_format', default='channels_last',
+    enum_values=['channels_last', 'channels_first'],
+    help=('Layout of the optimized variants. Depthwise convs only run in'
+          ' channels_last on CPU.'))
+
+flags.DEFINE_float(
+    'tolerance', default=1e-3,
+    help='Largest absolute difference allowed between the logits.')
+
+flags.DEFINE_list(
+    'batch_sizes', default=['1', '8', '32'],
+    help='Batch sizes timed on CPU.')
+
+flags.DEFINE_integer(
+    'num_iters', default=20, help='Timed runs per batch size.')
+
+flags.DEFINE_integer(
+    'num_threads', default=0,
+    help='Intra-op threads for the CPU timing; 0 lets TensorFlow decide.')
+
+
+def _normalized(images):
+  features = tf.cast(images, tf.float32)
+  features -= tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=features.dtype)
+  features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3], dtype=features.dtype)
+  return features
+
+
+def build_model(images, variant, weights=None):
+  """Returns the logits of the uint8 `images` for one variant."""
+  if variant in ('optimized', 'optimized_uint8'):
+    data_format = FLAGS.data_format
+    if variant == 'optimized_uint8':
+      return mnasnet_inference.build_inference_model(
+          images, weights, data_format, (MEAN_RGB, STDDEV_RGB))
+    return mnasnet_inference.build_inference_model(
+        _normalized(images), weights, data_format)
+
+  override_params = {
+      'data_format': 'channels_last',
+      'num_classes': FLAGS.num_label_classes,
+  }
+  if variant == 'uint8_folded':
+    override_params['input_normalization'] = (MEAN_RGB, STDDEV_RGB)
+    features = images
+  else:
+    features = _normalized(images)
+  logits, _ = mnasnet_models.build_mnasnet_model(
+      features, model_name=FLAGS.model_name, training=False,
+      override_params=override_params)
+  return logits
+
+
+def _session_config():
+  return tf.ConfigProto(
+      device_count={'GPU': 0},
+      intra_op_parallelism_threads=FLAGS.num_threads)
+
+
+def run_model(variant, test_images, weights=None, export_dir=None):
+  """Returns the logits of `test_images` and the CPU latency per batch size."""
+  with tf.Graph().as_default(), tf.Session(config=_session_config()) as sess:
+    images = tf.placeholder(
+        tf.uint8, [None, FLAGS.image_size, FLAGS.image_size, 3], name='images')
+    logits = build_model(images, variant, weights)
+    if tf.global_variables():
+      mnasnet_utils.restore_model(sess, FLAGS.checkpoint_path,
+                                  FLAGS.use_moving_average)
+    test_logits = sess.run(logits, {images: test_images})
+
+    latency_ms = {}
+    for batch_size in FLAGS.batch_sizes:
+      batch = np.resize(test_images, [int(batch_size)] +
+                        list(test_images.shape[1:]))
+      sess.run(logits, {images: batch})
+      start = time.time()
+      for _ in range(FLAGS.num_iters):
+        sess.run(logits, {images: batch})
+      latency_ms[batch_size] = 1e3 * (time.time() - start) / FLAGS.num_iters
+
+    if export_dir:
+      mnasnet_inference.save_classify_model(sess, images, logits, export_dir)
+      tf.logging.info('Exported %s to %s.', variant, export_dir)
+  return test_logits, latency_ms
+
+
+def run_numpy_engine(test_images):
+  """Like `run_model`, for the NumPy engine of --numpy_weights_file."""
+  engine = mnasnet_numpy.NumpyMnasNet(FLAGS.numpy_weights_file)
+  test_logits = engine.predict(test_images)
+  latency_ms = {}
+  for batch_size in FLAGS.batch_sizes:
+    batch = np.resize(test_images, [int(batch_size)] +
+                      list(test_images.shape[1:]))
+    start = time.time()
+    for _ in range(FLAGS.num_iters):
+      engine.predict(batch)
+    latency_ms[batch_size] = 1e3 * (time.time() - start) / FLAGS.num_iters
+  return test_logits, latency_ms
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  rng = np.random.RandomState(0)
+  test_images = rng.randint(
+      0, 256, size=[8, FLAGS.image_size, FLAGS.image_size, 3]).astype(np.uint8)
+
+  weights = None
+  if FLAGS.numpy_weights_file or any(
+      v.startswith('optimized') for v in FLAGS.variants + [
+          FLAGS.export_variant]):
+    weights = mnasnet_inference.load_inference_weights(
+        FLAGS.checkpoint_path, FLAGS.model_name,
+        {'num_classes': FLAGS.num_label_classes}, FLAGS.use_moving_average)
+
+  variants = ['float_input'] + [v for v in FLAGS.variants
+                                if v != 'float_input']
+  report = {}
+  if FLAGS.numpy_weights_file:
+    mnasnet_numpy.save_weights(weights, FLAGS.numpy_weights_file,
+                               FLAGS.model_name, MEAN_RGB, STDDEV_RGB)
+    variants.append('numpy')
+  for variant in variants:
+    if variant == 'numpy':
+      logits, latency_ms = run_numpy_engine(test_images)
+    else:
+      logits, latency_ms = run_model(variant, test_images, weights)
+    if variant == 'float_input':
+      reference_logits = logits
+    report[variant] = {
+        'max_abs_logits_diff': float(np.max(np.abs(logits - reference_logits))),
+        'top_1_agreement': float(np.mean(
+            np.argmax(logits, 1) == np.argmax(reference_logits, 1))),
+        'cpu_latency_ms': latency_ms,
+    }
+  tf.logging.info('%s', json.dumps(report, indent=2))
+  for variant in variants:
+    max_abs_diff = report[variant]['max_abs_logits_diff']
+    if max_abs_diff > FLAGS.tolerance:
+      raise ValueError('%s differs from float_input by %g, more than '
+                       '--tolerance=%g.' % (variant, max_abs_diff,
+                                            FLAGS.tolerance))
+
+  if FLAGS.export_dir:
+    run_model(FLAGS.export_variant, test_images, weights, FLAGS.export_dir)
+
+
+if __name__ == '__main__':
+  app.run(main)
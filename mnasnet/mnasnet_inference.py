@@ -0,0 +1,278 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Inference-only MnasNet graph built from folded weights.
+
+`load_inference_weights` restores a checkpoint into the training model and
+reads its weights back as numpy arrays, with every batch normalization folded
+into the kernel and a bias of the conv before it. `build_inference_model`
+builds a graph from these weights alone:
+
+  - conv + bias_add + relu, with no batch normalization;
+  - squeeze and excitation as two matmuls on the pooled [batch, channels]
+    vectors, instead of 1x1 convs on [batch, 1, 1, channels] tensors;
+  - no dropout and no identity ops;
+  - the weights as constants, in either layout; NHWC is the one to use on
+    CPU, where depthwise convs only run in NHWC.
+
+The weights are a plain nested dict of numpy arrays, see
+`load_inference_weights`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import mnasnet_model
+import mnasnet_models_v1 as mnasnet_models
+import mnasnet_utils
+
+
+def fold_batch_norm(kernel, gamma, beta, moving_mean, moving_variance,
+                    epsilon):
+  """Folds a batch normalization into the conv kernel before it.
+
+  Args:
+    kernel: [height, width, in, out] conv kernel, or [height, width, in,
+      multiplier] depthwise kernel.
+    gamma, beta, moving_mean, moving_variance: batch normalization weights of
+      the conv outputs.
+    epsilon: batch normalization epsilon.
+
+  Returns:
+    The (kernel, bias) of the conv followed by the batch normalization.
+  """
+  scale = gamma / np.sqrt(moving_variance + epsilon)
+  kernel = kernel * scale.reshape([1, 1] + list(kernel.shape[2:]))
+  bias = beta - moving_mean * scale
+  return kernel.astype(np.float32), bias.astype(np.float32)
+
+
+def _folded(sess, conv, conv_kernel, bn):
+  kernel, gamma, beta, mean, variance = sess.run(
+      [conv_kernel, bn.gamma, bn.beta, bn.moving_mean, bn.moving_variance])
+  kernel, bias = fold_batch_norm(kernel, gamma, beta, mean, variance,
+                                 bn.epsilon)
+  return {'kernel': kernel, 'bias': bias, 'strides': list(conv.strides)}
+
+
+def extract_inference_weights(model, sess):
+  """Reads the folded weights of a built `MnasNetModel` from `sess`."""
+  # pylint: disable=protected-access
+  weights = {
+      'stem': _folded(sess, model._conv_stem, model._conv_stem.kernel,
+                      model._bn0),
+      'head': _folded(sess, model._conv_head, model._conv_head.kernel,
+                      model._bn1),
+      'blocks': [],
+  }
+  fc_kernel, fc_bias = sess.run([model._fc.kernel, model._fc.bias])
+  weights['fc'] = {'kernel': fc_kernel, 'bias': fc_bias}
+
+  for block in model._blocks:
+    block_args = block.block_args()
+    expand = None
+    if block_args.expand_ratio != 1:
+      expand = _folded(sess, block._expand_conv, block._expand_conv.kernel,
+                       block._bn0)
+    se = None
+    if block.has_se:
+      reduce_kernel, reduce_bias, expand_kernel, expand_bias = sess.run([
+          block._se_reduce.kernel, block._se_reduce.bias,
+          block._se_expand.kernel, block._se_expand.bias])
+      se = {
+          # [1, 1, in, out] 1x1 kernels of pooled inputs are [in, out] matrices.
+          'reduce_kernel': reduce_kernel[0, 0],
+          'reduce_bias': reduce_bias,
+          'expand_kernel': expand_kernel[0, 0],
+          'expand_bias': expand_bias,
+      }
+    weights['blocks'].append({
+        'expand': expand,
+        'depthwise': _folded(sess, block._depthwise_conv,
+                             block._depthwise_conv.depthwise_kernel,
+                             block._bn1),
+        'se': se,
+        'project': _folded(sess, block._project_conv,
+                           block._project_conv.kernel, block._bn2),
+        'residual': bool(
+            block_args.id_skip and all(s == 1 for s in block_args.strides) and
+            block_args.input_filters == block_args.output_filters),
+    })
+  # pylint: enable=protected-access
+  return weights
+
+
+def load_inference_weights(checkpoint_path, model_name, override_params=None,
+                           use_moving_average=True):
+  """Restores a checkpoint and returns its folded weights.
+
+  Args:
+    checkpoint_path: a checkpoint, or a directory of checkpoints.
+    model_name: string, the model name of a pre-defined MnasNet.
+    override_params: A dictionary of params for overriding. Fields must exist
+      in mnasnet_model.GlobalParams.
+    use_moving_average: fold the moving averages of the weights when the
+      checkpoint has them.
+
+  Returns:
+    A dict with the folded 'stem', 'blocks', 'head' and 'fc' weights.
+  """
+  blocks_args, global_params = mnasnet_models.get_model_params(
+      model_name, override_params)
+  with tf.Graph().as_default(), tf.Session() as sess:
+    images = tf.zeros([1, 224, 224, 3])
+    if global_params.data_format == 'channels_first':
+      images = tf.transpose(images, [0, 3, 1, 2])
+    with tf.variable_scope(model_name):
+      model = mnasnet_model.MnasNetModel(blocks_args, global_params)
+      model(images, training=False)
+    mnasnet_utils.restore_model(sess, checkpoint_path, use_moving_average)
+    return extract_inference_weights(model, sess)
+
+
+class _Builder(object):
+  """Builds the layers of `build_inference_model` in one data format."""
+
+  def __init__(self, data_format):
+    self.nchw = data_format == 'channels_first'
+    self.data_format = 'NCHW' if self.nchw else 'NHWC'
+    self.spatial_dims = [2, 3] if self.nchw else [1, 2]
+
+  def _strides(self, strides):
+    return [1, 1] + strides if self.nchw else [1] + strides + [1]
+
+  def conv(self, x, layer, relu=True, input_mean=None):
+    outputs = tf.nn.conv2d(x, layer['kernel'],
+                           strides=self._strides(layer['strides']),
+                           padding='SAME', data_format=self.data_format)
+    if input_mean is not None:
+      # conv(x - mean, W) is conv(x, W) minus the conv of one image of the
+      # mean pixel, zero-padded like x.
+      mean_image = tf.ones_like(x[:1]) * tf.constant(
+          input_mean, shape=[1, 3, 1, 1] if self.nchw else [1, 1, 1, 3],
+          dtype=x.dtype)
+      outputs -= tf.nn.conv2d(mean_image, layer['kernel'],
+                              strides=self._strides(layer['strides']),
+                              padding='SAME', data_format=self.data_format)
+    outputs = tf.nn.bias_add(outputs, layer['bias'],
+                             data_format=self.data_format)
+    return tf.nn.relu(outputs) if relu else outputs
+
+  def depthwise_conv(self, x, layer):
+    outputs = tf.nn.depthwise_conv2d(x, layer['kernel'],
+                                     strides=self._strides(layer['strides']),
+                                     padding='SAME',
+                                     data_format=self.data_format)
+    outputs = tf.nn.bias_add(outputs, layer['bias'],
+                             data_format=self.data_format)
+    return tf.nn.relu(outputs)
+
+  def squeeze_excite(self, x, se):
+    pooled = tf.reduce_mean(x, self.spatial_dims)
+    gate = tf.nn.relu(tf.matmul(pooled, se['reduce_kernel']) +
+                      se['reduce_bias'])
+    gate = tf.sigmoid(tf.matmul(gate, se['expand_kernel']) + se['expand_bias'])
+    if self.nchw:
+      gate = gate[:, :, tf.newaxis, tf.newaxis]
+    else:
+      gate = gate[:, tf.newaxis, tf.newaxis, :]
+    return x * gate
+
+
+def build_inference_model(images, weights, data_format='channels_last',
+                          input_normalization=None):
+  """Builds the logits of `images` from folded inference weights.
+
+  Args:
+    images: [batch, height, width, 3] NHWC images; normalized floats, or raw
+      [0, 255] images if `input_normalization` is set.
+    weights: folded weights from `load_inference_weights`.
+    data_format: layout of the graph, `channels_last` or `channels_first`.
+    input_normalization: optional (mean_rgb, stddev_rgb) folded into the stem
+      as in `MnasNetModel._call_stem`.
+
+  Returns:
+    The logits tensor.
+  """
+  builder = _Builder(data_format)
+  x = tf.cast(images, tf.float32)
+  if builder.nchw:
+    x = tf.transpose(x, [0, 3, 1, 2])
+
+  stem = weights['stem']
+  input_mean = None
+  if input_normalization:
+    mean_rgb, stddev_rgb = input_normalization
+    kernel = stem['kernel'] / np.array(stddev_rgb, np.float32).reshape(
+        [1, 1, 3, 1])
+    stem = dict(stem, kernel=kernel.astype(np.float32))
+    # The mean term, as in `MnasNetModel._call_stem`.
+    input_mean = mean_rgb
+  x = builder.conv(x, stem, input_mean=input_mean)
+
+  for block in weights['blocks']:
+    inputs = x
+    if block['expand']:
+      x = builder.conv(x, block['expand'])
+    x = builder.depthwise_conv(x, block['depthwise'])
+    if block['se']:
+      x = builder.squeeze_excite(x, block['se'])
+    x = builder.conv(x, block['project'], relu=False)
+    if block['residual']:
+      x += inputs
+
+  x = builder.conv(x, weights['head'])
+  x = tf.reduce_mean(x, builder.spatial_dims)
+  return tf.add(tf.matmul(x, weights['fc']['kernel']), weights['fc']['bias'],
+                name='logits')
+
+
+def save_classify_model(sess, images, logits, export_dir):
+  """Saves the graph of `sess` with a 'classify' signature of `images`."""
+  predictions = {
+      'classes': tf.argmax(logits, axis=1),
+      'probabilities': tf.nn.softmax(logits, name='softmax_tensor'),
+  }
+  signature = tf.saved_model.signature_def_utils.predict_signature_def(
+      inputs={'images': images}, outputs=predictions)
+  builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+  builder.add_meta_graph_and_variables(
+      sess, [tf.saved_model.tag_constants.SERVING],
+      signature_def_map={
+          'classify': signature,
+          tf.saved_model.signature_constants
+          .DEFAULT_SERVING_SIGNATURE_DEF_KEY: signature,
+      })
+  builder.save()
+
+
+def export_saved_model(weights, export_dir, image_size,
+                       data_format='channels_last', input_normalization=None):
+  """Exports the inference model of `weights` as a SavedModel.
+
+  The signature takes NHWC images: normalized floats, or uint8 images if
+  `input_normalization` is set, which is then folded into the stem.
+  """
+  with tf.Graph().as_default(), tf.Session() as sess:
+    images = tf.placeholder(
+        tf.uint8 if input_normalization else tf.float32,
+        [None, image_size, image_size, 3], name='images')
+    logits = build_inference_model(images, weights, data_format,
+                                   input_normalization)
+    save_classify_model(sess, images, logits, export_dir)
+  tf.logging.info('Exported the optimized inference model to %s.', export_dir)
@@ -38,6 +38,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import tempfile
 import time
 from absl import app
 from absl import flags
@@ -45,8 +46,15 @@ import numpy as np
 import tensorflow as tf
 
 import imagenet_input
+import mnasnet_inference
 import mnasnet_models_v2 as mnasnet_models
 import mnasnet_utils
+import preprocessing
+from utils import exact_eval
+from utils import input_state
+from utils import input_stats
+from utils import shard_watcher
+from utils import work_leases
 from tensorflow.contrib.tpu.python.tpu import async_checkpoint
 from tensorflow.contrib.training.python.training import evaluation
 from tensorflow.core.protobuf import rewriter_config_pb2
@@ -270,6 +278,45 @@ flags.DEFINE_bool(
     help=('Replace variables with corresponding moving average variables in '
           'saved model export.'))
 
+flags.DEFINE_integer(
+    'serving_preprocessing_parallelism',
+    default=64,
+    help=('Number of images of a serving request decoded and resized in'
+          ' parallel.'))
+
+flags.DEFINE_bool(
+    'export_uint8_input',
+    default=False,
+    help=('Export a signature taking decoded, resized uint8 NHWC images, with'
+          ' their normalization folded into the stem convolution.'))
+
+flags.DEFINE_list(
+    'warmup_batch_sizes',
+    default=['1', '2', '4', '8', '16', '32'],
+    help=('Batch sizes of the warm-up requests written with the SavedModel,'
+          ' assets.extra/tf_serving_warmup_requests, from validation images of'
+          ' --data_dir. mnasnet_serve.py, mnasnet_predict.py and TensorFlow'
+          ' Serving replay them before serving. Empty to write none.'))
+
+flags.DEFINE_bool(
+    'optimize_for_inference',
+    default=False,
+    help=('Also export an NHWC inference graph with the batch norms folded'
+          ' into the convs, squeeze and excitation as matmuls and no dropout,'
+          ' see mnasnet_inference.py. Check it with mnasnet_export.py.'))
+
+flags.DEFINE_bool(
+    'full_integer_quantization',
+    default=False,
+    help=('Also export <model_name>_int8.tflite, with int8 weights,'
+          ' activations, input and output, calibrated on validation images of'
+          ' --data_dir. Compare it with benchmark_tflite.py.'))
+
+flags.DEFINE_integer(
+    'calibration_images',
+    default=500,
+    help='Number of validation images used to calibrate the int8 model.')
+
 flags.DEFINE_string(
     'init_checkpoint',
     default=None,
@@ -298,6 +345,23 @@ flags.DEFINE_float(
     default=0.1,
     help=('Label smoothing parameter used in the softmax_cross_entropy'))
 
+flags.DEFINE_list(
+    'early_exits',
+    default=[],
+    help=('Reduction endpoints, e.g. 3,4, to attach early-exit classifiers'
+          ' to. See benchmark_early_exit.py.'))
+
+flags.DEFINE_float(
+    'early_exit_loss_weight',
+    default=0.3,
+    help=('Weight of the mean cross entropy of the early exits in the loss.'))
+
+flags.DEFINE_bool(
+    'early_exit_freeze_backbone',
+    default=False,
+    help=('Only train the early exits, on a backbone restored with'
+          ' --init_checkpoint and run in inference mode.'))
+
 flags.DEFINE_float(
     'dropout_rate',
     default=0.2,
@@ -310,6 +374,18 @@ flags.DEFINE_integer(
 flags.DEFINE_bool(
     'use_cache', default=True, help=('Enable cache for training input.'))
 
+flags.DEFINE_bool(
+    'synthetic_data', default=False,
+    help=('Train on one random batch generated once and kept on the compute'
+          ' device, instead of reading --data_dir. Measures the compute and'
+          ' communication throughput ceiling.'))
+
+flags.DEFINE_enum(
+    'batch_augmentation', None, ['host', 'device'],
+    help=('Flip, convert and normalize whole batches of uint8 images instead'
+          ' of single images, either in the input pipeline (host) or on the'
+          ' compute device (device). Applies to the TFRecord input.'))
+
 flags.DEFINE_float(
     'depth_multiplier', default=None, help=('Depth multiplier per layer.'))
 
@@ -347,9 +423,69 @@ flags.DEFINE_bool(
     default=False,
     help=('Whether to eval on single gpu. If false, evaluation is performed on all available gpus'))
 
+flags.DEFINE_bool(
+    'exact_eval',
+    default=False,
+    help=('Split the validation records exactly across all ranks, pad the last'
+          ' batch instead of dropping it, and combine the metrics of all ranks'
+          ' with one allreduce. Every validation image is counted once.'
+          ' Overrides --eval_on_single_gpu.'))
+
 flags.DEFINE_integer(
     'warmup_epochs', 5, 'The number of warmup epochs to ramp up lr')
 
+flags.DEFINE_bool(
+    'resumable_input',
+    default=False,
+    help=('Read the training data in a deterministic, seeded order and save'
+          ' the input position with every checkpoint, so that a restarted job'
+          ' continues the interrupted epoch instead of starting a new pass.'
+          ' Disables --use_cache for training.'))
+
+flags.DEFINE_integer(
+    'input_seed', default=0,
+    help=('Seed of the per-epoch file order of the resumable input.'))
+
+flags.DEFINE_integer(
+    'input_files_per_round', default=8,
+    help=('Number of files the resumable input interleaves and shuffles'
+          ' together. A restart re-reads at most one round of records.'))
+
+flags.DEFINE_bool(
+    'continuous_input',
+    default=False,
+    help=('Keep watching --data_dir (or --train_manifest) for new training'
+          ' shards and add them to the tf.data training input at epoch'
+          ' boundaries. Steps per epoch follow the number of records found'
+          ' instead of --num_train_images. Disables --use_cache for training.'))
+
+flags.DEFINE_string(
+    'train_manifest',
+    default=None,
+    help=('Append-only file listing one training shard per line, relative to'
+          ' --data_dir. With --continuous_input, new shards are taken from it'
+          ' instead of listing --data_dir.'))
+
+flags.DEFINE_bool(
+    'dynamic_file_assignment',
+    default=False,
+    help=('Lease training files to ranks on demand from a coordinator on rank'
+          ' 0 instead of statically sharding them, so that slower ranks read'
+          ' fewer files. Every file is still read once per epoch. Requires'
+          ' --use_horovod and disables --use_cache for training.'))
+
+flags.DEFINE_string(
+    'input_stats_dir',
+    default=None,
+    help=('If set, instrument the training input pipeline and write per-stage'
+          ' latency, throughput and buffer occupancy per rank as JSON lines'
+          ' to this directory.'))
+
+flags.DEFINE_integer(
+    'input_stats_every_secs',
+    default=60,
+    help=('Interval in seconds between two input pipeline stats summaries.'))
+
 flags.DEFINE_bool(
     'use_larc',
     default=False,
@@ -383,6 +519,10 @@ def get_pretrained_variables_to_restore(checkpoint_path,
 
   Returns:
     Mapping of variables to restore.
+
+  Raises:
+    ValueError: a variable other than those of the early exits is not in the
+      checkpoint.
   """
   checkpoint_reader = tf.train.load_checkpoint(checkpoint_path)
   variable_shape_map = checkpoint_reader.get_variable_to_shape_map()
@@ -408,6 +548,14 @@ def get_pretrained_variables_to_restore(checkpoint_path,
             'Skip init [%s] from [%s] as it is not in the checkpoint',
             v.op.name, variable_name_ckpt)
         continue
+    elif variable_name_ckpt not in variable_shape_map:
+      if '/mnas_exit_' not in v.op.name:
+        raise ValueError('[%s] is not in the checkpoint %s.' %
+                         (v.op.name, checkpoint_path))
+      # The early exits added to a trained backbone start from scratch.
+      tf.logging.info('Skip init [%s] as it is not in the checkpoint',
+                      v.op.name)
+      continue
 
     variables_to_restore[variable_name_ckpt] = v
     tf.logging.info('Init variable [%s] from [%s] in ckpt', v.op.name,
@@ -492,25 +640,39 @@ def mnasnet_model_fn(features, labels, mode, params):
   if isinstance(features, dict):
     features = features['feature']
 
-  # In most cases, the default data format NCHW instead of NHWC should be
-  # used for a significant performance boost on GPU/TPU. NHWC should be used
-  # only if the network needs to be run on CPU since the pooling operations
-  # are only supported on NHWC.
-  if FLAGS.data_format == 'channels_first':
-    assert not FLAGS.transpose_input    # channels_first only for GPU
-    features = tf.transpose(features, [0, 3, 1, 2])
-
-  if FLAGS.transpose_input and mode != tf.estimator.ModeKeys.PREDICT:
-    features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
-
-  # Normalize the image to zero mean and unit variance.
-  if FLAGS.data_format == 'channels_last':
-    features -= tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=features.dtype)
-    features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3], dtype=features.dtype)
+  input_normalization = None
+  batch_augmentation = params.get('batch_augmentation')
+  if batch_augmentation and mode != tf.estimator.ModeKeys.PREDICT:
+    if FLAGS.transpose_input:
+      features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
+    if batch_augmentation == 'device':
+      # Flip, convert, normalize and transpose the uint8 batch on the device.
+      features = preprocessing.augment_batch(
+          features, is_training, params['use_bfloat16'], FLAGS.data_format,
+          MEAN_RGB, STDDEV_RGB)
   else:
-    features -= tf.constant(MEAN_RGB, shape=[3, 1, 1], dtype=features.dtype)
-    features /= tf.constant(STDDEV_RGB, shape=[3, 1, 1], dtype=features.dtype)
-  
+    # In most cases, the default data format NCHW instead of NHWC should be
+    # used for a significant performance boost on GPU/TPU. NHWC should be used
+    # only if the network needs to be run on CPU since the pooling operations
+    # are only supported on NHWC.
+    if FLAGS.data_format == 'channels_first':
+      assert not FLAGS.transpose_input    # channels_first only for GPU
+      features = tf.transpose(features, [0, 3, 1, 2])
+
+    if FLAGS.transpose_input and mode != tf.estimator.ModeKeys.PREDICT:
+      features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
+
+    # Normalize the image to zero mean and unit variance. The stem conv
+    # normalizes the images of the uint8 serving signature itself.
+    if features.dtype == tf.uint8:
+      input_normalization = (MEAN_RGB, STDDEV_RGB)
+    elif FLAGS.data_format == 'channels_last':
+      features -= tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=features.dtype)
+      features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3], dtype=features.dtype)
+    else:
+      features -= tf.constant(MEAN_RGB, shape=[3, 1, 1], dtype=features.dtype)
+      features /= tf.constant(STDDEV_RGB, shape=[3, 1, 1], dtype=features.dtype)
+
   has_moving_average_decay = (FLAGS.moving_average_decay > 0)
 
   tf.logging.info('Using open-source implementation for MnasNet definition.')
@@ -532,20 +694,26 @@ def mnasnet_model_fn(features, labels, mode, params):
   if FLAGS.min_depth:
     override_params['min_depth'] = FLAGS.min_depth
   override_params['use_keras'] = FLAGS.use_keras
+  if input_normalization:
+    override_params['input_normalization'] = input_normalization
+  if FLAGS.early_exits:
+    override_params['early_exits'] = tuple(int(r) for r in FLAGS.early_exits)
 
+  # A frozen backbone keeps its batch normalization statistics.
+  backbone_training = is_training and not FLAGS.early_exit_freeze_backbone
   if params['use_bfloat16']:
     with tf.contrib.tpu.bfloat16_scope():
-      logits, _ = mnasnet_models.build_mnasnet_model(
+      logits, endpoints = mnasnet_models.build_mnasnet_model(
           features,
           model_name=FLAGS.model_name,
-          training=is_training,
+          training=backbone_training,
           override_params=override_params)
     logits = tf.cast(logits, tf.float32)
   else:
-    logits, _ = mnasnet_models.build_mnasnet_model(
+    logits, endpoints = mnasnet_models.build_mnasnet_model(
         features,
         model_name=FLAGS.model_name,
-        training=is_training,
+        training=backbone_training,
         override_params=override_params)
 
   if params['quantized_training']:
@@ -592,9 +760,14 @@ def mnasnet_model_fn(features, labels, mode, params):
 
   # Calculate loss, which includes softmax cross entropy and L2 regularization.
   one_hot_labels = tf.one_hot(labels, FLAGS.num_label_classes)
+  loss_weights = 1.0
+  if mode == tf.estimator.ModeKeys.EVAL and params.get('exact_eval'):
+    # Padding examples of the last eval batch have label -1.
+    loss_weights = tf.cast(tf.greater_equal(labels, 0), tf.float32)
   cross_entropy = tf.losses.softmax_cross_entropy(
       logits=logits,
       onehot_labels=one_hot_labels,
+      weights=loss_weights,
       label_smoothing=FLAGS.label_smoothing)
 
   # Add weight decay to the loss for non-batch-normalization variables.
@@ -604,6 +777,10 @@ def mnasnet_model_fn(features, labels, mode, params):
       if 'batch_normalization' not in v.name
   ])
 
+  if FLAGS.early_exits:
+    loss += FLAGS.early_exit_loss_weight * mnasnet_utils.early_exit_loss(
+        endpoints, one_hot_labels, loss_weights, FLAGS.label_smoothing)
+
   global_step = tf.train.get_global_step()
   if has_moving_average_decay:
     ema = tf.train.ExponentialMovingAverage(
@@ -618,8 +795,14 @@ def mnasnet_model_fn(features, labels, mode, params):
   host_call = None
   if is_training:
     # Compute the current epoch and associated learning rate from global_step.
+    steps_per_epoch = params['steps_per_epoch']
     current_epoch = (
-        tf.cast(global_step, tf.float32) / params['steps_per_epoch'])
+        tf.cast(global_step, tf.float32) / steps_per_epoch)
+    if params.get('continuous_input'):
+      # Updated by StepsPerEpochHook as new training shards arrive; the
+      # learning rate schedule keeps the initial epoch length.
+      current_epoch = tf.cast(global_step, tf.float32) / (
+          shard_watcher.steps_per_epoch_variable(steps_per_epoch))
 
     # Mnas optimize - fix lr based on horovod here!!!!!
     if FLAGS.use_horovod:
@@ -627,7 +810,7 @@ def mnasnet_model_fn(features, labels, mode, params):
     else:
         scaled_lr = FLAGS.base_learning_rate * (FLAGS.train_batch_size / 256.0)
     learning_rate = mnasnet_utils.build_learning_rate(scaled_lr, global_step,
-                                                      params['steps_per_epoch'], warmup_epochs=FLAGS.warmup_epochs)
+                                                      steps_per_epoch, warmup_epochs=FLAGS.warmup_epochs)
    
     if FLAGS.use_horovod:
       # Mnas optimize - note: the learning rate multiplier may not be necessary because of the
@@ -644,11 +827,15 @@ def mnasnet_model_fn(features, labels, mode, params):
       # user, this should look like regular synchronous training.
       optimizer = tf.contrib.tpu.CrossShardOptimizer(optimizer)
 
+    var_list = None
+    if FLAGS.early_exit_freeze_backbone:
+      var_list = mnasnet_utils.early_exit_variables()
+
     # Batch normalization requires UPDATE_OPS to be added as a dependency to
     # the train operation.
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     with tf.control_dependencies(update_ops):
-      train_op = optimizer.minimize(loss, global_step)
+      train_op = optimizer.minimize(loss, global_step, var_list=var_list)
 
     if has_moving_average_decay:
       with tf.control_dependencies([train_op]):
@@ -742,7 +929,8 @@ def mnasnet_model_fn(features, labels, mode, params):
           'top_5_accuracy': top_5_accuracy,
       }
 
-    eval_metrics = (metric_fn, [labels, logits])
+    eval_metrics = (exact_eval.metric_fn if params.get('exact_eval')
+                    else metric_fn, [labels, logits])
 
   num_params = np.sum([np.prod(v.shape) for v in tf.trainable_variables()])
   tf.logging.info('number of trainable parameters: {}'.format(num_params))
@@ -844,23 +1032,51 @@ def export(est, export_dir, post_quantize=True):
     post_quantize: boolean, whether to quantize model checkpoint after training.
 
   Raises:
-    ValueError: the export directory path is not specified.
+    ValueError: the export directory path is not specified, or
+      --full_integer_quantization is set without --data_dir.
   """
   if not export_dir:
     raise ValueError('The export directory path is not specified.')
+  if FLAGS.full_integer_quantization and not FLAGS.data_dir:
+    # Calibrating on the null images of the fake input would quantize every
+    # activation range to zero.
+    raise ValueError('--full_integer_quantization requires --data_dir.')
   # The guide to serve a exported TensorFlow model is at:
   #    https://www.tensorflow.org/serving/serving_basic
-  image_serving_input_fn = imagenet_input.build_image_serving_input_fn(
-      FLAGS.input_image_size)
+  if FLAGS.export_uint8_input:
+    image_serving_input_fn = imagenet_input.build_uint8_serving_input_fn(
+        FLAGS.input_image_size)
+    input_arrays = ['images']
+  else:
+    image_serving_input_fn = imagenet_input.build_image_serving_input_fn(
+        FLAGS.input_image_size,
+        parallel_iterations=FLAGS.serving_preprocessing_parallelism)
+    input_arrays = ['truediv']
+
+  assets_extra = None
+  if FLAGS.warmup_batch_sizes:
+    # Copied into the SavedModel before it is renamed into place, so a
+    # server loading the new version never misses its warm-up requests.
+    warmup_dir = tempfile.mkdtemp()
+    warmup_file = os.path.join(warmup_dir, 'tf_serving_warmup_requests')
+    imagenet_input.write_warmup_requests(
+        warmup_file, FLAGS.data_dir, FLAGS.input_image_size,
+        [int(b) for b in FLAGS.warmup_batch_sizes],
+        uint8_input=FLAGS.export_uint8_input,
+        parallel_iterations=FLAGS.serving_preprocessing_parallelism)
+    assets_extra = {'tf_serving_warmup_requests': warmup_file}
 
   tf.logging.info('Starting to export model.')
   subfolder = est.export_saved_model(
       export_dir_base=export_dir,
-      serving_input_receiver_fn=image_serving_input_fn)
+      serving_input_receiver_fn=image_serving_input_fn,
+      assets_extra=assets_extra)
+  if assets_extra:
+    tf.gfile.DeleteRecursively(warmup_dir)
 
   tf.logging.info('Starting to export TFLite.')
   converter = tf.lite.TFLiteConverter.from_saved_model(
-      subfolder, input_arrays=['truediv'], output_arrays=['logits'])
+      subfolder, input_arrays=input_arrays, output_arrays=['logits'])
   tflite_model = converter.convert()
   tflite_file = os.path.join(export_dir, FLAGS.model_name + '.tflite')
   tf.gfile.GFile(tflite_file, 'wb').write(tflite_model)
@@ -868,13 +1084,51 @@ def export(est, export_dir, post_quantize=True):
   if post_quantize:
     tf.logging.info('Starting to export quantized TFLite.')
     converter = tf.lite.TFLiteConverter.from_saved_model(
-        subfolder, input_arrays=['truediv'], output_arrays=['logits'])
+        subfolder, input_arrays=input_arrays, output_arrays=['logits'])
     converter.post_training_quantize = True
     quant_tflite_model = converter.convert()
     quant_tflite_file = os.path.join(export_dir,
                                      FLAGS.model_name + '_postquant.tflite')
     tf.gfile.GFile(quant_tflite_file, 'wb').write(quant_tflite_model)
 
+  if FLAGS.full_integer_quantization:
+    tf.logging.info('Starting to export full-integer TFLite.')
+    converter = tf.lite.TFLiteConverter.from_saved_model(
+        subfolder, input_arrays=input_arrays, output_arrays=['logits'])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(
+        imagenet_input.build_representative_dataset(
+            FLAGS.data_dir, FLAGS.input_image_size, FLAGS.calibration_images,
+            FLAGS.data_format, uint8_input=FLAGS.export_uint8_input))
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if not FLAGS.export_uint8_input:
+      # The images of the uint8 signature are integers already.
+      converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    int8_tflite_model = converter.convert()
+    int8_tflite_file = os.path.join(export_dir,
+                                    FLAGS.model_name + '_int8.tflite')
+    tf.gfile.GFile(int8_tflite_file, 'wb').write(int8_tflite_model)
+
+  if FLAGS.optimize_for_inference:
+    tf.logging.info('Starting to export the optimized inference model.')
+    override_params = {'num_classes': FLAGS.num_label_classes}
+    if FLAGS.depth_multiplier:
+      override_params['depth_multiplier'] = FLAGS.depth_multiplier
+    if FLAGS.depth_divisor:
+      override_params['depth_divisor'] = FLAGS.depth_divisor
+    if FLAGS.min_depth:
+      override_params['min_depth'] = FLAGS.min_depth
+    weights = mnasnet_inference.load_inference_weights(
+        est.latest_checkpoint(), FLAGS.model_name, override_params,
+        use_moving_average=FLAGS.export_moving_average)
+    mnasnet_inference.export_saved_model(
+        weights,
+        os.path.join(export_dir, 'optimized', str(int(time.time()))),
+        FLAGS.input_image_size,
+        input_normalization=((MEAN_RGB, STDDEV_RGB)
+                             if FLAGS.export_uint8_input else None))
+
 
 def main(unused_argv):
   # Mnas optimize - set the proper image data format
@@ -937,14 +1191,34 @@ def main(unused_argv):
         'Keras layers do not have full support to bfloat16 activation training.'
         ' You have set use_bfloat as %s and use_keras as %s' %
         (FLAGS.use_bfloat16, FLAGS.use_keras))
+  if FLAGS.full_integer_quantization and not FLAGS.data_dir:
+    raise ValueError('--full_integer_quantization requires --data_dir.')
 
   # Initializes model parameters.
-  steps_per_epoch = FLAGS.num_train_images / FLAGS.train_batch_size
+  watcher = None
+  num_train_images = FLAGS.num_train_images
+  if FLAGS.continuous_input:
+    if FLAGS.resumable_input:
+      raise ValueError('--continuous_input and --resumable_input are mutually '
+                       'exclusive.')
+    watcher = shard_watcher.ShardWatcher(
+        FLAGS.data_dir, manifest=FLAGS.train_manifest,
+        cache_file=os.path.join(FLAGS.model_dir, 'input_state',
+                                'record_counts.rank-%d.json' % mpi_rank))
+    watcher.refresh()
+    num_train_images = max(watcher.num_records, FLAGS.train_batch_size)
+  steps_per_epoch = num_train_images / FLAGS.train_batch_size
   steps_per_epoch = steps_per_epoch // mpi_size if FLAGS.use_horovod else steps_per_epoch
   params = dict(
       steps_per_epoch=steps_per_epoch,
       use_bfloat16=FLAGS.use_bfloat16,
+      batch_augmentation=(None if FLAGS.bigtable_instance
+                          else FLAGS.batch_augmentation),
       quantized_training=FLAGS.quantized_training)
+  if FLAGS.continuous_input:
+      params['continuous_input'] = True
+  if FLAGS.exact_eval:
+      params['exact_eval'] = True
   if FLAGS.use_horovod:
       params['hvd'] = True 
       params['hvd_curr_host'] = mpi_rank
@@ -966,6 +1240,45 @@ def main(unused_argv):
     bcast_hook = hvd.BroadcastGlobalVariablesHook(0)
 
 
+  train_hooks = []
+  pipeline_stats = None
+  if FLAGS.input_stats_dir:
+    pipeline_stats = input_stats.InputPipelineStats(
+        FLAGS.input_stats_dir,
+        rank=mpi_rank if FLAGS.use_horovod else 0,
+        batch_size=FLAGS.train_batch_size)
+    train_hooks.append(input_stats.InputStatsHook(
+        pipeline_stats, every_secs=FLAGS.input_stats_every_secs))
+  if FLAGS.resumable_input:
+    train_hooks.append(input_state.InputStateHook(
+        lambda: getattr(imagenet_train, 'input_state', None),
+        save_steps=max(100, FLAGS.iterations_per_loop)))
+  if watcher:
+    train_hooks.append(shard_watcher.StepsPerEpochHook(
+        watcher, FLAGS.train_batch_size * (mpi_size if FLAGS.use_horovod else 1),
+        broadcast=(lambda value: hvd.broadcast(value, 0)) if FLAGS.use_horovod else None,
+        sync_steps=max(100, FLAGS.iterations_per_loop)))
+
+  lease_client = None
+  if FLAGS.dynamic_file_assignment:
+    if not FLAGS.use_horovod:
+      raise ValueError('--dynamic_file_assignment requires --use_horovod.')
+    if FLAGS.resumable_input:
+      raise ValueError('--dynamic_file_assignment and --resumable_input are '
+                       'mutually exclusive.')
+    if FLAGS.continuous_input:
+      raise ValueError('--dynamic_file_assignment and --continuous_input are '
+                       'mutually exclusive.')
+    num_train_files = len(tf.gfile.Glob(os.path.join(FLAGS.data_dir, 'train-*')))
+    lease_client = work_leases.start(
+        comm, num_train_files, seed=FLAGS.input_seed,
+        state_dir=os.path.join(FLAGS.model_dir, 'input_state'),
+        restore_step=estimator._load_global_step_from_checkpoint_dir(FLAGS.model_dir))  # pylint: disable=protected-access
+    # Only the coordinator on rank 0 has lease state to checkpoint.
+    train_hooks.append(input_state.InputStateHook(
+        lambda: lease_client.coordinator,
+        save_steps=max(100, FLAGS.iterations_per_loop)))
+
   # Input pipelines are slightly different (with regards to shuffling and
   # preprocessing) between training and evaluation.
   if FLAGS.bigtable_instance:
@@ -988,10 +1301,23 @@ def main(unused_argv):
             is_training=is_training,
             data_dir=FLAGS.data_dir,
             transpose_input=FLAGS.transpose_input,
-            cache=FLAGS.use_cache and is_training,
+            cache=(FLAGS.use_cache and is_training and not FLAGS.resumable_input
+                   and not FLAGS.continuous_input
+                   and not FLAGS.dynamic_file_assignment),
             image_size=FLAGS.input_image_size,
             num_parallel_calls=FLAGS.num_parallel_calls,
-            use_bfloat16=FLAGS.use_bfloat16) for is_training in [True, False]
+            resume_dir=FLAGS.model_dir if FLAGS.resumable_input else None,
+            seed=FLAGS.input_seed,
+            files_per_round=FLAGS.input_files_per_round,
+            shard_watcher=watcher,
+            lease_client=lease_client,
+            exact_eval=FLAGS.exact_eval,
+            synthetic_data=FLAGS.synthetic_data and is_training,
+            batch_augmentation=FLAGS.batch_augmentation,
+            data_format=FLAGS.data_format,
+            use_bfloat16=FLAGS.use_bfloat16,
+            input_stats=pipeline_stats if is_training else None)
+        for is_training in [True, False]
     ]
 
   if FLAGS.mode == 'eval':
@@ -1002,10 +1328,14 @@ def main(unused_argv):
       tf.logging.info('Starting to evaluate.')
       try:
         start_timestamp = time.time()  # This time will include compilation time
-        eval_results = mnasnet_est.evaluate(
-            input_fn=imagenet_eval.input_fn,
-            steps=eval_steps,
-            checkpoint_path=ckpt)
+        if FLAGS.exact_eval:
+          eval_results = exact_eval.evaluate(
+              mnasnet_est, imagenet_eval.input_fn, checkpoint_path=ckpt)
+        else:
+          eval_results = mnasnet_est.evaluate(
+              input_fn=imagenet_eval.input_fn,
+              steps=eval_steps,
+              checkpoint_path=ckpt)
         elapsed_time = int(time.time() - start_timestamp)
         tf.logging.info('Eval results: %s. Elapsed seconds: %d', eval_results,
                         elapsed_time)
@@ -1039,7 +1369,7 @@ def main(unused_argv):
     start_timestamp = time.time()  # This time will include compilation time
 
     if FLAGS.mode == 'train':
-      hooks = []
+      hooks = list(train_hooks)
       if FLAGS.use_async_checkpointing:
         hooks.append(
             async_checkpoint.AsyncCheckpointSaverHook(
@@ -1062,10 +1392,12 @@ def main(unused_argv):
                               FLAGS.train_steps)
         if FLAGS.use_horovod:
           mnasnet_est.train(
-              input_fn=imagenet_train.input_fn, max_steps=next_checkpoint, hooks=[bcast_hook])
+              input_fn=imagenet_train.input_fn, max_steps=next_checkpoint,
+              hooks=[bcast_hook] + train_hooks)
         else:
           mnasnet_est.train(
-              input_fn=imagenet_train.input_fn, max_steps=next_checkpoint)
+              input_fn=imagenet_train.input_fn, max_steps=next_checkpoint,
+              hooks=train_hooks)
         current_step = next_checkpoint
 
         tf.logging.info('Finished training up to step %d. Elapsed seconds %d. Hvd rank %d',
@@ -1077,7 +1409,11 @@ def main(unused_argv):
         # consistent, the evaluated images are also consistent.
         eval_on_single_gpu = FLAGS.eval_on_single_gpu 
         tf.logging.info('Starting to evaluate.')
-        if eval_on_single_gpu:
+        if FLAGS.exact_eval:
+          eval_results = exact_eval.evaluate(mnasnet_est, imagenet_eval.input_fn)
+          tf.logging.info('Eval results at step %d: %s. Hvd rank %d', next_checkpoint,
+                          eval_results, curr_rank)
+        elif eval_on_single_gpu:
           if curr_rank == 0:
             eval_results = mnasnet_est.evaluate(
               input_fn=imagenet_eval.input_fn,
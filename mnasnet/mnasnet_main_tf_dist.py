@@ -35,6 +35,7 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import tempfile
 import time
 from absl import app
 from absl import flags
@@ -42,8 +43,11 @@ import numpy as np
 import tensorflow as tf
 
 import imagenet_input
+import mnasnet_inference
 import mnasnet_models
 import mnasnet_utils
+import preprocessing
+from utils import input_state
 from tensorflow.contrib.tpu.python.tpu import async_checkpoint
 from tensorflow.contrib.training.python.training import evaluation
 from tensorflow.core.protobuf import rewriter_config_pb2
@@ -232,6 +236,45 @@ flags.DEFINE_bool(
     help=('Replace variables with corresponding moving average variables in '
           'saved model export.'))
 
+flags.DEFINE_integer(
+    'serving_preprocessing_parallelism',
+    default=64,
+    help=('Number of images of a serving request decoded and resized in'
+          ' parallel.'))
+
+flags.DEFINE_bool(
+    'export_uint8_input',
+    default=False,
+    help=('Export a signature taking decoded, resized uint8 NHWC images, with'
+          ' their normalization folded into the stem convolution.'))
+
+flags.DEFINE_list(
+    'warmup_batch_sizes',
+    default=['1', '2', '4', '8', '16', '32'],
+    help=('Batch sizes of the warm-up requests written with the SavedModel,'
+          ' assets.extra/tf_serving_warmup_requests, from validation images of'
+          ' --data_dir. mnasnet_serve.py, mnasnet_predict.py and TensorFlow'
+          ' Serving replay them before serving. Empty to write none.'))
+
+flags.DEFINE_bool(
+    'optimize_for_inference',
+    default=False,
+    help=('Also export an NHWC inference graph with the batch norms folded'
+          ' into the convs, squeeze and excitation as matmuls and no dropout,'
+          ' see mnasnet_inference.py. Check it with mnasnet_export.py.'))
+
+flags.DEFINE_bool(
+    'full_integer_quantization',
+    default=False,
+    help=('Also export <model_name>_int8.tflite, with int8 weights,'
+          ' activations, input and output, calibrated on validation images of'
+          ' --data_dir. Compare it with benchmark_tflite.py.'))
+
+flags.DEFINE_integer(
+    'calibration_images',
+    default=500,
+    help='Number of validation images used to calibrate the int8 model.')
+
 flags.DEFINE_string(
     'init_checkpoint',
     default=None,
@@ -260,6 +303,23 @@ flags.DEFINE_float(
     default=0.1,
     help=('Label smoothing parameter used in the softmax_cross_entropy'))
 
+flags.DEFINE_list(
+    'early_exits',
+    default=[],
+    help=('Reduction endpoints, e.g. 3,4, to attach early-exit classifiers'
+          ' to. See benchmark_early_exit.py.'))
+
+flags.DEFINE_float(
+    'early_exit_loss_weight',
+    default=0.3,
+    help=('Weight of the mean cross entropy of the early exits in the loss.'))
+
+flags.DEFINE_bool(
+    'early_exit_freeze_backbone',
+    default=False,
+    help=('Only train the early exits, on a backbone restored with'
+          ' --init_checkpoint and run in inference mode.'))
+
 flags.DEFINE_float(
     'dropout_rate',
     default=0.2,
@@ -272,6 +332,18 @@ flags.DEFINE_integer(
 flags.DEFINE_bool(
     'use_cache', default=True, help=('Enable cache for training input.'))
 
+flags.DEFINE_bool(
+    'synthetic_data', default=False,
+    help=('Train on one random batch generated once and kept on the compute'
+          ' device, instead of reading --data_dir. Measures the compute and'
+          ' communication throughput ceiling.'))
+
+flags.DEFINE_enum(
+    'batch_augmentation', None, ['host', 'device'],
+    help=('Flip, convert and normalize whole batches of uint8 images instead'
+          ' of single images, either in the input pipeline (host) or on the'
+          ' compute device (device). Applies to the TFRecord input.'))
+
 flags.DEFINE_float(
     'depth_multiplier', default=None, help=('Depth multiplier per layer.'))
 
@@ -307,6 +379,23 @@ flags.DEFINE_bool(
 flags.DEFINE_integer(
     'warmup_epochs', 5, 'The number of warmup epochs to ramp up lr')
 
+flags.DEFINE_bool(
+    'resumable_input',
+    default=False,
+    help=('Read the training data in a deterministic, seeded order and save'
+          ' the input position with every checkpoint, so that a restarted job'
+          ' continues the interrupted epoch instead of starting a new pass.'
+          ' Disables --use_cache for training.'))
+
+flags.DEFINE_integer(
+    'input_seed', default=0,
+    help=('Seed of the per-epoch file order of the resumable input.'))
+
+flags.DEFINE_integer(
+    'input_files_per_round', default=8,
+    help=('Number of files the resumable input interleaves and shuffles'
+          ' together. A restart re-reads at most one round of records.'))
+
 flags.DEFINE_integer(
     'total_nodes', 1, 'The total number of nodes for TF dist using mirrored strategy')
 
@@ -341,6 +430,10 @@ def get_pretrained_variables_to_restore(checkpoint_path,
 
   Returns:
     Mapping of variables to restore.
+
+  Raises:
+    ValueError: a variable other than those of the early exits is not in the
+      checkpoint.
   """
   checkpoint_reader = tf.train.load_checkpoint(checkpoint_path)
   variable_shape_map = checkpoint_reader.get_variable_to_shape_map()
@@ -366,6 +459,14 @@ def get_pretrained_variables_to_restore(checkpoint_path,
             'Skip init [%s] from [%s] as it is not in the checkpoint',
             v.op.name, variable_name_ckpt)
         continue
+    elif variable_name_ckpt not in variable_shape_map:
+      if '/mnas_exit_' not in v.op.name:
+        raise ValueError('[%s] is not in the checkpoint %s.' %
+                         (v.op.name, checkpoint_path))
+      # The early exits added to a trained backbone start from scratch.
+      tf.logging.info('Skip init [%s] as it is not in the checkpoint',
+                      v.op.name)
+      continue
 
     variables_to_restore[variable_name_ckpt] = v
     tf.logging.info('Init variable [%s] from [%s] in ckpt', v.op.name,
@@ -396,25 +497,39 @@ def mnasnet_model_fn(features, labels, mode, params):
   if isinstance(features, dict):
     features = features['feature']
 
-  # In most cases, the default data format NCHW instead of NHWC should be
-  # used for a significant performance boost on GPU/TPU. NHWC should be used
-  # only if the network needs to be run on CPU since the pooling operations
-  # are only supported on NHWC.
-  if FLAGS.data_format == 'channels_first':
-    assert not FLAGS.transpose_input    # channels_first only for GPU
-    features = tf.transpose(features, [0, 3, 1, 2])
-
-  if FLAGS.transpose_input and mode != tf.estimator.ModeKeys.PREDICT:
-    features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
-
-  # Normalize the image to zero mean and unit variance.
-  if FLAGS.data_format == 'channels_last':
-    features -= tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=features.dtype)
-    features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3], dtype=features.dtype)
+  input_normalization = None
+  batch_augmentation = params.get('batch_augmentation')
+  if batch_augmentation and mode != tf.estimator.ModeKeys.PREDICT:
+    if FLAGS.transpose_input:
+      features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
+    if batch_augmentation == 'device':
+      # Flip, convert, normalize and transpose the uint8 batch on the device.
+      features = preprocessing.augment_batch(
+          features, is_training, params['use_bfloat16'], FLAGS.data_format,
+          MEAN_RGB, STDDEV_RGB)
   else:
-    features -= tf.constant(MEAN_RGB, shape=[3, 1, 1], dtype=features.dtype)
-    features /= tf.constant(STDDEV_RGB, shape=[3, 1, 1], dtype=features.dtype)
-  
+    # In most cases, the default data format NCHW instead of NHWC should be
+    # used for a significant performance boost on GPU/TPU. NHWC should be used
+    # only if the network needs to be run on CPU since the pooling operations
+    # are only supported on NHWC.
+    if FLAGS.data_format == 'channels_first':
+      assert not FLAGS.transpose_input    # channels_first only for GPU
+      features = tf.transpose(features, [0, 3, 1, 2])
+
+    if FLAGS.transpose_input and mode != tf.estimator.ModeKeys.PREDICT:
+      features = tf.transpose(features, [3, 0, 1, 2])  # HWCN to NHWC
+
+    # Normalize the image to zero mean and unit variance. The stem conv
+    # normalizes the images of the uint8 serving signature itself.
+    if features.dtype == tf.uint8:
+      input_normalization = (MEAN_RGB, STDDEV_RGB)
+    elif FLAGS.data_format == 'channels_last':
+      features -= tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=features.dtype)
+      features /= tf.constant(STDDEV_RGB, shape=[1, 1, 3], dtype=features.dtype)
+    else:
+      features -= tf.constant(MEAN_RGB, shape=[3, 1, 1], dtype=features.dtype)
+      features /= tf.constant(STDDEV_RGB, shape=[3, 1, 1], dtype=features.dtype)
+
   has_moving_average_decay = (FLAGS.moving_average_decay > 0)
 
   tf.logging.info('Using open-source implementation for MnasNet definition.')
@@ -436,20 +551,26 @@ def mnasnet_model_fn(features, labels, mode, params):
   if FLAGS.min_depth:
     override_params['min_depth'] = FLAGS.min_depth
   override_params['use_keras'] = FLAGS.use_keras
+  if input_normalization:
+    override_params['input_normalization'] = input_normalization
+  if FLAGS.early_exits:
+    override_params['early_exits'] = tuple(int(r) for r in FLAGS.early_exits)
 
+  # A frozen backbone keeps its batch normalization statistics.
+  backbone_training = is_training and not FLAGS.early_exit_freeze_backbone
   if params['use_bfloat16']:
     with tf.contrib.tpu.bfloat16_scope():
-      logits, _ = mnasnet_models.build_mnasnet_model(
+      logits, endpoints = mnasnet_models.build_mnasnet_model(
           features,
           model_name=FLAGS.model_name,
-          training=is_training,
+          training=backbone_training,
           override_params=override_params)
     logits = tf.cast(logits, tf.float32)
   else:
-    logits, _ = mnasnet_models.build_mnasnet_model(
+    logits, endpoints = mnasnet_models.build_mnasnet_model(
         features,
         model_name=FLAGS.model_name,
-        training=is_training,
+        training=backbone_training,
         override_params=override_params)
 
   if params['quantized_training']:
@@ -509,6 +630,10 @@ def mnasnet_model_fn(features, labels, mode, params):
       if 'batch_normalization' not in v.name
   ])
 
+  if FLAGS.early_exits:
+    loss += FLAGS.early_exit_loss_weight * mnasnet_utils.early_exit_loss(
+        endpoints, one_hot_labels, 1.0, FLAGS.label_smoothing)
+
   global_step = tf.train.get_global_step()
   if has_moving_average_decay:
     # ema = tf.train.ExponentialMovingAverage(
@@ -538,12 +663,17 @@ def mnasnet_model_fn(features, labels, mode, params):
       # user, this should look like regular synchronous training.
       optimizer = tf.contrib.tpu.CrossShardOptimizer(optimizer)
 
+    var_list = None
+    if FLAGS.early_exit_freeze_backbone:
+      var_list = mnasnet_utils.early_exit_variables()
+
     # Batch normalization requires UPDATE_OPS to be added as a dependency to
     # the train operation.
     update_ops = tf.get_collection(tf.GraphKeys.UPDATE_OPS)
     # with tf.control_dependencies(update_ops):
     #   train_op = optimizer.minimize(loss, global_step)
-    minimize_op = optimizer.minimize(loss=loss, global_step=global_step)
+    minimize_op = optimizer.minimize(loss=loss, global_step=global_step,
+                                     var_list=var_list)
     train_op = tf.group(minimize_op, update_ops)
 
     # if has_moving_average_decay:
@@ -714,23 +844,51 @@ def export(est, export_dir, post_quantize=True):
     post_quantize: boolean, whether to quantize model checkpoint after training.
 
   Raises:
-    ValueError: the export directory path is not specified.
+    ValueError: the export directory path is not specified, or
+      --full_integer_quantization is set without --data_dir.
   """
   if not export_dir:
     raise ValueError('The export directory path is not specified.')
+  if FLAGS.full_integer_quantization and not FLAGS.data_dir:
+    # Calibrating on the null images of the fake input would quantize every
+    # activation range to zero.
+    raise ValueError('--full_integer_quantization requires --data_dir.')
   # The guide to serve a exported TensorFlow model is at:
   #    https://www.tensorflow.org/serving/serving_basic
-  image_serving_input_fn = imagenet_input.build_image_serving_input_fn(
-      FLAGS.input_image_size)
+  if FLAGS.export_uint8_input:
+    image_serving_input_fn = imagenet_input.build_uint8_serving_input_fn(
+        FLAGS.input_image_size)
+    input_arrays = ['images']
+  else:
+    image_serving_input_fn = imagenet_input.build_image_serving_input_fn(
+        FLAGS.input_image_size,
+        parallel_iterations=FLAGS.serving_preprocessing_parallelism)
+    input_arrays = ['truediv']
+
+  assets_extra = None
+  if FLAGS.warmup_batch_sizes:
+    # Copied into the SavedModel before it is renamed into place, so a
+    # server loading the new version never misses its warm-up requests.
+    warmup_dir = tempfile.mkdtemp()
+    warmup_file = os.path.join(warmup_dir, 'tf_serving_warmup_requests')
+    imagenet_input.write_warmup_requests(
+        warmup_file, FLAGS.data_dir, FLAGS.input_image_size,
+        [int(b) for b in FLAGS.warmup_batch_sizes],
+        uint8_input=FLAGS.export_uint8_input,
+        parallel_iterations=FLAGS.serving_preprocessing_parallelism)
+    assets_extra = {'tf_serving_warmup_requests': warmup_file}
 
   tf.logging.info('Starting to export model.')
   subfolder = est.export_saved_model(
       export_dir_base=export_dir,
-      serving_input_receiver_fn=image_serving_input_fn)
+      serving_input_receiver_fn=image_serving_input_fn,
+      assets_extra=assets_extra)
+  if assets_extra:
+    tf.gfile.DeleteRecursively(warmup_dir)
 
   tf.logging.info('Starting to export TFLite.')
   converter = tf.lite.TFLiteConverter.from_saved_model(
-      subfolder, input_arrays=['truediv'], output_arrays=['logits'])
+      subfolder, input_arrays=input_arrays, output_arrays=['logits'])
   tflite_model = converter.convert()
   tflite_file = os.path.join(export_dir, FLAGS.model_name + '.tflite')
   tf.gfile.GFile(tflite_file, 'wb').write(tflite_model)
@@ -738,15 +896,55 @@ def export(est, export_dir, post_quantize=True):
   if post_quantize:
     tf.logging.info('Starting to export quantized TFLite.')
     converter = tf.lite.TFLiteConverter.from_saved_model(
-        subfolder, input_arrays=['truediv'], output_arrays=['logits'])
+        subfolder, input_arrays=input_arrays, output_arrays=['logits'])
     converter.post_training_quantize = True
     quant_tflite_model = converter.convert()
     quant_tflite_file = os.path.join(export_dir,
                                      FLAGS.model_name + '_postquant.tflite')
     tf.gfile.GFile(quant_tflite_file, 'wb').write(quant_tflite_model)
 
+  if FLAGS.full_integer_quantization:
+    tf.logging.info('Starting to export full-integer TFLite.')
+    converter = tf.lite.TFLiteConverter.from_saved_model(
+        subfolder, input_arrays=input_arrays, output_arrays=['logits'])
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = tf.lite.RepresentativeDataset(
+        imagenet_input.build_representative_dataset(
+            FLAGS.data_dir, FLAGS.input_image_size, FLAGS.calibration_images,
+            FLAGS.data_format, uint8_input=FLAGS.export_uint8_input))
+    converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if not FLAGS.export_uint8_input:
+      # The images of the uint8 signature are integers already.
+      converter.inference_input_type = tf.int8
+    converter.inference_output_type = tf.int8
+    int8_tflite_model = converter.convert()
+    int8_tflite_file = os.path.join(export_dir,
+                                    FLAGS.model_name + '_int8.tflite')
+    tf.gfile.GFile(int8_tflite_file, 'wb').write(int8_tflite_model)
+
+  if FLAGS.optimize_for_inference:
+    tf.logging.info('Starting to export the optimized inference model.')
+    override_params = {'num_classes': FLAGS.num_label_classes}
+    if FLAGS.depth_multiplier:
+      override_params['depth_multiplier'] = FLAGS.depth_multiplier
+    if FLAGS.depth_divisor:
+      override_params['depth_divisor'] = FLAGS.depth_divisor
+    if FLAGS.min_depth:
+      override_params['min_depth'] = FLAGS.min_depth
+    weights = mnasnet_inference.load_inference_weights(
+        est.latest_checkpoint(), FLAGS.model_name, override_params,
+        use_moving_average=FLAGS.export_moving_average)
+    mnasnet_inference.export_saved_model(
+        weights,
+        os.path.join(export_dir, 'optimized', str(int(time.time()))),
+        FLAGS.input_image_size,
+        input_normalization=((MEAN_RGB, STDDEV_RGB)
+                             if FLAGS.export_uint8_input else None))
+
 
 def main(unused_argv):
+  if FLAGS.full_integer_quantization and not FLAGS.data_dir:
+    raise ValueError('--full_integer_quantization requires --data_dir.')
   # Mnas optimize - set the proper image data format
   tf.keras.backend.set_image_data_format(FLAGS.data_format)
   # Mnas optimize - optimization flags
@@ -820,7 +1018,18 @@ def main(unused_argv):
       batch_size=FLAGS.train_batch_size,
       dtype = tf.float32,
       use_bfloat16=FLAGS.use_bfloat16,
-      quantized_training=FLAGS.quantized_training)
+      batch_augmentation=(None if FLAGS.bigtable_instance
+                          else FLAGS.batch_augmentation),
+      quantized_training=FLAGS.quantized_training,
+      # MirroredStrategy distributes the batches of a dataset to the replicas.
+      input_dataset=True)
+  if FLAGS.resumable_input:
+    # Each worker resumes its own subset of the files, and its input_fn
+    # batches are per replica: every step consumes one per local replica.
+    params['input_shard_index'] = FLAGS.node_num
+    params['input_num_shards'] = FLAGS.total_nodes
+    params['input_batches_per_step'] = max(
+        1, strategy.num_replicas_in_sync // FLAGS.total_nodes)
   
   mnasnet_est = tf.estimator.Estimator(
       model_fn=mnasnet_model_fn,
@@ -850,12 +1059,24 @@ def main(unused_argv):
             is_training=is_training,
             data_dir=FLAGS.data_dir,
             transpose_input=FLAGS.transpose_input,
-            cache=FLAGS.use_cache and is_training,
+            cache=FLAGS.use_cache and is_training and not FLAGS.resumable_input,
             image_size=FLAGS.input_image_size,
             num_parallel_calls=FLAGS.num_parallel_calls,
+            resume_dir=FLAGS.model_dir if FLAGS.resumable_input else None,
+            seed=FLAGS.input_seed,
+            files_per_round=FLAGS.input_files_per_round,
+            synthetic_data=FLAGS.synthetic_data and is_training,
+            batch_augmentation=FLAGS.batch_augmentation,
+            data_format=FLAGS.data_format,
             use_bfloat16=FLAGS.use_bfloat16) for is_training in [True, False]
     ]
 
+  train_hooks = []
+  if FLAGS.resumable_input:
+    train_hooks.append(input_state.InputStateHook(
+        lambda: getattr(imagenet_train, 'input_state', None),
+        save_steps=save_checkpoints_steps or max(100, FLAGS.iterations_per_loop)))
+
   if FLAGS.mode == 'eval':
     eval_steps = FLAGS.num_eval_images // FLAGS.eval_batch_size
     # Run evaluation when there's a new checkpoint
@@ -901,7 +1122,7 @@ def main(unused_argv):
     start_timestamp = time.time()  # This time will include compilation time
 
     if FLAGS.mode == 'train':
-      hooks = []
+      hooks = list(train_hooks)
       if FLAGS.use_async_checkpointing:
         hooks.append(
             async_checkpoint.AsyncCheckpointSaverHook(
@@ -914,7 +1135,8 @@ def main(unused_argv):
 
     else:
       assert FLAGS.mode == 'train_and_eval'
-      train_spec = tf.estimator.TrainSpec(input_fn=imagenet_train.input_fn, max_steps=FLAGS.train_steps)
+      train_spec = tf.estimator.TrainSpec(input_fn=imagenet_train.input_fn, max_steps=FLAGS.train_steps,
+                                          hooks=train_hooks)
       eval_spec = tf.estimator.EvalSpec(input_fn=imagenet_eval.input_fn, steps=FLAGS.num_eval_images // FLAGS.eval_batch_size, throttle_secs=600)
       tf.estimator.train_and_evaluate(mnasnet_est, train_spec, eval_spec)
       
@@ -53,7 +53,7 @@ import legacy_layers
 GlobalParams = collections.namedtuple('GlobalParams', [
     'batch_norm_momentum', 'batch_norm_epsilon', 'dropout_rate', 'data_format',
     'num_classes', 'depth_multiplier', 'depth_divisor', 'min_depth',
-    'stem_size', 'use_keras'
+    'stem_size', 'use_keras', 'input_normalization', 'early_exits'
 ])
 GlobalParams.__new__.__defaults__ = (None,) * len(GlobalParams._fields)
 
@@ -436,34 +436,113 @@ class MnasNetModel(tf.keras.Model):
     else:
       self._dropout = None
 
-  def call(self, inputs, training=True, features_only=None):
+    # Early-exit classifiers, pooled features of a reduction endpoint and a
+    # fully connected layer.
+    self._exit_heads = {}
+    for reduction_idx in self._global_params.early_exits or ():
+      dense_layer = (tf.keras.layers.Dense if self._global_params.use_keras
+                     else tf.layers.Dense)
+      self._exit_heads[reduction_idx] = (
+          tf.keras.layers.GlobalAveragePooling2D(
+              data_format=self._global_params.data_format),
+          dense_layer(self._global_params.num_classes,
+                      kernel_initializer=dense_kernel_initializer))
+
+  def _call_stem(self, inputs):
+    """Calls the stem conv, applying `input_normalization` if it is set.
+
+    With `input_normalization=(mean_rgb, stddev_rgb)`, the inputs are raw
+    [0, 255] images and (x - mean) / stddev is folded into the conv:
+    conv(x / stddev, W) is conv(x, W / stddev), and conv(mean / stddev, W)
+    only depends on the output position. It is the conv of one image of the
+    mean pixel, zero-padded like the inputs, so that the borders see the
+    padding of the normalized float inputs exactly.
+    """
+    if not self._global_params.input_normalization:
+      return self._conv_stem(inputs)
+    mean_rgb, stddev_rgb = self._global_params.input_normalization
+    if self._global_params.data_format == 'channels_first':
+      channel_shape = [1, 3, 1, 1]
+      strides = [1, 1, 2, 2]
+      data_format = 'NCHW'
+    else:
+      channel_shape = [1, 1, 1, 3]
+      strides = [1, 2, 2, 1]
+      data_format = 'NHWC'
+    if inputs.dtype.is_integer:
+      inputs = tf.cast(inputs, tf.float32)
+    # Calling the layer on a 1x1 image creates its kernel under the usual
+    # variable names; nothing depends on that call, so it never runs.
+    self._conv_stem(tf.zeros(channel_shape, dtype=inputs.dtype))
+    kernel = self._conv_stem.kernel * tf.constant(
+        [1. / s for s in stddev_rgb], shape=[1, 1, 3, 1], dtype=inputs.dtype)
+    mean_image = tf.ones_like(inputs[:1]) * tf.constant(
+        mean_rgb, shape=channel_shape, dtype=inputs.dtype)
+    outputs = tf.nn.conv2d(inputs, kernel, strides=strides, padding='SAME',
+                           data_format=data_format)
+    return outputs - tf.nn.conv2d(mean_image, kernel, strides=strides,
+                                  padding='SAME', data_format=data_format)
+
+  def _block_reductions(self):
+    """The reduction index of the blocks ending a reduction, None otherwise."""
+    reductions = []
+    reduction_idx = 0
+    for idx in range(len(self._blocks)):
+      if ((idx == len(self._blocks) - 1) or
+          self._blocks[idx + 1].block_args().strides[0] > 1):
+        reduction_idx += 1
+        reductions.append(reduction_idx)
+      else:
+        reductions.append(None)
+    return reductions
+
+  def _call_exit(self, reduction_idx, outputs):
+    """Returns the logits of the early exit at `reduction_idx`."""
+    pooling, fc = self._exit_heads[reduction_idx]
+    with tf.variable_scope('mnas_exit_%s' % reduction_idx):
+      return fc(pooling(outputs))
+
+  def _call_head(self, outputs, training):
+    with tf.variable_scope('mnas_head'):
+      outputs = tf.nn.relu(
+          self._bn1(self._conv_head(outputs), training=training))
+      outputs = self._avg_pooling(outputs)
+      if self._dropout:
+        outputs = self._dropout(outputs, training=training)
+      outputs = self._fc(outputs)
+      self.endpoints['head'] = outputs
+    return outputs
+
+  def call(self, inputs, training=True, features_only=None,
+           early_exit_threshold=None):
     """Implementation of MnasNetModel call().
 
     Args:
       inputs: input tensors.
       training: boolean, whether the model is constructed for training.
       features_only: build the base feature network only.
+      early_exit_threshold: for inference, run the early exits and skip the
+        remaining blocks of the images at least this confident, see
+        `_call_early_exit`.
 
     Returns:
-      output tensors.
+      output tensors, or (logits, exits) with `early_exit_threshold`.
     """
+    if early_exit_threshold is not None:
+      return self._call_early_exit(inputs, early_exit_threshold)
     outputs = None
     self.endpoints = {}
     # Calls Stem layers
     with tf.variable_scope('mnas_stem'):
       outputs = tf.nn.relu(
-          self._bn0(self._conv_stem(inputs), training=training))
+          self._bn0(self._call_stem(inputs), training=training))
     tf.logging.info('Built stem layers with output shape: %s' % outputs.shape)
     self.endpoints['stem'] = outputs
 
     # Calls blocks.
-    reduction_idx = 0
-    for idx, block in enumerate(self._blocks):
-      is_reduction = False
-      if ((idx == len(self._blocks) - 1) or
-          self._blocks[idx + 1].block_args().strides[0] > 1):
-        is_reduction = True
-        reduction_idx += 1
+    for idx, (block, reduction_idx) in enumerate(
+        zip(self._blocks, self._block_reductions())):
+      is_reduction = reduction_idx is not None
 
       with tf.variable_scope('mnas_blocks_%s' % idx):
         outputs = block.call(outputs, training=training)
@@ -475,16 +554,57 @@ class MnasNetModel(tf.keras.Model):
             self.endpoints['block_%s/%s' % (idx, k)] = v
             if is_reduction:
               self.endpoints['reduction_%s/%s' % (reduction_idx, k)] = v
+      if reduction_idx in self._exit_heads:
+        self.endpoints['exit_%s' % reduction_idx] = self._call_exit(
+            reduction_idx, outputs)
     self.endpoints['global_pool'] = outputs
 
     if not features_only:
       # Calls final layers and returns logits.
-      with tf.variable_scope('mnas_head'):
-        outputs = tf.nn.relu(
-            self._bn1(self._conv_head(outputs), training=training))
-        outputs = self._avg_pooling(outputs)
-        if self._dropout:
-          outputs = self._dropout(outputs, training=training)
-        outputs = self._fc(outputs)
-        self.endpoints['head'] = outputs
+      outputs = self._call_head(outputs, training)
     return outputs
+
+  def _call_early_exit(self, inputs, threshold):
+    """Inference with early exits, skipping the blocks confident images skip.
+
+    After every early exit, the images whose top softmax probability is at
+    least `threshold` take the logits of that exit, and only the others go on
+    through the next blocks, as a smaller batch. The logits of all images are
+    then stitched back in the order of `inputs`.
+
+    Args:
+      inputs: input tensors.
+      threshold: scalar confidence from which an image exits.
+
+    Returns:
+      (logits, exits): the logits of every image, and the reduction index of
+      the exit it took, 0 for the full network.
+    """
+    self.endpoints = {}
+    with tf.variable_scope('mnas_stem'):
+      outputs = tf.nn.relu(
+          self._bn0(self._call_stem(inputs), training=False))
+    # Positions in `inputs` of the images still running.
+    positions = tf.range(tf.shape(inputs)[0])
+    exited_positions, exited_logits, exits = [], [], []
+    for idx, (block, reduction_idx) in enumerate(
+        zip(self._blocks, self._block_reductions())):
+      with tf.variable_scope('mnas_blocks_%s' % idx):
+        outputs = block.call(outputs, training=False)
+      if reduction_idx not in self._exit_heads:
+        continue
+      logits = self._call_exit(reduction_idx, outputs)
+      self.endpoints['exit_%s' % reduction_idx] = logits
+      exiting = tf.reduce_max(tf.nn.softmax(logits), axis=1) >= threshold
+      remaining = tf.logical_not(exiting)
+      exited_positions.append(tf.boolean_mask(positions, exiting))
+      exited_logits.append(tf.boolean_mask(logits, exiting))
+      exits.append(tf.fill(tf.shape(exited_positions[-1]), reduction_idx))
+      outputs = tf.boolean_mask(outputs, remaining)
+      positions = tf.boolean_mask(positions, remaining)
+    self.endpoints['global_pool'] = outputs
+    exited_positions.append(positions)
+    exited_logits.append(self._call_head(outputs, training=False))
+    exits.append(tf.zeros_like(positions))
+    return (tf.dynamic_stitch(exited_positions, exited_logits),
+            tf.dynamic_stitch(exited_positions, exits))
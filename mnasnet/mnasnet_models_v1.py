@@ -334,6 +334,37 @@ def build_mnasnet_model(images, model_name, training, override_params=None):
   return logits, model.endpoints
 
 
+def build_mnasnet_early_exit_model(images, model_name, threshold,
+                                   override_params=None):
+  """A helper function to run a MnasNet model with early exits for inference.
+
+  Args:
+    images: input images tensor.
+    model_name: string, the model name of a pre-defined MnasNet.
+    threshold: scalar tensor, the confidence from which an image takes an
+      early exit.
+    override_params: A dictionary of params for overriding. Fields must exist in
+      mnasnet_model.GlobalParams, and `early_exits` must be set.
+
+  Returns:
+    logits: the logits tensor of classes.
+    exits: the reduction index of the exit of every image, 0 for none.
+  Raises:
+    When model_name specified an undefined model, raises NotImplementedError.
+    When override_params has invalid fields, raises ValueError.
+  """
+  assert isinstance(images, tf.Tensor)
+  blocks_args, global_params = get_model_params(model_name, override_params)
+  if not global_params.early_exits:
+    raise ValueError('early_exits is not set.')
+  with tf.variable_scope(model_name):
+    model = mnasnet_model.MnasNetModel(blocks_args, global_params)
+    logits, exits = model(images, training=False,
+                          early_exit_threshold=threshold)
+  logits = tf.identity(logits, 'logits')
+  return logits, tf.identity(exits, 'exits')
+
+
 def build_mnasnet_base(images, model_name, training, override_params=None):
   """A helper functiion to create a MnasNet base model and return global_pool.
 
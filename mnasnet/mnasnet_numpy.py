@@ -0,0 +1,246 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""MnasNet inference in NumPy, without TensorFlow.
+
+The folded weights of `mnasnet_inference.load_inference_weights` are packed
+into a single file by `save_weights`:
+
+    b'MNASNPY1', uint64 header length, JSON header, arrays
+
+The JSON header holds the block list and, for every array, its offset, shape
+and dtype; the arrays are float32 and 64-byte aligned. `NumpyMnasNet` maps
+the file read-only, so loading it takes milliseconds and the weights are
+shared by every process serving the same file.
+
+Only NumPy is imported here. Convs with a spatial kernel gather their patches
+with stride tricks (im2col) and run as one matmul, 1x1 convs are plain
+matmuls, and depthwise convs sum one strided slice per kernel tap.
+
+    model = mnasnet_numpy.NumpyMnasNet('mnasnet-a1.npw')
+    logits = model.predict(images)  # [batch, height, width, 3] in [0, 255].
+
+See mnasnet_export.py --numpy_weights_file to pack a checkpoint, and
+check_numpy_engine.py to compare the engine with TensorFlow.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import struct
+
+import numpy as np
+
+_MAGIC = b'MNASNPY1'
+_ALIGNMENT = 64
+
+
+def _flatten(value, arrays, path):
+  """Replaces the arrays of a nested weights structure with their names."""
+  if isinstance(value, np.ndarray):
+    arrays.append((path, np.ascontiguousarray(value, dtype=np.float32)))
+    return {'array': path}
+  if isinstance(value, dict):
+    return {k: _flatten(v, arrays, '%s/%s' % (path, k) if path else k)
+            for k, v in value.items()}
+  if isinstance(value, (list, tuple)):
+    return [_flatten(v, arrays, '%s/%d' % (path, i))
+            for i, v in enumerate(value)]
+  return value
+
+
+def save_weights(weights, path, model_name=None, mean_rgb=None,
+                 stddev_rgb=None):
+  """Packs folded inference weights into a single memory-mappable file.
+
+  Args:
+    weights: folded weights from `mnasnet_inference.load_inference_weights`.
+    path: the file to write.
+    model_name: recorded in the header.
+    mean_rgb, stddev_rgb: input normalization applied by `predict` to raw
+      images.
+  """
+  arrays = []
+  header = {
+      'model_name': model_name,
+      'mean_rgb': list(mean_rgb) if mean_rgb is not None else None,
+      'stddev_rgb': list(stddev_rgb) if stddev_rgb is not None else None,
+      'weights': _flatten(weights, arrays, ''),
+      'arrays': {},
+  }
+  offset = 0
+  for name, array in arrays:
+    header['arrays'][name] = {
+        'offset': offset, 'shape': list(array.shape), 'dtype': 'float32'}
+    offset += -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+
+  header_bytes = json.dumps(header, sort_keys=True).encode('utf-8')
+  data_start = len(_MAGIC) + 8 + len(header_bytes)
+  padding = -data_start % _ALIGNMENT
+  header_bytes += b' ' * padding
+  data_start += padding
+  with open(path, 'wb') as f:
+    f.write(_MAGIC)
+    f.write(struct.pack('<Q', len(header_bytes)))
+    f.write(header_bytes)
+    for name, array in arrays:
+      f.seek(data_start + header['arrays'][name]['offset'])
+      f.write(array.tobytes())
+    f.truncate(data_start + offset)
+
+
+def load_weights(path):
+  """Maps a file written by `save_weights`; returns (weights, header)."""
+  with open(path, 'rb') as f:
+    if f.read(len(_MAGIC)) != _MAGIC:
+      raise ValueError('%s is not a packed MnasNet weights file.' % path)
+    header_length, = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(header_length).decode('utf-8'))
+  data = np.memmap(path, dtype=np.uint8, mode='r',
+                   offset=len(_MAGIC) + 8 + header_length)
+
+  def unflatten(value):
+    if isinstance(value, dict):
+      if set(value) == {'array'}:
+        spec = header['arrays'][value['array']]
+        size = int(np.prod(spec['shape'])) * np.dtype(spec['dtype']).itemsize
+        return data[spec['offset']:spec['offset'] + size].view(
+            spec['dtype']).reshape(spec['shape'])
+      return {k: unflatten(v) for k, v in value.items()}
+    if isinstance(value, list):
+      return [unflatten(v) for v in value]
+    return value
+
+  return unflatten(header['weights']), header
+
+
+def _same_padding(size, kernel_size, stride):
+  """Output size and (before, after) padding of TF's 'SAME' padding."""
+  out_size = -(-size // stride)
+  total = max((out_size - 1) * stride + kernel_size - size, 0)
+  return out_size, (total // 2, total - total // 2)
+
+
+def _pad(x, kernel_shape, strides):
+  """Pads NHWC `x` for a 'SAME' conv; returns it and the output size."""
+  out_h, pad_h = _same_padding(x.shape[1], kernel_shape[0], strides[0])
+  out_w, pad_w = _same_padding(x.shape[2], kernel_shape[1], strides[1])
+  if any(pad_h + pad_w):
+    x = np.pad(x, [(0, 0), pad_h, pad_w, (0, 0)], mode='constant')
+  return x, out_h, out_w
+
+
+def conv2d(x, kernel, bias, strides):
+  """'SAME' conv of NHWC `x` with an HWIO kernel, plus bias."""
+  kernel_h, kernel_w, in_channels, out_channels = kernel.shape
+  if kernel_h == kernel_w == 1 and strides == [1, 1]:
+    outputs = x.reshape(-1, in_channels).dot(kernel.reshape(in_channels, -1))
+    return (outputs + bias).reshape(x.shape[:3] + (out_channels,))
+  x, out_h, out_w = _pad(x, kernel.shape, strides)
+  batch, _, _, channels = x.shape
+  s_b, s_h, s_w, s_c = x.strides
+  # [batch, out_h, out_w, kernel_h, kernel_w, channels] view of the patches.
+  patches = np.lib.stride_tricks.as_strided(
+      x, shape=(batch, out_h, out_w, kernel_h, kernel_w, channels),
+      strides=(s_b, s_h * strides[0], s_w * strides[1], s_h, s_w, s_c),
+      writeable=False)
+  patches = patches.reshape(batch * out_h * out_w, -1)
+  outputs = patches.dot(kernel.reshape(-1, out_channels)) + bias
+  return outputs.reshape(batch, out_h, out_w, out_channels)
+
+
+def depthwise_conv2d(x, kernel, bias, strides):
+  """'SAME' depthwise conv of NHWC `x` with an [h, w, c, 1] kernel."""
+  if kernel.shape[3] != 1:
+    raise ValueError('Only a depth multiplier of 1 is supported.')
+  kernel_h, kernel_w = kernel.shape[:2]
+  x, out_h, out_w = _pad(x, kernel.shape, strides)
+  stride_h, stride_w = strides
+  outputs = np.empty((x.shape[0], out_h, out_w, x.shape[3]), np.float32)
+  outputs[...] = bias
+  for i in range(kernel_h):
+    for j in range(kernel_w):
+      outputs += x[:, i:i + stride_h * out_h:stride_h,
+                   j:j + stride_w * out_w:stride_w, :] * kernel[i, j, :, 0]
+  return outputs
+
+
+def _relu(x):
+  return np.maximum(x, 0, out=x)
+
+
+def _sigmoid(x):
+  return 1. / (1. + np.exp(-x))
+
+
+class NumpyMnasNet(object):
+  """Runs a MnasNet from a file written by `save_weights`.
+
+  Args:
+    path: the packed weights file.
+  """
+
+  def __init__(self, path):
+    self.weights, self.header = load_weights(path)
+    self.model_name = self.header['model_name']
+    self._mean_rgb = self.header['mean_rgb']
+    self._stddev_rgb = self.header['stddev_rgb']
+
+  def _conv(self, x, layer, relu=True):
+    outputs = conv2d(x, layer['kernel'], layer['bias'], layer['strides'])
+    return _relu(outputs) if relu else outputs
+
+  def _block(self, x, block):
+    inputs = x
+    if block['expand']:
+      x = self._conv(x, block['expand'])
+    depthwise = block['depthwise']
+    x = _relu(depthwise_conv2d(x, depthwise['kernel'], depthwise['bias'],
+                               depthwise['strides']))
+    se = block['se']
+    if se:
+      gate = _relu(x.mean(axis=(1, 2)).dot(se['reduce_kernel']) +
+                   se['reduce_bias'])
+      gate = _sigmoid(gate.dot(se['expand_kernel']) + se['expand_bias'])
+      x *= gate[:, np.newaxis, np.newaxis, :]
+    x = self._conv(x, block['project'], relu=False)
+    if block['residual']:
+      x += inputs
+    return x
+
+  def predict(self, images, normalized=False):
+    """Returns the logits of a batch of images.
+
+    Args:
+      images: [batch, height, width, 3] NHWC images, uint8 or float in
+        [0, 255], or already normalized if `normalized`.
+      normalized: whether the images are already normalized.
+
+    Returns:
+      [batch, num_classes] float32 logits.
+    """
+    x = np.asarray(images, dtype=np.float32)
+    if not normalized:
+      if self._mean_rgb is None:
+        raise ValueError('The weights file has no input normalization.')
+      x = (x - np.float32(self._mean_rgb)) / np.float32(self._stddev_rgb)
+    x = self._conv(x, self.weights['stem'])
+    for block in self.weights['blocks']:
+      x = self._block(x, block)
+    x = self._conv(x, self.weights['head'])
+    x = x.mean(axis=(1, 2))
+    fc = self.weights['fc']
+    return x.dot(fc['kernel']) + fc['bias']
@@ -0,0 +1,518 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Bulk offline inference over JPEG directories, file lists or TFRecord shards.
+
+Images are read and decoded in parallel by tf.data, batched as uint8 and
+normalized per batch on the device. Each batch is split across all local GPUs
+(or run on the CPU if there is none), and the top-k predictions are written
+to sharded columnar files in --output_dir:
+
+    predictions-00000.npz   keys, top_k_classes, top_k_probabilities
+    predictions-00001.npz   ...
+    report.json             throughput report
+
+Every output shard holds --records_per_shard consecutive inputs and is
+renamed into place once complete. The inputs are read in a deterministic
+order, so rerunning the same command skips the inputs of the shards already
+written and resumes with the next one.
+
+    python mnasnet_predict.py --input_dir=/data/jpegs \
+        --checkpoint_path=/models/mnasnet-a1 --output_dir=/data/predictions
+
+--saved_model_dir runs a model exported by `export()` instead; its serving
+signature decodes the images itself, so only the reads are parallelized. The
+images of the exports of --export_uint8_input are decoded in a batch first. The
+warm-up requests of the export are replayed first, and their images tiled to
+a full --batch_size batch, so that the first batch of the inputs does not pay
+for the first runs of the graph; report.json gives the warm-up time and the
+time of the first batch.
+
+With --prediction_cache_entries or --prediction_cache_dir, every image is
+looked up by the hash of its bytes and the model version before it is
+decoded, and only the images not seen before are decoded and run. The disk
+tier is shared with mnasnet_serve.py, so a rerun over overlapping inputs, or
+over images the server has already answered with the same SavedModel, skips
+them. report.json then includes the cache hit rate and the bytes not decoded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import time
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import imagenet_input
+import mnasnet_model
+import mnasnet_models_v1 as mnasnet_models
+import mnasnet_utils
+import preprocessing
+from tensorflow.python.client import device_lib
+from utils import prediction_cache
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'input_dir', default=None,
+    help='Directory searched recursively for JPEG images.')
+
+flags.DEFINE_string(
+    'file_list', default=None,
+    help='Text file listing one image path per line.')
+
+flags.DEFINE_string(
+    'tfrecord_pattern', default=None,
+    help='Glob of TFRecord shards of ImageNet TFExamples.')
+
+flags.DEFINE_string(
+    'checkpoint_path', default=None,
+    help='Checkpoint, or directory of checkpoints, to restore the model from.')
+
+flags.DEFINE_string(
+    'saved_model_dir', default=None,
+    help='SavedModel to run instead of --checkpoint_path.')
+
+flags.DEFINE_string(
+    'output_dir', default=None, help='Directory of the prediction shards.')
+
+flags.DEFINE_enum(
+    'output_format', default='npz', enum_values=['npz', 'parquet'],
+    help='Format of the prediction shards; parquet requires pyarrow.')
+
+flags.DEFINE_string(
+    'model_name', default='mnasnet-a1', help='The model name to select.')
+
+flags.DEFINE_integer(
+    'num_label_classes', default=1000, help='Number of classes, at least 2')
+
+flags.DEFINE_string(
+    'data_format', default='channels_last',
+    help=('A flag to override the data format used in the model. The value'
+          ' is either channels_first or channels_last.'))
+
+flags.DEFINE_bool(
+    'use_moving_average', default=True,
+    help='Restore the moving averages of the weights when there are any.')
+
+flags.DEFINE_integer('image_size', default=224, help='Input image size.')
+
+flags.DEFINE_integer(
+    'batch_size', default=1024,
+    help='Global batch size, split evenly across the devices.')
+
+flags.DEFINE_integer('top_k', default=5, help='Number of classes to keep.')
+
+flags.DEFINE_integer(
+    'num_parallel_calls', default=64,
+    help='Number of images read and decoded in parallel.')
+
+flags.DEFINE_integer(
+    'records_per_shard', default=100000,
+    help='Number of predictions per output shard.')
+
+flags.DEFINE_bool(
+    'replay_warmup_requests', default=True,
+    help=('Replay the warm-up requests of --saved_model_dir, written by'
+          ' export(), before the first batch. Compare first_batch_secs in'
+          ' report.json with and without it.'))
+
+flags.DEFINE_integer(
+    'prediction_cache_entries', default=0,
+    help=('Predictions kept in memory, keyed by the hash of the image bytes and'
+          ' the model version, so that duplicate images are neither decoded nor'
+          ' run. 0 disables the cache unless --prediction_cache_dir is set.'))
+
+flags.DEFINE_string(
+    'prediction_cache_dir', default=None,
+    help='Directory keeping every prediction on disk as well, across runs.')
+
+flags.DEFINE_integer(
+    'prediction_cache_max_mb', default=1024,
+    help='Size of --prediction_cache_dir; the oldest predictions are dropped.')
+
+flags.DEFINE_integer(
+    'prediction_cache_ttl_secs', default=0,
+    help='Age beyond which cached predictions are ignored; 0 for no limit.')
+
+_JPEG_EXTENSIONS = ('.jpg', '.jpeg', '.JPG', '.JPEG')
+
+
+def _list_images():
+  """Returns the sorted image paths of --input_dir or --file_list."""
+  if FLAGS.file_list:
+    with tf.gfile.GFile(FLAGS.file_list, 'r') as f:
+      return [line.strip() for line in f if line.strip()]
+  filenames = []
+  for dirname, _, basenames in tf.gfile.Walk(FLAGS.input_dir):
+    filenames.extend(os.path.join(dirname, basename) for basename in basenames
+                     if basename.endswith(_JPEG_EXTENSIONS))
+  return sorted(filenames)
+
+
+def make_source_dataset(skip=0):
+  """Dataset of (key, image bytes) pairs in a deterministic order.
+
+  The first `skip` images are left out before they are read or parsed.
+  """
+  if FLAGS.tfrecord_pattern:
+    filenames = sorted(tf.gfile.Glob(FLAGS.tfrecord_pattern))
+    if not filenames:
+      raise ValueError('No TFRecord shards match %s' % FLAGS.tfrecord_pattern)
+
+    def read_shard(filename):
+      records = tf.data.TFRecordDataset(filename, buffer_size=8 * 1024 * 1024)
+      # Records without a file name are keyed by shard and position.
+      index = tf.data.Dataset.range(np.iinfo(np.int64).max).map(tf.as_string)
+      return tf.data.Dataset.zip((records, index)).map(
+          lambda record, i: (record, filename + ':' + i))
+
+    dataset = tf.data.Dataset.from_tensor_slices(filenames)
+    dataset = dataset.apply(
+        tf.contrib.data.parallel_interleave(
+            read_shard, cycle_length=min(len(filenames), 16), sloppy=False))
+    return dataset.skip(skip).map(
+        _parse_record, num_parallel_calls=FLAGS.num_parallel_calls)
+
+  filenames = _list_images()
+  if not filenames:
+    raise ValueError('No images found.')
+  dataset = tf.data.Dataset.from_tensor_slices(filenames[skip:])
+  return dataset.map(lambda filename: (filename, tf.read_file(filename)),
+                     num_parallel_calls=FLAGS.num_parallel_calls)
+
+
+def _parse_record(record, default_key):
+  parsed = tf.parse_single_example(record, {
+      'image/encoded': tf.FixedLenFeature((), tf.string, ''),
+      'image/filename': tf.FixedLenFeature((), tf.string, ''),
+  })
+  key = tf.where(tf.equal(parsed['image/filename'], ''), default_key,
+                 parsed['image/filename'])
+  return key, parsed['image/encoded']
+
+
+def _devices():
+  gpus = [d.name for d in device_lib.list_local_devices()
+          if d.device_type == 'GPU']
+  return gpus or ['/cpu:0']
+
+
+def build_checkpoint_model(images):
+  """Splits the batch across the devices and returns the top-k of each image."""
+  devices = _devices()
+  override_params = {
+      'data_format': FLAGS.data_format,
+      'num_classes': FLAGS.num_label_classes,
+  }
+  batch_size = tf.shape(images)[0]
+  tower_size = (batch_size + len(devices) - 1) // len(devices)
+  # The last, partial batch leaves the last towers short or empty.
+  sizes = [tf.clip_by_value(batch_size - i * tower_size, 0, tower_size)
+           for i in range(len(devices))]
+  tower_images = tf.split(images, tf.stack(sizes), num=len(devices))
+  blocks_args, global_params = mnasnet_models.get_model_params(
+      FLAGS.model_name, override_params)
+  probabilities, classes = [], []
+  # One model, so the towers share its variables.
+  with tf.variable_scope(FLAGS.model_name):
+    model = mnasnet_model.MnasNetModel(blocks_args, global_params)
+    for device, tower in zip(devices, tower_images):
+      with tf.device(device):
+        tower = preprocessing.augment_batch(
+            tower, is_training=False, data_format=FLAGS.data_format)
+        logits = model(tower, training=False)
+        top_k = tf.nn.top_k(tf.nn.softmax(logits), k=FLAGS.top_k)
+        probabilities.append(top_k.values)
+        classes.append(top_k.indices)
+  return tf.concat(classes, axis=0), tf.concat(probabilities, axis=0)
+
+
+def _saved_model_predict_fn(sess):
+  """Loads --saved_model_dir and returns functions of its signature input.
+
+  Returns:
+    (predict_fn, run_fn, input_key): `run_fn` runs a batch of the input
+    `input_key` of the signature, image bytes or, for the exports of
+    --export_uint8_input, uint8 images. `predict_fn` runs a batch of image
+    bytes, decoded first for uint8 exports.
+  """
+  meta_graph = tf.saved_model.loader.load(
+      sess, [tf.saved_model.tag_constants.SERVING], FLAGS.saved_model_dir)
+  signature = meta_graph.signature_def['classify']
+  if len(signature.inputs) != 1:
+    raise ValueError('The classify signature of %s has %d inputs, not 1.' %
+                     (FLAGS.saved_model_dir, len(signature.inputs)))
+  input_key, input_info = list(signature.inputs.items())[0]
+  inputs = sess.graph.get_tensor_by_name(input_info.name)
+  probabilities = sess.graph.get_tensor_by_name(
+      signature.outputs['probabilities'].name)
+  with tf.name_scope('top_k'):
+    top_k = tf.nn.top_k(probabilities, k=FLAGS.top_k)
+  run_fn = sess.make_callable([top_k.indices, top_k.values],
+                              feed_list=[inputs])
+  if inputs.dtype == tf.string:
+    return run_fn, run_fn, input_key
+
+  if inputs.dtype != tf.uint8 or inputs.shape.ndims != 4:
+    raise ValueError('The classify signature of %s takes %s %s, neither image'
+                     ' bytes nor uint8 images.' %
+                     (FLAGS.saved_model_dir, inputs.dtype.name, inputs.shape))
+  image_bytes = tf.placeholder(tf.string, [None])
+  decode_fn = sess.make_callable(
+      _decode_batch(image_bytes, inputs.shape[1].value),
+      feed_list=[image_bytes])
+
+  def predict_fn(batch):
+    return run_fn(decode_fn(batch))
+  return predict_fn, run_fn, input_key
+
+
+def _decode_batch(image_bytes, image_size=None):
+  """Decodes a batch of encoded images to uint8 images, as for evaluation."""
+  return tf.map_fn(
+      lambda b: preprocessing.preprocess_image(
+          b, is_training=False, image_size=image_size or FLAGS.image_size,
+          defer_to_batch=True),
+      image_bytes, dtype=tf.uint8, back_prop=False,
+      parallel_iterations=FLAGS.num_parallel_calls)
+
+
+def cached_predict_fn(predict_fn, cache, version):
+  """Wraps a function of image bytes to only run the images not in `cache`."""
+
+  def cached_fn(batch):
+    keys = [cache.key(image_bytes, version) for image_bytes in batch]
+    predictions = [cache.get(key, len(image_bytes))
+                   for key, image_bytes in zip(keys, batch)]
+    missing = [i for i, p in enumerate(predictions) if p is None]
+    if missing:
+      classes, probabilities = predict_fn(batch[missing])
+      for i, c, p in zip(missing, classes, probabilities):
+        predictions[i] = {'classes': c.tolist(), 'probabilities': p.tolist()}
+        cache.put(keys[i], predictions[i])
+    return (np.array([p['classes'] for p in predictions], dtype=np.int32),
+            np.array([p['probabilities'] for p in predictions],
+                     dtype=np.float32))
+  return cached_fn
+
+
+def _shard_path(index):
+  return os.path.join(FLAGS.output_dir, 'predictions-%05d.%s' %
+                      (index, FLAGS.output_format))
+
+
+def write_shard(index, keys, classes, probabilities):
+  """Writes one complete output shard, renaming it into place."""
+  path = _shard_path(index)
+  tmp_path = path + '.tmp'
+  if FLAGS.output_format == 'parquet':
+    import pyarrow  # pylint: disable=g-import-not-at-top
+    import pyarrow.parquet  # pylint: disable=g-import-not-at-top
+    table = pyarrow.Table.from_arrays(
+        [pyarrow.array([k.decode('utf-8') for k in keys]),
+         pyarrow.array(list(classes)),
+         pyarrow.array(list(probabilities))],
+        ['key', 'top_k_classes', 'top_k_probabilities'])
+    with tf.gfile.GFile(tmp_path, 'wb') as f:
+      pyarrow.parquet.write_table(table, f)
+  else:
+    with tf.gfile.GFile(tmp_path, 'wb') as f:
+      np.savez(f, keys=np.array(keys), top_k_classes=classes,
+               top_k_probabilities=probabilities)
+  tf.gfile.Rename(tmp_path, path, overwrite=True)
+
+
+def _completed_shards():
+  """Number of consecutive output shards written by a previous run."""
+  index = 0
+  while tf.gfile.Exists(_shard_path(index)):
+    index += 1
+  return index
+
+
+def _check_resume_config():
+  """Refuses to resume shards written with a different configuration."""
+  config = {
+      'input_dir': FLAGS.input_dir,
+      'file_list': FLAGS.file_list,
+      'tfrecord_pattern': FLAGS.tfrecord_pattern,
+      'records_per_shard': FLAGS.records_per_shard,
+      'top_k': FLAGS.top_k,
+  }
+  config_file = os.path.join(FLAGS.output_dir, 'config.json')
+  if tf.gfile.Exists(config_file):
+    with tf.gfile.GFile(config_file, 'r') as f:
+      previous = json.load(f)
+    if previous != config:
+      raise ValueError('%s was written with %s, not %s' %
+                       (FLAGS.output_dir, previous, config))
+  else:
+    with tf.gfile.GFile(config_file, 'w') as f:
+      json.dump(config, f, indent=2)
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  if sum(bool(x) for x in (FLAGS.input_dir, FLAGS.file_list,
+                           FLAGS.tfrecord_pattern)) != 1:
+    raise ValueError('Exactly one of --input_dir, --file_list and '
+                     '--tfrecord_pattern must be set.')
+  if bool(FLAGS.checkpoint_path) == bool(FLAGS.saved_model_dir):
+    raise ValueError('Exactly one of --checkpoint_path and --saved_model_dir '
+                     'must be set.')
+  if FLAGS.output_format == 'parquet':
+    import pyarrow  # pylint: disable=g-import-not-at-top,unused-variable
+
+  tf.gfile.MakeDirs(FLAGS.output_dir)
+  _check_resume_config()
+  first_shard = _completed_shards()
+  if first_shard:
+    tf.logging.info('Resuming after %d complete output shards.', first_shard)
+
+  cache = None
+  if FLAGS.prediction_cache_entries or FLAGS.prediction_cache_dir:
+    cache = prediction_cache.PredictionCache(
+        FLAGS.prediction_cache_entries, disk_dir=FLAGS.prediction_cache_dir,
+        disk_max_mb=FLAGS.prediction_cache_max_mb,
+        ttl_secs=FLAGS.prediction_cache_ttl_secs)
+
+  dataset = make_source_dataset(first_shard * FLAGS.records_per_shard)
+  if FLAGS.saved_model_dir or cache:
+    # The serving signature takes the encoded images, and cached images are
+    # never decoded.
+    dataset = dataset.batch(FLAGS.batch_size)
+  else:
+    dataset = dataset.map(
+        lambda key, image_bytes: (key, preprocessing.preprocess_image(
+            image_bytes, is_training=False, image_size=FLAGS.image_size,
+            defer_to_batch=True)),
+        num_parallel_calls=FLAGS.num_parallel_calls)
+    dataset = dataset.batch(FLAGS.batch_size)
+  dataset = dataset.prefetch(4)
+  keys, inputs = dataset.make_one_shot_iterator().get_next()
+
+  config = tf.ConfigProto(allow_soft_placement=True)
+  config.gpu_options.allow_growth = True
+  sess = tf.Session(config=config)
+  if FLAGS.saved_model_dir:
+    predict_fn, run_fn, input_key = _saved_model_predict_fn(sess)
+    # How the images reach the model, as for mnasnet_serve.py: image bytes
+    # are decoded in the graph of the export, uint8 images by `_decode_batch`.
+    version = prediction_cache.model_version(
+        FLAGS.saved_model_dir, FLAGS.top_k,
+        'graph' if predict_fn is run_fn else 'host', input_key)
+  elif cache:
+    image_bytes = tf.placeholder(tf.string, [None])
+    top_k_classes, top_k_probabilities = build_checkpoint_model(
+        _decode_batch(image_bytes))
+    checkpoint_path = mnasnet_utils.restore_model(
+        sess, FLAGS.checkpoint_path, FLAGS.use_moving_average)
+    predict_fn = sess.make_callable(
+        [top_k_classes, top_k_probabilities], feed_list=[image_bytes])
+    version = prediction_cache.model_version(
+        checkpoint_path, FLAGS.model_name, FLAGS.image_size,
+        FLAGS.use_moving_average, FLAGS.top_k)
+  else:
+    top_k_classes, top_k_probabilities = build_checkpoint_model(inputs)
+    mnasnet_utils.restore_model(sess, FLAGS.checkpoint_path,
+                                FLAGS.use_moving_average)
+    fetches = [keys, top_k_classes, top_k_probabilities]
+  warmup_requests = []
+  warmup_secs = 0.
+  if FLAGS.saved_model_dir and FLAGS.replay_warmup_requests:
+    start = time.time()
+    warmup_requests = imagenet_input.read_warmup_requests(
+        FLAGS.saved_model_dir, input_key)
+    for request in warmup_requests:
+      run_fn(request)
+    if warmup_requests:
+      largest = max(warmup_requests, key=len)
+      run_fn(largest[np.arange(FLAGS.batch_size) % len(largest)])
+    warmup_secs = time.time() - start
+    tf.logging.info('Replayed %d warm-up requests in %.1f secs.',
+                    len(warmup_requests), warmup_secs)
+  if cache:
+    predict_fn = cached_predict_fn(predict_fn, cache, version)
+
+  shard = first_shard
+  pending = {'keys': [], 'classes': [], 'probabilities': []}
+  num_images = 0
+  start = time.time()
+
+  def flush(count):
+    keys_ = np.concatenate(pending['keys'])
+    classes_ = np.concatenate(pending['classes'])
+    probabilities_ = np.concatenate(pending['probabilities'])
+    write_shard(shard, keys_[:count], classes_[:count], probabilities_[:count])
+    for name, values in zip(['keys', 'classes', 'probabilities'],
+                            [keys_, classes_, probabilities_]):
+      pending[name] = [values[count:]]
+    tf.logging.info('Wrote shard %d, %d images at %.1f images/sec.', shard,
+                    num_images, num_images / (time.time() - start))
+
+  first_batch_secs = None
+  num_pending = 0
+  while True:
+    try:
+      if FLAGS.saved_model_dir or cache:
+        batch_keys, batch = sess.run([keys, inputs])
+        batch_classes, batch_probabilities = predict_fn(batch)
+      else:
+        batch_keys, batch_classes, batch_probabilities = sess.run(fetches)
+    except tf.errors.OutOfRangeError:
+      break
+    if first_batch_secs is None:
+      first_batch_secs = time.time() - start
+    pending['keys'].append(batch_keys)
+    pending['classes'].append(batch_classes)
+    pending['probabilities'].append(batch_probabilities)
+    num_images += len(batch_keys)
+    num_pending += len(batch_keys)
+    while num_pending >= FLAGS.records_per_shard:
+      flush(FLAGS.records_per_shard)
+      shard += 1
+      num_pending -= FLAGS.records_per_shard
+  if num_pending:
+    flush(num_pending)
+    shard += 1
+  elapsed = time.time() - start
+
+  report = {
+      'num_images': num_images,
+      'num_shards': shard,
+      'resumed_shards': first_shard,
+      'elapsed_secs': elapsed,
+      'images_per_sec': num_images / elapsed if elapsed else None,
+      'batch_size': FLAGS.batch_size,
+      'devices': ['saved_model'] if FLAGS.saved_model_dir else _devices(),
+      'warmup_requests': len(warmup_requests),
+      'warmup_secs': warmup_secs,
+      'first_batch_secs': first_batch_secs,
+  }
+  if cache:
+    report.update(cache.stats())
+  with tf.gfile.GFile(os.path.join(FLAGS.output_dir, 'report.json'), 'w') as f:
+    json.dump(report, f, indent=2)
+  tf.logging.info('%s', json.dumps(report))
+
+
+if __name__ == '__main__':
+  app.run(main)
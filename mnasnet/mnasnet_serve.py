@@ -0,0 +1,1559 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""HTTP inference server for the SavedModels written by `export()`.
+
+Concurrent requests are coalesced into batches by a
+`utils.dynamic_batching.DynamicBatcher`: a batch runs once it holds
+max(--batch_sizes) images or after --max_queue_delay_ms, padded to the
+smallest of --batch_sizes that fits. Every batch size is run before the
+server accepts requests, so no request pays for the first run of a shape:
+on the warm-up requests export() writes with the SavedModel, in
+assets.extra/tf_serving_warmup_requests as for TensorFlow Serving, or on
+synthetic JPEGs without them (see --serving_warmup). The model status
+reports the latency of its first request.
+
+The 'classify' signature of the SavedModel takes either JPEG bytes
+('image_bytes', the default export) or uint8 images ('images',
+--export_uint8_input). With --staged_decoding, the default, the JPEGs are
+decoded and center-cropped, as for evaluation, by a pool of
+--num_decode_threads threads ahead of the batcher, and the model is fed the
+decoded images: the normalized 'truediv' tensor of a JPEG export, which is
+also the TFLite input, or the uint8 input. Decoding then overlaps with the
+batches of the model instead of running inside them, and both stages have a
+bounded queue. Without it, the session call of a JPEG export decodes its
+batch itself.
+
+    python mnasnet_serve.py --saved_model_dir=/export/mnasnet-a1 --port=8501
+
+With --model_root, one process serves every export under it, e.g. the
+variants of /export/mnasnet-a1, /export/mnasnet-d1 and /export/mnasnet-d1-320
+as models mnasnet-a1, mnasnet-d1 and mnasnet-d1-320. A model is loaded and
+warmed up on its first request, and the least recently used idle models are
+evicted when the loaded ones take more than --model_memory_budget_mb. The
+models share the decode threads and the --num_batch_threads batch slots, so
+adding models does not multiply the threads of the process.
+--model_stats_file keeps the request counts of the models across restarts,
+saved every --model_stats_interval_secs and on shutdown or SIGTERM, and
+--prewarm_top_k loads the most requested ones at startup:
+
+    python mnasnet_serve.py --model_root=/export --model_memory_budget_mb=2048 \
+        --model_stats_file=/export/model_stats.json --prewarm_top_k=2
+
+With --prediction_cache_entries or --prediction_cache_dir, the predictions
+of every JPEG are cached by the hash of its bytes, the model version and its
+preprocessing, and repeated images are answered before decoding; /metrics
+reports the cache hits, misses, hit rate and the JPEG bytes not decoded.
+
+With --cascade_small_model_dir, --served_model_name is a cascade: the small
+model runs on every image, and the images it is not confident about, under
+the threshold of --cascade_calibration_file (see calibrate_cascade.py) or
+--cascade_threshold, are escalated to the model of --saved_model_dir, whose
+batcher batches them apart. Both models are also served on their own, as
+<served_model_name>-small and <served_model_name>-large, and /metrics
+reports the escalation rate and, with a calibration file, the compute saved:
+
+    python mnasnet_serve.py --saved_model_dir=/export/mnasnet-a1 \
+        --cascade_small_model_dir=/export/mnasnet-small \
+        --cascade_calibration_file=/export/cascade.json
+
+New versions written to the export directory of a loaded model, e.g. by
+export() after more training, are loaded, warmed up and checked in the
+background every --model_reload_interval_secs, then swapped in without
+dropping requests: the requests in flight finish on the old version, whose
+graph is closed after them. A version whose outputs on canary images are
+not probabilities (or disagree with the current version beyond
+--reload_min_agreement) is rolled back and not tried again; one whose warm
+batches are more than --reload_max_slowdown times slower than the current
+ones, timed back to back, is rolled back until the next check.
+--pinned_model_versions, or POST :pin, holds a model at a version.
+
+With --resolution_buckets, images of any aspect ratio run at the resolution
+bucket nearest to it instead of the square resolution of the export, e.g.
+192x256 for a 4:3 photo with a 224 model, center-cropped to the aspect ratio
+of the bucket or, with --letterbox, resized whole into it and padded. The
+SavedModel is frozen and imported once per bucket with a static input shape,
+so that no request runs the graph at a new shape, and every bucket has a
+batcher of its own. Aspect ratio buckets are sized to the resolution of each
+model, so one list fits the 224 models and mnasnet-d1-320:
+
+    python mnasnet_serve.py --model_root=/export \
+        --resolution_buckets=1:1,3:4,4:3,9:16,16:9
+
+See benchmark_buckets.py for the latency and shape counts of the buckets
+against fixed and dynamic shapes.
+
+Endpoints:
+
+  POST /v1/models/<model_name>:predict
+      A JPEG body (Content-Type: image/jpeg), or a JSON body
+      {"instances": [{"b64": <base64 JPEG>}, ...]}. Answers
+      {"predictions": [{"classes": [...], "probabilities": [...]}, ...]} with
+      the --top_k classes of every image. An X-Timeout-Ms header overrides
+      --timeout_ms. A full queue answers 503, a request past its deadline 504.
+  GET  /v1/models/<model_name>
+      The model status, loading the model if needed. Unknown models answer
+      404.
+  GET  /v1/models
+      The loaded models, their memory and request counts, and the models
+      available.
+  POST /v1/models/<model_name>:pin
+      {"version": <version>} serves a version of the export directory of the
+      model, {"version": null} its latest version again. Answers the model
+      status, or 409 if the version was rolled back.
+  GET  /metrics
+      Queue depth, request counts and latency histograms of every model,
+      labelled with its name, and model loads and evictions, in the
+      Prometheus text format, or as JSON with ?format=json.
+
+See benchmark_server.py for a local load generator.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import base64
+import collections
+import functools
+import json
+import os
+import re
+import signal
+import socketserver
+import threading
+import time
+from concurrent import futures
+from http import server as http_server
+
+from absl import app
+from absl import flags
+import numpy as np
+import tensorflow as tf
+
+import imagenet_input
+import preprocessing
+from preprocessing import MEAN_RGB
+from preprocessing import STDDEV_RGB
+from utils import cascade
+from utils import dynamic_batching
+from utils import model_registry
+from utils import prediction_cache
+from utils import resolution_buckets
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string(
+    'saved_model_dir', default=None,
+    help=('SavedModel to serve, or an export directory, whose latest'
+          ' timestamped SavedModel is served.'))
+
+flags.DEFINE_string(
+    'served_model_name', default='mnasnet',
+    help='Name of the model of --saved_model_dir in the request URLs.')
+
+flags.DEFINE_string(
+    'model_root', default=None,
+    help=('Directory of exports, one per model variant, e.g. mnasnet-a1 and'
+          ' mnasnet-d1-320, each served under its directory name. They are'
+          ' loaded when first requested.'))
+
+flags.DEFINE_integer(
+    'model_memory_budget_mb', default=0,
+    help=('Memory the models of --model_root may take; least recently used'
+          ' models are evicted beyond it. 0 for no limit.'))
+
+flags.DEFINE_list(
+    'prewarm_models', default=[],
+    help='Models of --model_root loaded at startup.')
+
+flags.DEFINE_integer(
+    'prewarm_top_k', default=0,
+    help=('Also load at startup the models most requested, according to'
+          ' --model_stats_file.'))
+
+flags.DEFINE_string(
+    'model_stats_file', default=None,
+    help='JSON file keeping the number of requests per model across restarts.')
+
+flags.DEFINE_integer(
+    'model_stats_interval_secs', default=60,
+    help=('How often --model_stats_file is saved, besides on shutdown. 0 only'
+          ' saves it on shutdown.'))
+
+flags.DEFINE_integer(
+    'model_reload_interval_secs', default=60,
+    help=('How often the export directories of the loaded models are checked'
+          ' for a new version, which is loaded, warmed up and checked in the'
+          ' background and then swapped in. 0 disables reloading.'))
+
+flags.DEFINE_list(
+    'pinned_model_versions', default=[],
+    help=('<model name>:<version> pairs of models served at a given version'
+          ' of their export directory instead of the latest. See also'
+          ' POST /v1/models/<name>:pin.'))
+
+flags.DEFINE_float(
+    'reload_max_slowdown', default=1.5,
+    help=('Largest ratio of the warm batch latency of a new version to that'
+          ' of the current one, timed back to back; slower versions are'
+          ' rolled back and tried again at the next check. 0 disables the'
+          ' check.'))
+
+flags.DEFINE_integer(
+    'reload_timing_runs', default=5,
+    help=('Runs of every warm batch on the new and the current version whose'
+          ' median latencies are compared against --reload_max_slowdown.'))
+
+flags.DEFINE_float(
+    'reload_min_agreement', default=0.,
+    help=('Smallest share of the canary images on which a new version must'
+          ' agree with the current one on the top class.'))
+
+flags.DEFINE_string(
+    'reload_canary_dir', default=None,
+    help=('Directory of JPEGs run by every new version before it is swapped'
+          ' in, synthetic JPEGs without it.'))
+
+flags.DEFINE_string('host', default='0.0.0.0', help='Address to listen on.')
+
+flags.DEFINE_integer('port', default=8501, help='Port to listen on.')
+
+flags.DEFINE_list(
+    'batch_sizes', default=['1', '2', '4', '8', '16', '32'],
+    help=('Batch sizes the model is run with; batches are padded to the'
+          ' smallest that fits. The largest is the maximum batch size.'))
+
+flags.DEFINE_float(
+    'max_queue_delay_ms', default=5.,
+    help='Longest time a request waits for others to fill its batch.')
+
+flags.DEFINE_integer(
+    'max_queue_size', default=256,
+    help='Most images queued at once; further requests are rejected with 503.')
+
+flags.DEFINE_float(
+    'timeout_ms', default=1000.,
+    help='Default deadline of a request; later requests fail with 504.')
+
+flags.DEFINE_integer(
+    'num_batch_threads', default=2,
+    help='Number of batches run concurrently.')
+
+flags.DEFINE_integer(
+    'intra_op_threads', default=0,
+    help='Intra-op threads of the model session; 0 lets TensorFlow decide.')
+
+flags.DEFINE_integer(
+    'inter_op_threads', default=0,
+    help='Inter-op threads of the model session; 0 lets TensorFlow decide.')
+
+flags.DEFINE_bool(
+    'staged_decoding', default=True,
+    help=('Decode the JPEGs on a pool of threads ahead of the batcher instead'
+          ' of in the session call of the model. Always on for models taking'
+          ' uint8 images.'))
+
+flags.DEFINE_integer(
+    'num_decode_threads', default=4,
+    help='Threads decoding JPEGs, with --staged_decoding.')
+
+flags.DEFINE_integer(
+    'max_decode_queue_size', default=64,
+    help=('Most requests waiting to be decoded; further requests are rejected'
+          ' with 503.'))
+
+flags.DEFINE_list(
+    'resolution_buckets', default=[],
+    help=('Resolution buckets of variable-resolution inference:'
+          ' <height>x<width>, <size> or <height>:<width> aspect ratios sized to'
+          ' the resolution of each model, e.g. 1:1,3:4,4:3,9:16,16:9. Every'
+          ' image runs at the bucket nearest to its aspect ratio, in a graph of'
+          ' static shapes and a batcher per bucket. Empty to serve the square'
+          ' resolution of the export.'))
+
+flags.DEFINE_bool(
+    'letterbox', default=False,
+    help=('With --resolution_buckets, resize the whole image into its bucket,'
+          ' preserving its aspect ratio, and pad it, instead of center'
+          ' cropping it to the aspect ratio of the bucket.'))
+
+flags.DEFINE_enum(
+    'serving_warmup', default='requests',
+    enum_values=['requests', 'synthetic', 'none'],
+    help=('How every batch size is run before a model serves: \'requests\''
+          ' replays the warm-up requests export() writes with the SavedModel,'
+          ' or synthetic JPEGs without them; \'none\' serves the model cold,'
+          ' e.g. to measure the latency of first requests.'))
+
+flags.DEFINE_integer(
+    'top_k', default=5, help='Number of classes returned per image.')
+
+flags.DEFINE_string(
+    'cascade_small_model_dir', default=None,
+    help=('Export of a small model, e.g. mnasnet-small, run on every image of'
+          ' --served_model_name first; only the images it is not confident'
+          ' about are run by the model of --saved_model_dir.'))
+
+flags.DEFINE_string(
+    'cascade_calibration_file', default=None,
+    help='Threshold and confidence measure written by calibrate_cascade.py.')
+
+flags.DEFINE_float(
+    'cascade_threshold', default=None,
+    help=('Confidence of the small model below which an image is escalated;'
+          ' overrides --cascade_calibration_file.'))
+
+flags.DEFINE_enum(
+    'cascade_confidence_measure', default=None, enum_values=cascade.MEASURES,
+    help=('Confidence of the small model; overrides'
+          ' --cascade_calibration_file, max_softmax without it.'))
+
+flags.DEFINE_integer(
+    'prediction_cache_entries', default=0,
+    help=('Predictions kept in memory, keyed by the hash of the JPEG bytes and'
+          ' the model version, to answer repeated images without decoding'
+          ' them. 0 disables the cache unless --prediction_cache_dir is set.'))
+
+flags.DEFINE_string(
+    'prediction_cache_dir', default=None,
+    help=('Directory keeping every prediction on disk as well, shared with'
+          ' other servers and with mnasnet_predict.py when they run the same'
+          ' export on the same preprocessing.'))
+
+flags.DEFINE_integer(
+    'prediction_cache_max_mb', default=1024,
+    help='Size of --prediction_cache_dir; the oldest predictions are dropped.')
+
+flags.DEFINE_integer(
+    'prediction_cache_ttl_secs', default=0,
+    help='Age beyond which cached predictions are ignored; 0 for no limit.')
+
+
+def latest_saved_model(saved_model_dir):
+  """`saved_model_dir`, or its latest timestamped SavedModel."""
+  if tf.gfile.Exists(os.path.join(saved_model_dir, 'saved_model.pb')):
+    return saved_model_dir
+  versions = [d.strip('/') for d in tf.gfile.ListDirectory(saved_model_dir)
+              if d.strip('/').isdigit()]
+  if not versions:
+    raise ValueError('No SavedModel in %s' % saved_model_dir)
+  return os.path.join(saved_model_dir, max(versions, key=int))
+
+
+def _session_config(intra_op_threads=0, inter_op_threads=0):
+  return tf.ConfigProto(intra_op_parallelism_threads=intra_op_threads,
+                        inter_op_parallelism_threads=inter_op_threads)
+
+
+class SavedModelRunner(object):
+  """Runs one signature of a SavedModel in a session of its own.
+
+  `run_decoded` runs it on decoded uint8 NHWC images, whichever its input: a
+  JPEG signature is fed its normalized images, the 'truediv' tensor.
+
+  Args:
+    saved_model_dir: the SavedModel.
+    signature_name: the signature to run, with a single input.
+    intra_op_threads, inter_op_threads: threads of the session.
+  """
+
+  def __init__(self, saved_model_dir, signature_name='classify',
+               intra_op_threads=0, inter_op_threads=0):
+    self.saved_model_dir = saved_model_dir
+    self.graph = tf.Graph()
+    self.sess = tf.Session(graph=self.graph, config=_session_config(
+        intra_op_threads, inter_op_threads))
+    meta_graph = tf.saved_model.loader.load(
+        self.sess, [tf.saved_model.tag_constants.SERVING], saved_model_dir)
+    signature = meta_graph.signature_def[signature_name]
+    if len(signature.inputs) != 1:
+      raise ValueError('The %s signature has %d inputs, not 1.' %
+                       (signature_name, len(signature.inputs)))
+    self.input_key, input_info = list(signature.inputs.items())[0]
+    self.input_dtype = tf.as_dtype(input_info.dtype)
+    self.input_shape = [d.size for d in input_info.tensor_shape.dim]
+    self.output_keys = sorted(signature.outputs)
+    outputs = [self.graph.get_tensor_by_name(signature.outputs[k].name)
+               for k in self.output_keys]
+    self._outputs = outputs
+    self._input = self.graph.get_tensor_by_name(input_info.name)
+    # A callable skips the feed and fetch lookups of every `Session.run`.
+    self._run = self.sess.make_callable(outputs, feed_list=[self._input])
+
+    self._normalized_input = None
+    self._run_normalized = None
+    if self.takes_jpegs:
+      try:
+        self._normalized_input = self.graph.get_tensor_by_name('truediv:0')
+      except KeyError:
+        pass
+      else:
+        self._run_normalized = self.sess.make_callable(
+            outputs, feed_list=[self._normalized_input])
+
+  @property
+  def takes_jpegs(self):
+    return self.input_dtype == tf.string
+
+  @property
+  def _normalized_nchw(self):
+    shape = self._normalized_input.shape.as_list()
+    return shape[1] == 3 and shape[3] != 3
+
+  @property
+  def image_size(self):
+    """The size of the decoded images, None if it is unknown."""
+    if not self.takes_jpegs:
+      return self.input_shape[1]
+    if self._normalized_input is None:
+      return None
+    return self._normalized_input.shape.as_list()[
+        2 if self._normalized_nchw else 1]
+
+  @property
+  def can_run_decoded(self):
+    return not self.takes_jpegs or self.image_size is not None
+
+  @property
+  def decoded_input(self):
+    """The tensor `run_decoded` feeds, normalized images of a JPEG export."""
+    return self._normalized_input if self.takes_jpegs else self._input
+
+  @property
+  def decoded_data_format(self):
+    if self.takes_jpegs and self._normalized_nchw:
+      return 'channels_first'
+    return 'channels_last'
+
+  @property
+  def output_names(self):
+    """The names of the output tensors, in the order of `output_keys`."""
+    return [t.name for t in self._outputs]
+
+  def frozen_graph_def(self):
+    """The GraphDef of the signature, with its variables as constants."""
+    return tf.graph_util.convert_variables_to_constants(
+        self.sess, self.graph.as_graph_def(),
+        [name.split(':')[0] for name in self.output_names])
+
+  def __call__(self, inputs):
+    return dict(zip(self.output_keys, self._run(inputs)))
+
+  def run_decoded(self, images):
+    """Runs the model on [batch, size, size, 3] uint8 images."""
+    if not self.takes_jpegs:
+      return self(images)
+    images = ((images.astype(np.float32) - np.float32(MEAN_RGB)) /
+              np.float32(STDDEV_RGB))
+    if self._normalized_nchw:
+      images = images.transpose([0, 3, 1, 2])
+    return dict(zip(self.output_keys, self._run_normalized(images)))
+
+  def close(self):
+    self.sess.close()
+
+
+class BucketedRunner(object):
+  """Runs a SavedModel on uint8 images of a few resolutions, in static shapes.
+
+  The frozen graph of the signature is imported once per (height, width)
+  bucket, with the input `SavedModelRunner.run_decoded` feeds remapped to a
+  [None, height, width, 3] uint8 placeholder: every op of a bucket has a
+  static shape, so it is planned for one resolution, and a request never
+  re-plans the graph for a new shape. A (None, None) bucket imports a graph
+  of dynamic shapes instead, for comparison. The buckets share a session.
+
+  `input_shapes` are the distinct input shapes run: under dynamic batching,
+  the buckets times the batch sizes.
+
+  Args:
+    runner: the `SavedModelRunner` of the model, which can run decoded images.
+    buckets: the (height, width) of the buckets.
+    intra_op_threads, inter_op_threads: threads of the session.
+  """
+
+  def __init__(self, runner, buckets, intra_op_threads=0, inter_op_threads=0):
+    if not runner.can_run_decoded:
+      raise ValueError('No decoded input in %s.' % runner.saved_model_dir)
+    graph_def = runner.frozen_graph_def()
+    self.buckets = list(buckets)
+    self.output_keys = runner.output_keys
+    self.input_shapes = set()
+    self._lock = threading.Lock()
+    self.graph = tf.Graph()
+    feeds = {}
+    with self.graph.as_default():
+      for height, width in self.buckets:
+        with tf.name_scope('bucket_%sx%s' % (height, width)):
+          images = tf.placeholder(tf.uint8, [None, height, width, 3],
+                                  name='images')
+          inputs = images
+          if runner.takes_jpegs:
+            inputs = preprocessing.augment_batch(
+                images, is_training=False,
+                data_format=runner.decoded_data_format)
+          outputs = tf.import_graph_def(
+              graph_def, input_map={runner.decoded_input.name: inputs},
+              return_elements=runner.output_names, name='model')
+        feeds[(height, width)] = images, outputs
+    self.sess = tf.Session(graph=self.graph, config=_session_config(
+        intra_op_threads, inter_op_threads))
+    self._runs = {bucket: self.sess.make_callable(outputs, feed_list=[images])
+                  for bucket, (images, outputs) in feeds.items()}
+
+  def __call__(self, bucket, images):
+    """Runs the model on the [batch, height, width, 3] images of a bucket."""
+    with self._lock:
+      self.input_shapes.add(images.shape)
+    return dict(zip(self.output_keys, self._runs[bucket](images)))
+
+  def close(self):
+    self.sess.close()
+
+
+class JpegDecoder(object):
+  """Decodes and center-crops JPEGs to uint8 images, as for evaluation.
+
+  Args:
+    image_size: size of the decoded images.
+    num_threads: number of threads calling the decoder at once.
+  """
+
+  def __init__(self, image_size, num_threads=1):
+    self.image_size = image_size
+    graph = tf.Graph()
+    with graph.as_default():
+      image_bytes = tf.placeholder(tf.string, [])
+      image = preprocessing.preprocess_image(
+          image_bytes, is_training=False, image_size=image_size,
+          defer_to_batch=True)
+    # Every call runs on one inter-op thread, without splitting its ops.
+    self.sess = tf.Session(graph=graph, config=_session_config(
+        intra_op_threads=1, inter_op_threads=num_threads))
+    self._decode = self.sess.make_callable(image, feed_list=[image_bytes])
+
+  def __call__(self, jpegs):
+    return np.stack([self._decode(jpeg) for jpeg in jpegs])
+
+
+class BucketJpegDecoder(object):
+  """Decodes JPEGs to uint8 images of the resolution bucket of each.
+
+  An image goes to the bucket nearest to its aspect ratio, see
+  utils/resolution_buckets.py. Without `letterbox`, it is center-cropped to
+  the aspect ratio of its bucket, with the margin of evaluation, and resized
+  to it; with it, the whole image is resized to fit the bucket and padded
+  with the mean pixel, which the normalization maps to 0.
+
+  Args:
+    buckets: the (height, width) of the buckets.
+    letterbox: whether to letterbox the images instead of cropping them.
+    num_threads: number of threads calling the decoder at once.
+  """
+
+  def __init__(self, buckets, letterbox=False, num_threads=1):
+    self.buckets = list(buckets)
+    self.letterbox = letterbox
+    graph = tf.Graph()
+    with graph.as_default():
+      image_bytes = tf.placeholder(tf.string, [])
+      crop_window = tf.placeholder(tf.int32, [4])
+      size = tf.placeholder(tf.int32, [2])
+      padding = tf.placeholder(tf.int32, [2, 2])
+      image = tf.image.decode_and_crop_jpeg(image_bytes, crop_window,
+                                            channels=3)
+      image = tf.image.resize_bicubic([image], size)[0]
+      mean = tf.constant(MEAN_RGB, shape=[1, 1, 3], dtype=tf.float32)
+      image = tf.pad(image - mean, tf.concat([padding, [[0, 0]]], 0)) + mean
+      image = tf.saturate_cast(tf.round(image), tf.uint8)
+      shape = tf.image.extract_jpeg_shape(image_bytes)
+    self.sess = tf.Session(graph=graph, config=_session_config(
+        intra_op_threads=1, inter_op_threads=num_threads))
+    self._shape = self.sess.make_callable(shape, feed_list=[image_bytes])
+    self._decode = self.sess.make_callable(
+        image, feed_list=[image_bytes, crop_window, size, padding])
+
+  def shape(self, jpeg):
+    """The (height, width) of a JPEG, from its header."""
+    height, width, _ = self._shape(jpeg)
+    return int(height), int(width)
+
+  def decode(self, jpeg, bucket, shape=None):
+    """Decodes a JPEG, of (height, width) `shape`, to the images of `bucket`."""
+    height, width = shape or self.shape(jpeg)
+    if self.letterbox:
+      window = (0, 0, height, width)
+      size, padding = resolution_buckets.letterbox(height, width, bucket)
+    else:
+      window = resolution_buckets.crop_window(height, width, bucket,
+                                              preprocessing.CROP_PADDING)
+      size, padding = bucket, ((0, 0), (0, 0))
+    return self._decode(jpeg, window, size, padding)
+
+  def __call__(self, jpegs):
+    """The images of `jpegs` by bucket: {bucket: (indices, images)}."""
+    groups = collections.defaultdict(lambda: ([], []))
+    for i, jpeg in enumerate(jpegs):
+      shape = self.shape(jpeg)
+      bucket = resolution_buckets.nearest_bucket(shape[0], shape[1],
+                                                 self.buckets)
+      indices, images = groups[bucket]
+      indices.append(i)
+      images.append(self.decode(jpeg, bucket, shape))
+    return {bucket: (indices, np.stack(images))
+            for bucket, (indices, images) in groups.items()}
+
+
+class JpegDecoders(object):
+  """The JPEG decoders of every model, for a decode pool shared by models.
+
+  Called with (jpegs, image_size) from the threads of a `StagePool`, by a
+  `JpegDecoder` of that size, or with (jpegs, (buckets, letterbox)) by a
+  `BucketJpegDecoder`.
+  """
+
+  def __init__(self, num_threads=1):
+    self.num_threads = num_threads
+    self._decoders = {}
+    self._lock = threading.Lock()
+
+  def decoder(self, image_size):
+    with self._lock:
+      if image_size not in self._decoders:
+        if isinstance(image_size, tuple):
+          buckets, letterbox = image_size
+          self._decoders[image_size] = BucketJpegDecoder(
+              buckets, letterbox, self.num_threads)
+        else:
+          self._decoders[image_size] = JpegDecoder(image_size,
+                                                   self.num_threads)
+      return self._decoders[image_size]
+
+  def __call__(self, args):
+    jpegs, image_size = args
+    return self.decoder(image_size)(jpegs)
+
+
+class ModelServer(object):
+  """Batches the requests of one model and formats its predictions.
+
+  Args:
+    runner: the `SavedModelRunner` of the model.
+    batcher: the `DynamicBatcher` running `runner`, or `runner.run_decoded`
+      with a `decode_pool`.
+    decode_pool: optional `StagePool` of `JpegDecoders`, decoding the JPEGs of
+      a request.
+    top_k: number of classes returned per image.
+    cache: optional `PredictionCache`, looked up before decoding.
+    export_dir: the directory of timestamped SavedModels the model is a
+      version of, None if it was given a SavedModel.
+  """
+
+  def __init__(self, runner, batcher, decode_pool=None, top_k=5, cache=None,
+               export_dir=None):
+    self.runner = runner
+    self.batcher = batcher
+    self.decode_pool = decode_pool
+    self.top_k = top_k
+    self.cache = cache
+    self.export_dir = export_dir
+    self.version = os.path.basename(runner.saved_model_dir.rstrip('/'))
+    # How the images reach the model, as for mnasnet_predict.py: decoded in
+    # the graph or by the host, and the tensor fed.
+    if decode_pool is None:
+      self.preprocessing = ('graph', runner.input_key)
+    else:
+      self.preprocessing = ('host', 'truediv' if runner.takes_jpegs
+                            else runner.input_key)
+    self.cache_version = prediction_cache.model_version(
+        runner.saved_model_dir, top_k, *self.preprocessing)
+    # Milliseconds of a warm batch of every batch size.
+    self.warm_ms = {}
+    self.warmup_requests = 0
+    self.first_request_ms = None
+    self.ready = False
+
+  @property
+  def metrics(self):
+    return self.batcher.metrics
+
+  @property
+  def timeout(self):
+    """The default deadline of a request, in seconds."""
+    return self.batcher.timeout
+
+  def _inputs(self, jpegs):
+    """The inputs of the batcher for `jpegs`, decoded in this thread."""
+    if self.decode_pool:
+      return self.decode_pool.fn((jpegs, self.runner.image_size))
+    return np.array(jpegs, dtype=object)
+
+  def run_direct(self, jpegs):
+    """The probabilities of `jpegs`, without the cache and the batcher."""
+    return self.batcher.run_fn(self._inputs(jpegs))['probabilities']
+
+  def warm_batches(self, jpegs, requests=()):
+    """The (run_fn, batch) of every batch size, keyed as `warm_ms`.
+
+    A batch size is run on the warm-up request of that size, or else on the
+    images of the largest request, or on copies of `jpegs` without any.
+
+    Args:
+      jpegs: a list of JPEGs.
+      requests: warm-up request batches of the input of the runner, see
+        `imagenet_input.read_warmup_requests`.
+    """
+    batches = {}
+    for request in requests:
+      batches[len(request)] = (self._inputs(list(request))
+                               if self.runner.takes_jpegs else request)
+    images = batches[max(batches)] if batches else self._inputs(list(jpegs))
+    warm_batches = collections.OrderedDict()
+    for batch_size in self.batcher.batch_sizes:
+      batch = batches.get(batch_size)
+      if batch is None:
+        batch = images[np.arange(batch_size) % len(images)]
+      warm_batches[batch_size] = (self.batcher.run_fn, batch)
+    return warm_batches
+
+  def warmup(self, jpeg, requests=()):
+    """Runs every batch of `warm_batches` twice, timing the second."""
+    self.warmup_requests = len(requests)
+    for key, (run_fn, batch) in self.warm_batches([jpeg], requests).items():
+      run_fn(batch)
+      start = time.time()
+      run_fn(batch)
+      self.warm_ms[key] = 1e3 * (time.time() - start)
+    self.ready = True
+
+  def predict(self, jpegs, timeout_ms=None):
+    """Returns the top classes and probabilities of every JPEG."""
+    if not self.cache:
+      return self._predict(jpegs, timeout_ms)
+    keys = [self.cache.key(jpeg, self.cache_version) for jpeg in jpegs]
+    predictions = [self.cache.get(key, len(jpeg))
+                   for key, jpeg in zip(keys, jpegs)]
+    missing = [i for i, p in enumerate(predictions) if p is None]
+    if missing:
+      computed = self._predict([jpegs[i] for i in missing], timeout_ms)
+      for i, prediction in zip(missing, computed):
+        self.cache.put(keys[i], prediction)
+        predictions[i] = prediction
+    return predictions
+
+  def _predict(self, jpegs, timeout_ms):
+    if timeout_ms is None:
+      timeout_ms = 1e3 * self.timeout
+    start = time.time()
+    if self.decode_pool:
+      inputs = self.decode_pool.run((jpegs, self.runner.image_size),
+                                    timeout_ms)
+      # Decoding takes its share of the deadline.
+      timeout_ms -= 1e3 * (time.time() - start)
+    else:
+      inputs = np.array(jpegs, dtype=object)
+    outputs = self.batcher.predict(inputs, timeout_ms)
+    if self.first_request_ms is None:
+      self.first_request_ms = 1e3 * (time.time() - start)
+    return self._top_k(outputs['probabilities'])
+
+  def _top_k(self, probabilities):
+    classes = np.argsort(-probabilities, axis=1)[:, :self.top_k]
+    return [{'classes': c.tolist(), 'probabilities': p[c].tolist()}
+            for c, p in zip(classes, probabilities)]
+
+  def status(self):
+    return {
+        'saved_model_dir': self.runner.saved_model_dir,
+        'version': self.version,
+        'state': 'AVAILABLE' if self.ready else 'LOADING',
+        'input': self.runner.input_key,
+        'batch_sizes': self.batcher.batch_sizes,
+        'warmup_requests': self.warmup_requests,
+        'first_request_ms': self.first_request_ms,
+    }
+
+  def close(self):
+    self.batcher.stop()
+    self.runner.close()
+
+
+class _BucketMetrics(object):
+  """The `ServingMetrics` of the batchers of every bucket, as those of a model.
+
+  The Prometheus samples are those of every bucket, labelled with it, and the
+  JSON snapshot adds up their counters and queue depths.
+  """
+
+  def __init__(self, metrics_by_bucket):
+    self.metrics_by_bucket = metrics_by_bucket
+
+  def snapshot(self):
+    buckets = {'%dx%d' % bucket: metrics.snapshot()
+               for bucket, metrics in self.metrics_by_bucket.items()}
+    snapshot = {name: sum(b[name] for b in buckets.values())
+                for name in dynamic_batching.ServingMetrics.COUNTERS +
+                ('queue_depth', 'input_shapes')}
+    snapshot['buckets'] = buckets
+    return snapshot
+
+  def families(self):
+    for metrics in self.metrics_by_bucket.values():
+      for family in metrics.families():
+        yield family
+
+
+class BucketedModelServer(ModelServer):
+  """A `ModelServer` running every image at the resolution of its bucket.
+
+  The JPEGs of a request are decoded by a `BucketJpegDecoder` and split by
+  bucket; every bucket has a `DynamicBatcher` of its own, running the graph of
+  static shapes of the bucket in a `BucketedRunner`, so that a batch only
+  holds images of one resolution and its latency is that of its bucket and
+  batch size.
+
+  Args:
+    runner: the `SavedModelRunner` of the model.
+    bucketed: the `BucketedRunner` of its buckets.
+    batchers: the `DynamicBatcher` of every bucket.
+    decode_pool: the `StagePool` of `JpegDecoders`.
+    letterbox: whether to letterbox the images instead of cropping them.
+    top_k, cache, export_dir: as for `ModelServer`.
+  """
+
+  def __init__(self, runner, bucketed, batchers, decode_pool, letterbox,
+               top_k=5, cache=None, export_dir=None):
+    super(BucketedModelServer, self).__init__(
+        runner, None, decode_pool, top_k, cache, export_dir)
+    self.bucketed = bucketed
+    self.batchers = batchers
+    self.letterbox = letterbox
+    self._decoder_key = (tuple(bucketed.buckets), letterbox)
+    self._metrics = _BucketMetrics(
+        {bucket: batcher.metrics for bucket, batcher in batchers.items()})
+    self.cache_version = prediction_cache.model_version(
+        runner.saved_model_dir, top_k, *(self.preprocessing +
+                                         (self._decoder_key,)))
+
+  @property
+  def metrics(self):
+    return self._metrics
+
+  @property
+  def timeout(self):
+    return next(iter(self.batchers.values())).timeout
+
+  def run_direct(self, jpegs):
+    groups = self.decode_pool.fn((jpegs, self._decoder_key))
+    probabilities = [None] * len(jpegs)
+    for bucket, (indices, images) in groups.items():
+      outputs = self.batchers[bucket].run_fn(images)
+      for i, p in zip(indices, outputs['probabilities']):
+        probabilities[i] = p
+    return np.stack(probabilities)
+
+  def warm_batches(self, jpegs, requests=()):
+    """The (run_fn, batch) of every bucket and batch size.
+
+    The batches are the JPEGs of the largest warm-up request, or copies of
+    `jpegs` without any, decoded to every bucket.
+    """
+    if requests and self.runner.takes_jpegs:
+      jpegs = list(max(requests, key=len))
+    decoder = self.decode_pool.fn.decoder(self._decoder_key)
+    warm_batches = collections.OrderedDict()
+    for bucket, batcher in sorted(self.batchers.items()):
+      images = np.stack([decoder.decode(j, bucket) for j in jpegs])
+      for batch_size in batcher.batch_sizes:
+        warm_batches['%dx%d/%d' % (bucket + (batch_size,))] = (
+            batcher.run_fn, images[np.arange(batch_size) % len(images)])
+    return warm_batches
+
+  def _predict(self, jpegs, timeout_ms):
+    if timeout_ms is None:
+      timeout_ms = 1e3 * self.timeout
+    start = time.time()
+    groups = self.decode_pool.run((jpegs, self._decoder_key), timeout_ms)
+    deadline = start + timeout_ms / 1e3
+    submitted = [
+        (indices, self.batchers[bucket].submit(
+            images, 1e3 * (deadline - time.time())))
+        for bucket, (indices, images) in groups.items()]
+    probabilities = [None] * len(jpegs)
+    for indices, future in submitted:
+      try:
+        outputs = future.result(max(0., deadline - time.time()))
+      except futures.TimeoutError:
+        future.cancel()
+        raise dynamic_batching.RequestTimeoutError(
+            'No result after %.0f ms.' % timeout_ms)
+      for i, p in zip(indices, outputs['probabilities']):
+        probabilities[i] = p
+    if self.first_request_ms is None:
+      self.first_request_ms = 1e3 * (time.time() - start)
+    return self._top_k(np.stack(probabilities))
+
+  def status(self):
+    return {
+        'saved_model_dir': self.runner.saved_model_dir,
+        'version': self.version,
+        'state': 'AVAILABLE' if self.ready else 'LOADING',
+        'input': self.runner.input_key,
+        'buckets': ['%dx%d' % bucket for bucket in self.bucketed.buckets],
+        'letterbox': self.letterbox,
+        'batch_sizes': next(iter(self.batchers.values())).batch_sizes,
+        'input_shapes': len(self.bucketed.input_shapes),
+        'warmup_requests': self.warmup_requests,
+        'first_request_ms': self.first_request_ms,
+    }
+
+  def close(self):
+    for batcher in self.batchers.values():
+      batcher.stop()
+    self.bucketed.close()
+    self.runner.close()
+
+
+class CascadeModelServer(object):
+  """Runs a small `ModelServer` first, and a large one when it is not confident.
+
+  The images of a request whose confidence under the small model is below
+  `threshold` are escalated to the large model, in a request of their own, so
+  that escalations are batched by the batcher of the large model. Every
+  prediction says whether it was escalated.
+
+  Args:
+    registry: the `ModelRegistry` serving both models, so that the cascade
+      runs their latest versions.
+    small, large: the names of both models.
+    threshold, measure: the escalation threshold and the confidence measure,
+      see utils/cascade.py.
+    metrics: `ServingMetrics` of the cascade.
+    costs: optional (small, large) cost per image, to report the compute
+      saved.
+  """
+
+  def __init__(self, registry, small, large, threshold, measure, metrics,
+               costs=None):
+    if measure == 'margin' and FLAGS.top_k < 2:
+      raise ValueError('The margin confidence needs --top_k of at least 2.')
+    self.registry = registry
+    self.small = small
+    self.large = large
+    self.threshold = threshold
+    self.measure = measure
+    self.metrics = metrics
+    self.costs = costs
+    self.ready = True
+    self._lock = threading.Lock()
+    self._images = 0
+    self._escalated = 0
+    metrics.gauge('cascade_escalation_rate', self.escalation_rate)
+    if costs:
+      metrics.gauge('cascade_compute_saved', lambda: cascade.compute_saved(
+          self.escalation_rate(), costs[0], costs[1]))
+
+  def escalation_rate(self):
+    with self._lock:
+      return self._escalated / self._images if self._images else 0.
+
+  def predict(self, jpegs, timeout_ms=None):
+    start = time.time()
+    with self.registry.use(self.small) as small:
+      if timeout_ms is None:
+        timeout_ms = 1e3 * small.timeout
+      predictions = small.predict(jpegs, timeout_ms)
+    scores = cascade.confidence(
+        [p['probabilities'] for p in predictions], self.measure)
+    escalated = [i for i, score in enumerate(scores) if score < self.threshold]
+    if escalated:
+      with self.registry.use(self.large) as large:
+        large_predictions = large.predict(
+            [jpegs[i] for i in escalated],
+            timeout_ms - 1e3 * (time.time() - start))
+      for i, prediction in zip(escalated, large_predictions):
+        predictions[i] = prediction
+    with self._lock:
+      self._images += len(jpegs)
+      self._escalated += len(escalated)
+    self.metrics.inc('cascade_images', len(jpegs))
+    self.metrics.inc('cascade_escalated', len(escalated))
+    escalated = set(escalated)
+    return [dict(p, escalated=i in escalated) for i, p in enumerate(predictions)]
+
+  def status(self):
+    return {
+        'state': 'AVAILABLE',
+        'cascade': {
+            'threshold': self.threshold,
+            'measure': self.measure,
+            'escalation_rate': self.escalation_rate(),
+        },
+        'small': self.registry.peek(self.small).status(),
+        'large': self.registry.peek(self.large).status(),
+    }
+
+  def close(self):
+    # The registry closes both models.
+    pass
+
+
+class ModelLoader(object):
+  """Loads the `ModelServer`s of a process, sharing its decode and run threads.
+
+  Every model runs its batches on the --num_batch_threads slots shared by all
+  models, and decodes its JPEGs on one pool of --num_decode_threads threads.
+  `metrics` are those shared by the models: decoding, loads, evictions and
+  the prediction cache.
+
+  Args:
+    staged_decoding: whether to decode the JPEGs ahead of the batchers.
+    serving_warmup: one of the values of --serving_warmup.
+  """
+
+  def __init__(self, staged_decoding, serving_warmup='requests'):
+    self.staged_decoding = staged_decoding
+    self.serving_warmup = serving_warmup
+    self.metrics = dynamic_batching.ServingMetrics()
+    self.decode_pool = dynamic_batching.StagePool(
+        JpegDecoders(FLAGS.num_decode_threads), 'decode',
+        num_threads=FLAGS.num_decode_threads,
+        max_queue_size=FLAGS.max_decode_queue_size, metrics=self.metrics)
+    self.run_slots = threading.Semaphore(FLAGS.num_batch_threads)
+    # Model name -> version of its export directory to load.
+    self.pins = dict(pin.rsplit(':', 1) for pin in FLAGS.pinned_model_versions)
+    self.cache = None
+    if FLAGS.prediction_cache_entries or FLAGS.prediction_cache_dir:
+      self.cache = prediction_cache.PredictionCache(
+          FLAGS.prediction_cache_entries,
+          disk_dir=FLAGS.prediction_cache_dir,
+          disk_max_mb=FLAGS.prediction_cache_max_mb,
+          ttl_secs=FLAGS.prediction_cache_ttl_secs, metrics=self.metrics)
+    self._warmup_jpeg = preprocessing.synthetic_jpegs(1)[0]
+
+  def load(self, saved_model_dir, model_name):
+    """Loads and warms up a `ModelServer`.
+
+    `saved_model_dir` is a SavedModel, or an export directory whose latest
+    version is loaded.
+    """
+    export_dir = None
+    if latest_saved_model(saved_model_dir) != saved_model_dir:
+      export_dir = saved_model_dir
+      saved_model_dir = latest_saved_model(saved_model_dir)
+      if self.pins.get(model_name):
+        saved_model_dir = os.path.join(export_dir, self.pins[model_name])
+    elif os.path.basename(saved_model_dir.rstrip('/')).isdigit():
+      # A version of an export directory.
+      export_dir = os.path.dirname(saved_model_dir.rstrip('/'))
+    tf.logging.info('Loading %s from %s.', model_name, saved_model_dir)
+    runner = SavedModelRunner(saved_model_dir,
+                              intra_op_threads=FLAGS.intra_op_threads,
+                              inter_op_threads=FLAGS.inter_op_threads)
+    if FLAGS.resolution_buckets:
+      model_server = self._bucketed_server(runner, model_name, export_dir)
+    else:
+      decode_pool = None
+      run_fn = runner
+      if (self.staged_decoding and runner.takes_jpegs and
+          not runner.can_run_decoded):
+        tf.logging.warning('No decoded input in %s, decoding in the session'
+                           ' call.', saved_model_dir)
+      elif self.staged_decoding or not runner.takes_jpegs:
+        decode_pool = self.decode_pool
+        run_fn = runner.run_decoded
+      model_server = ModelServer(
+          runner, self._batcher(run_fn, {'model': model_name}), decode_pool,
+          FLAGS.top_k, self.cache, export_dir)
+    if self.serving_warmup == 'none':
+      model_server.ready = True
+      return model_server
+    requests = []
+    if self.serving_warmup == 'requests':
+      requests = imagenet_input.read_warmup_requests(saved_model_dir,
+                                                     runner.input_key)
+    start = time.time()
+    model_server.warmup(self._warmup_jpeg, requests)
+    tf.logging.info('Warmed up %s in %.1f secs with %d warm-up requests.',
+                    model_name, time.time() - start, len(requests))
+    return model_server
+
+  def _batcher(self, run_fn, labels):
+    return dynamic_batching.DynamicBatcher(
+        run_fn, FLAGS.batch_sizes,
+        max_queue_delay_ms=FLAGS.max_queue_delay_ms,
+        max_queue_size=FLAGS.max_queue_size,
+        timeout_ms=FLAGS.timeout_ms,
+        num_workers=FLAGS.num_batch_threads,
+        metrics=dynamic_batching.ServingMetrics(labels=labels),
+        run_slots=self.run_slots)
+
+  def _bucketed_server(self, runner, model_name, export_dir):
+    """A `BucketedModelServer` of the --resolution_buckets of the model."""
+    buckets = resolution_buckets.parse_buckets(FLAGS.resolution_buckets,
+                                               runner.image_size)
+    tf.logging.info('Building the %s buckets of %s.',
+                    ', '.join('%dx%d' % b for b in buckets), model_name)
+    bucketed = BucketedRunner(runner, buckets,
+                              intra_op_threads=FLAGS.intra_op_threads,
+                              inter_op_threads=FLAGS.inter_op_threads)
+    # The weights are constants of the graphs of the buckets now.
+    runner.close()
+    batchers = {}
+    for bucket in buckets:
+      batcher = self._batcher(
+          functools.partial(bucketed, bucket),
+          {'model': model_name, 'bucket': '%dx%d' % bucket})
+      batcher.metrics.gauge(
+          'input_shapes', lambda b=bucket: sum(
+              shape[1:3] == b for shape in list(bucketed.input_shapes)))
+      batchers[bucket] = batcher
+    return BucketedModelServer(runner, bucketed, batchers, self.decode_pool,
+                               FLAGS.letterbox, FLAGS.top_k, self.cache,
+                               export_dir)
+
+  def close(self):
+    self.decode_pool.stop()
+
+
+def export_versions(export_dir):
+  """The timestamped versions of an export directory, oldest first."""
+  return sorted((d.strip('/') for d in tf.gfile.ListDirectory(export_dir)
+                 if d.strip('/').isdigit()), key=int)
+
+
+class ModelReloader(object):
+  """Swaps in the new versions of the exports of the loaded models.
+
+  Every `interval_secs`, and when a version is pinned, the export directory
+  of every loaded `ModelServer` is checked for the version it should serve:
+  its pinned version, or else its latest one. That version is loaded and
+  warmed up in the background, and swapped in by `ModelRegistry.replace` if
+  it passes the checks of `_check`: in-flight requests finish on the old
+  version, whose graph is closed after them. A version failing the checks is
+  rolled back, i.e. closed while the current version keeps serving. A version
+  with wrong outputs is not tried again. A version that is only too slow is
+  tried again at the next check, since its latency depends on the load of
+  the server.
+
+  Args:
+    registry: the `ModelRegistry` of the models.
+    loader: the `ModelLoader` loading them, and keeping their pinned versions.
+    interval_secs: seconds between checks; 0 to only reload on pins.
+  """
+
+  def __init__(self, registry, loader, interval_secs):
+    self.registry = registry
+    self.loader = loader
+    self.interval_secs = interval_secs
+    # Model name -> versions rolled back.
+    self.rejected = collections.defaultdict(set)
+    self._canary_jpegs = None
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._thread = None
+    if interval_secs:
+      self._thread = threading.Thread(target=self._run, name='reloader')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _run(self):
+    while not self._stop.wait(self.interval_secs):
+      for name, model in self.registry.loaded():
+        if isinstance(model, ModelServer) and model.export_dir:
+          try:
+            self.reload(name)
+          except Exception as e:  # pylint: disable=broad-except
+            tf.logging.error('Reloading %s failed: %s', name, e)
+
+  def canary_jpegs(self):
+    if self._canary_jpegs is None:
+      if FLAGS.reload_canary_dir:
+        self._canary_jpegs = []
+        filenames = sorted(tf.gfile.ListDirectory(FLAGS.reload_canary_dir))
+        for filename in filenames[:max(int(b) for b in FLAGS.batch_sizes)]:
+          with tf.gfile.GFile(os.path.join(FLAGS.reload_canary_dir, filename),
+                              'rb') as f:
+            self._canary_jpegs.append(f.read())
+      else:
+        self._canary_jpegs = preprocessing.synthetic_jpegs(8)
+    return self._canary_jpegs
+
+  def pin(self, name, version):
+    """Pins `name` to `version`, or unpins it with None, and reloads it."""
+    model = self.registry.peek(name)
+    if not isinstance(model, ModelServer) or not model.export_dir:
+      raise ValueError('%s is not served from an export directory.' % name)
+    if version is not None:
+      version = str(version)
+      if version not in export_versions(model.export_dir):
+        raise ValueError('No version %s in %s.' % (version, model.export_dir))
+    with self._lock:
+      if version is None:
+        self.loader.pins.pop(name, None)
+      else:
+        self.rejected[name].discard(version)
+        self.loader.pins[name] = version
+    return self.reload(name)
+
+  def _version(self, name, current):
+    """The version `name` should serve, None if it serves it already."""
+    with self._lock:
+      version = self.loader.pins.get(name)
+      rejected = set(self.rejected[name])
+    version = version or export_versions(current.export_dir)[-1]
+    if version == current.version or version in rejected:
+      return None
+    return version
+
+  def reload(self, name):
+    """Swaps in the version `name` should serve; returns the problems.
+
+    The version is loaded and checked without holding the lock, so that pins
+    are not held up by a reload; it is not swapped in if a pin changed the
+    version to serve meanwhile.
+    """
+    current = self.registry.peek(name)
+    if current is None:
+      return []
+    version = self._version(name, current)
+    if version is None:
+      return []
+    tf.logging.info('Loading version %s of %s.', version, name)
+    # Problems that do not reject the version for good.
+    transient = []
+
+    def check(candidate):
+      if self._version(name, current) != version:
+        transient.append('superseded by a pin')
+        return transient
+      problems = self._check(candidate, current)
+      if not problems:
+        transient.extend(self._check_latency(candidate, current))
+        problems = transient
+      return problems
+
+    problems = self.registry.replace(
+        name,
+        lambda: self.loader.load(
+            os.path.join(current.export_dir, version), name),
+        check)
+    if problems:
+      if not transient:
+        with self._lock:
+          self.rejected[name].add(version)
+      self.loader.metrics.inc('rollbacks')
+      tf.logging.error('Rolled back version %s of %s: %s', version, name,
+                       '; '.join(problems))
+    else:
+      self.loader.metrics.inc('reloads')
+      tf.logging.info('Serving version %s of %s.', version, name)
+    return problems
+
+  def _check_latency(self, candidate, current):
+    """The latency problems of a new version, against the current one.
+
+    Both versions run the same batches of the canary images back to back,
+    --reload_timing_runs times, each run holding a batch slot like the
+    batchers do, so that both are timed under the same load. The medians of
+    the runs are compared.
+    """
+    if not FLAGS.reload_max_slowdown:
+      return []
+    jpegs = self.canary_jpegs()
+    current_batches = current.warm_batches(jpegs)
+    slowdowns = []
+    for key, candidate_batch in candidate.warm_batches(jpegs).items():
+      if key not in current_batches:
+        continue
+      times = ([], [])
+      for _ in range(FLAGS.reload_timing_runs):
+        for (run_fn, batch), ms in zip(
+            (current_batches[key], candidate_batch), times):
+          with self.loader.run_slots:
+            start = time.time()
+            run_fn(batch)
+            ms.append(1e3 * (time.time() - start))
+      slowdowns.append(np.median(times[1]) / np.median(times[0]))
+    if slowdowns and max(slowdowns) > FLAGS.reload_max_slowdown:
+      return ['warm batches are %.2fx slower' % max(slowdowns)]
+    return []
+
+  def _check(self, candidate, current):
+    """The problems of the outputs of a new version, against the current."""
+    problems = []
+    jpegs = self.canary_jpegs()
+    probabilities = candidate.run_direct(jpegs)
+    if (not np.all(np.isfinite(probabilities)) or
+        np.any(np.abs(probabilities.sum(axis=1) - 1) > 1e-3)):
+      problems.append('the outputs are not probabilities')
+    elif FLAGS.reload_min_agreement:
+      agreement = np.mean(np.argmax(probabilities, axis=1) == np.argmax(
+          current.run_direct(jpegs), axis=1))
+      if agreement < FLAGS.reload_min_agreement:
+        problems.append('the top class agrees on %.2f of the canary images'
+                        % agreement)
+    return problems
+
+  def status(self):
+    with self._lock:
+      return {
+          'pinned_versions': dict(self.loader.pins),
+          'rolled_back_versions': {name: sorted(versions, key=int)
+                                   for name, versions in self.rejected.items()
+                                   if versions},
+      }
+
+  def stop(self):
+    self._stop.set()
+    if self._thread:
+      self._thread.join()
+
+
+def _read_jpegs(body, content_type):
+  """The JPEGs of a request body."""
+  if content_type.startswith('image/'):
+    return [body]
+  instances = json.loads(body.decode('utf-8'))['instances']
+  return [base64.b64decode(instance['b64']) for instance in instances]
+
+
+_MODEL_PATH = re.compile(r'^/v1/models/([^/:]+)(:predict|:pin)?$')
+
+
+class _RequestHandler(http_server.BaseHTTPRequestHandler):
+  """Routes the requests of `ServingHTTPServer`."""
+
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+    pass
+
+  def _reply(self, code, body, content_type='application/json', headers=()):
+    if not isinstance(body, bytes):
+      body = json.dumps(body).encode('utf-8')
+    self.send_response(code)
+    self.send_header('Content-Type', content_type)
+    self.send_header('Content-Length', str(len(body)))
+    for key, value in headers:
+      self.send_header(key, value)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def _error(self, code, message, headers=()):
+    self._reply(code, {'error': message}, headers=headers)
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    path, _, query = self.path.partition('?')
+    match = _MODEL_PATH.match(path)
+    if path == '/metrics':
+      if query == 'format=json':
+        self._reply(200, self.server.metrics_snapshot())
+      else:
+        self._reply(200, self.server.prometheus_text().encode('utf-8'),
+                    content_type='text/plain; version=0.0.4')
+    elif path == '/v1/models':
+      self._reply(200, dict(self.server.registry.status(),
+                            available=self.server.registry.names(),
+                            **self.server.reloader.status()))
+    elif match and not match.group(2):
+      try:
+        with self.server.registry.use(match.group(1)) as model_server:
+          self._reply(200, model_server.status())
+      except model_registry.UnknownModelError:
+        self._error(404, 'Unknown model %s' % match.group(1))
+    else:
+      self._error(404, 'Unknown path %s' % path)
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    match = _MODEL_PATH.match(self.path)
+    if not match or not match.group(2):
+      self._error(404, 'Unknown path %s' % self.path)
+      return
+    if match.group(2) == ':pin':
+      self._pin(match.group(1), body)
+      return
+    timeout_ms = self.headers.get('X-Timeout-Ms')
+    try:
+      jpegs = _read_jpegs(body, self.headers.get('Content-Type', ''))
+      with self.server.registry.use(match.group(1)) as model_server:
+        predictions = model_server.predict(
+            jpegs, float(timeout_ms) if timeout_ms else None)
+    except model_registry.UnknownModelError:
+      self._error(404, 'Unknown model %s' % match.group(1))
+    except dynamic_batching.QueueFullError as e:
+      self._error(503, str(e), headers=[('Retry-After', '1')])
+    except dynamic_batching.RequestTimeoutError as e:
+      self._error(504, str(e))
+    except (ValueError, KeyError, TypeError, tf.errors.InvalidArgumentError) as e:
+      self._error(400, str(e))
+    except Exception as e:  # pylint: disable=broad-except
+      tf.logging.error('Request failed: %s', e)
+      self._error(500, str(e))
+    else:
+      self._reply(200, {'predictions': predictions})
+
+
+  def _pin(self, name, body):
+    try:
+      version = json.loads(body.decode('utf-8') or '{}').get('version')
+      problems = self.server.reloader.pin(name, version)
+    except (ValueError, AttributeError) as e:
+      self._error(400, str(e))
+      return
+    if problems:
+      self._error(409, 'Rolled back: %s' % '; '.join(problems))
+    else:
+      self._reply(200, self.server.registry.peek(name).status())
+
+
+class ServingHTTPServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+  """Serves the models of a `ModelRegistry`, one thread per connection."""
+
+  daemon_threads = True
+
+  def __init__(self, address, registry, loader, reloader):
+    http_server.HTTPServer.__init__(self, address, _RequestHandler)
+    self.registry = registry
+    self.loader = loader
+    self.reloader = reloader
+
+  def start(self):
+    """Serves in a background thread."""
+    thread = threading.Thread(target=self.serve_forever, name='http')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def _metrics(self):
+    return ([self.loader.metrics] +
+            [model.metrics for _, model in self.registry.loaded()])
+
+  def prometheus_text(self):
+    return dynamic_batching.prometheus_text(self._metrics())
+
+  def metrics_snapshot(self):
+    """The shared metrics, with the counters of every model added up."""
+    snapshot = self.loader.metrics.snapshot()
+    models = {name: model.metrics.snapshot()
+              for name, model in self.registry.loaded()}
+    for name in dynamic_batching.ServingMetrics.COUNTERS:
+      snapshot[name] += sum(m[name] for m in models.values())
+    snapshot['models'] = models
+    return snapshot
+
+  def close(self):
+    self.reloader.stop()
+    self.registry.close()
+    self.loader.close()
+
+
+def _model_names():
+  """The subdirectories of --model_root holding an export."""
+  if not FLAGS.model_root:
+    return []
+  names = []
+  for name in tf.gfile.ListDirectory(FLAGS.model_root):
+    name = name.strip('/')
+    try:
+      latest_saved_model(os.path.join(FLAGS.model_root, name))
+    except (ValueError, tf.errors.NotFoundError):
+      continue
+    names.append(name)
+  return names
+
+
+def _load_cascade(loader, registry):
+  """Loads the models of the cascade, each also served as a model of its own."""
+  calibration = {}
+  if FLAGS.cascade_calibration_file:
+    with tf.gfile.GFile(FLAGS.cascade_calibration_file) as f:
+      calibration = json.load(f)
+  threshold = FLAGS.cascade_threshold
+  if threshold is None:
+    if 'threshold' not in calibration:
+      raise ValueError('Set --cascade_threshold or --cascade_calibration_file.')
+    threshold = calibration['threshold']
+  measure = (FLAGS.cascade_confidence_measure or
+             calibration.get('measure', 'max_softmax'))
+  costs = None
+  if calibration.get('small_ms_per_image') and calibration.get(
+      'large_ms_per_image'):
+    costs = (calibration['small_ms_per_image'],
+             calibration['large_ms_per_image'])
+  names = []
+  for suffix, saved_model_dir in [('-small', FLAGS.cascade_small_model_dir),
+                                  ('-large', FLAGS.saved_model_dir)]:
+    names.append(FLAGS.served_model_name + suffix)
+    registry.pin(names[-1], loader.load(saved_model_dir, names[-1]))
+  tf.logging.info('Escalating images of %s confidence below %g.', measure,
+                  threshold)
+  return CascadeModelServer(
+      registry, names[0], names[1], threshold, measure,
+      dynamic_batching.ServingMetrics(
+          labels={'model': FLAGS.served_model_name}), costs)
+
+
+def create_server(port=None, staged_decoding=None, serving_warmup=None):
+  """Loads the models to serve and returns their `ServingHTTPServer`.
+
+  The model of --saved_model_dir is loaded now and never evicted; those of
+  --model_root when first requested, or now with --prewarm_models and
+  --prewarm_top_k. New versions of their exports are swapped in by a
+  `ModelReloader`.
+  """
+  if staged_decoding is None:
+    staged_decoding = FLAGS.staged_decoding
+  loader = ModelLoader(staged_decoding,
+                       serving_warmup or FLAGS.serving_warmup)
+  registry = model_registry.ModelRegistry(
+      lambda name: loader.load(os.path.join(FLAGS.model_root, name), name),
+      _model_names,
+      memory_budget_mb=FLAGS.model_memory_budget_mb,
+      stats_file=FLAGS.model_stats_file,
+      metrics=loader.metrics,
+      stats_interval_secs=FLAGS.model_stats_interval_secs)
+  if FLAGS.saved_model_dir and FLAGS.cascade_small_model_dir:
+    registry.pin(FLAGS.served_model_name, _load_cascade(loader, registry))
+  elif FLAGS.saved_model_dir:
+    registry.pin(FLAGS.served_model_name,
+                 loader.load(FLAGS.saved_model_dir, FLAGS.served_model_name))
+  elif not FLAGS.model_root:
+    raise ValueError('Set --saved_model_dir or --model_root.')
+  registry.prewarm(FLAGS.prewarm_models, FLAGS.prewarm_top_k)
+  port = FLAGS.port if port is None else port
+  tf.logging.info('Serving %s on port %d.', ', '.join(registry.names()), port)
+  reloader = ModelReloader(registry, loader, FLAGS.model_reload_interval_secs)
+  return ServingHTTPServer((FLAGS.host, port), registry, loader, reloader)
+
+
+def _exit_on_sigterm(signum, unused_frame):
+  # Unwinds serve_forever, so that the server is closed and its stats saved.
+  raise SystemExit(128 + signum)
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  httpd = create_server()
+  signal.signal(signal.SIGTERM, _exit_on_sigterm)
+  try:
+    httpd.serve_forever()
+  finally:
+    httpd.close()
+
+
+if __name__ == '__main__':
+  app.run(main)
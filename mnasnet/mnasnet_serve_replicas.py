@@ -0,0 +1,415 @@
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+"""Serves a model with several mnasnet_serve.py replicas pinned to core sets.
+
+A single session spreads its intra-op threads over every socket of the host,
+and small batches scale poorly past a few cores. Instead, the physical cores
+are split into --num_replicas equal core sets in NUMA order (see
+`utils.cpu_topology.replica_bindings`, which derives what ompi_bind_p3.sh
+writes by hand). Each replica is a mnasnet_serve.py process run under
+`numactl --physcpubind=<its cores and their siblings> --membind=<their
+nodes>`, with as many intra-op threads as it has cores.
+
+A dispatcher on --port forwards every request to the replica with the fewest
+requests in flight. Its /metrics adds up the counters of the replicas and has
+the in-flight requests and the latency seen by the dispatcher.
+
+    python mnasnet_serve_replicas.py --saved_model_dir=/export/mnasnet-a1 \
+        --num_replicas=8
+
+The flags of mnasnet_serve.py are passed on to the replicas, except the
+thread counts and ports. Every replica counts its own requests in
+--model_stats_file suffixed with .replica-<index>, which it saves when
+mnasnet_serve_replicas.py stops it. With --auto_size, every count of --replica_counts is
+served in turn and loaded with the concurrency levels of benchmark_server.py;
+the count with the best throughput whose p99 latency meets --latency_slo_ms
+is then served, or only reported with --auto_size_only.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import contextlib
+import http.client
+import json
+import os
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from http import server as http_server
+from urllib import error as urllib_error
+from urllib import request as urllib_request
+
+from absl import app
+from absl import flags
+import tensorflow as tf
+
+import benchmark_server
+import mnasnet_serve
+from utils import cpu_topology
+from utils import dynamic_batching
+
+FLAGS = flags.FLAGS
+
+flags.DEFINE_integer(
+    'num_replicas', default=0,
+    help='Number of replicas; 0 runs one per NUMA node.')
+
+flags.DEFINE_bool(
+    'use_hyperthreads', default=True,
+    help='Pin every replica to the hyperthread siblings of its cores too.')
+
+flags.DEFINE_integer(
+    'replica_base_port', default=9100,
+    help='Replica i listens on localhost, on this port plus i.')
+
+flags.DEFINE_bool(
+    'auto_size', default=False,
+    help='Pick the number of replicas by loading every --replica_counts.')
+
+flags.DEFINE_bool(
+    'auto_size_only', default=False,
+    help='With --auto_size, only report the best number of replicas.')
+
+flags.DEFINE_list(
+    'replica_counts', default=['1', '2', '4', '8', '16'],
+    help='Numbers of replicas tried by --auto_size.')
+
+flags.DEFINE_float(
+    'latency_slo_ms', default=50.,
+    help='p99 latency a configuration must meet to be picked by --auto_size.')
+
+flags.DEFINE_float(
+    'replica_start_timeout_secs', default=300.,
+    help='Longest time a replica may take to load and warm up.')
+
+# Flags of mnasnet_serve.py passed on to every replica.
+_REPLICA_FLAGS = ['saved_model_dir', 'served_model_name', 'model_root',
+                  'model_memory_budget_mb', 'prewarm_models', 'prewarm_top_k',
+                  'model_stats_interval_secs',
+                  'batch_sizes', 'max_queue_delay_ms', 'max_queue_size',
+                  'timeout_ms', 'num_batch_threads', 'staged_decoding',
+                  'num_decode_threads', 'max_decode_queue_size', 'top_k',
+                  'prediction_cache_entries', 'prediction_cache_dir',
+                  'prediction_cache_max_mb', 'prediction_cache_ttl_secs',
+                  'cascade_small_model_dir', 'cascade_calibration_file',
+                  'cascade_threshold', 'cascade_confidence_measure',
+                  'model_reload_interval_secs', 'pinned_model_versions',
+                  'reload_max_slowdown', 'reload_timing_runs',
+                  'reload_min_agreement', 'reload_canary_dir',
+                  'serving_warmup', 'resolution_buckets', 'letterbox']
+
+_COUNTERS = dynamic_batching.ServingMetrics.COUNTERS
+
+_SERVING_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Replica(object):
+  """A mnasnet_serve.py process pinned to a `cpu_topology.Binding`."""
+
+  def __init__(self, index, binding, port):
+    self.index = index
+    self.binding = binding
+    self.port = port
+    self.in_flight = 0
+    self.dispatched = 0
+    self.process = None
+
+  @property
+  def url(self):
+    return 'http://127.0.0.1:%d' % self.port
+
+  def start(self):
+    command = [sys.executable, os.path.join(_SERVING_DIR, 'mnasnet_serve.py'),
+               '--host=127.0.0.1', '--port=%d' % self.port,
+               '--intra_op_threads=%d' % self.binding.num_cores,
+               '--inter_op_threads=2']
+    # Unset flags serialize to ''.
+    command += [flag for flag in (FLAGS[name].serialize()
+                                  for name in _REPLICA_FLAGS) if flag]
+    if FLAGS.model_stats_file:
+      # Replicas would overwrite each other's counts in a shared file.
+      command.append('--model_stats_file=%s.replica-%d' %
+                     (FLAGS.model_stats_file, self.index))
+    preexec_fn = None
+    if _has_numactl():
+      command = cpu_topology.numactl_prefix(self.binding) + command
+    else:
+      binding = self.binding
+      preexec_fn = lambda: cpu_topology.pin_current_process(binding)
+    tf.logging.info('Starting replica %d: %s', self.index, ' '.join(command))
+    self.process = subprocess.Popen(command, preexec_fn=preexec_fn,
+                                    cwd=_SERVING_DIR)
+
+  def wait_ready(self, timeout_secs):
+    """Waits for the replica to load its models and listen."""
+    status_url = '%s/v1/models' % self.url
+    deadline = time.time() + timeout_secs
+    while time.time() < deadline:
+      if self.process.poll() is not None:
+        raise RuntimeError('Replica %d exited with %d.' %
+                           (self.index, self.process.returncode))
+      try:
+        urllib_request.urlopen(status_url).read()
+        return
+      except (IOError, ValueError):
+        pass
+      time.sleep(0.5)
+    raise RuntimeError('Replica %d is not ready after %ds.' %
+                       (self.index, timeout_secs))
+
+  def stop(self):
+    if self.process and self.process.poll() is None:
+      self.process.terminate()
+      self.process.wait()
+
+
+def _has_numactl():
+  return any(os.access(os.path.join(d, 'numactl'), os.X_OK)
+             for d in os.environ.get('PATH', '').split(os.pathsep))
+
+
+class Dispatcher(object):
+  """Forwards requests to the replica with the fewest requests in flight."""
+
+  def __init__(self, replicas):
+    self.replicas = replicas
+    self.metrics = dynamic_batching.ServingMetrics(prefix='mnasnet_dispatcher')
+    for replica in replicas:
+      self.metrics.gauge('replica_%d_in_flight' % replica.index,
+                         lambda replica=replica: replica.in_flight)
+    self._lock = threading.Lock()
+    self._local = threading.local()
+
+  def _acquire(self):
+    with self._lock:
+      replica = min(self.replicas, key=lambda r: (r.in_flight, r.dispatched))
+      replica.in_flight += 1
+      replica.dispatched += 1
+      return replica
+
+  def _release(self, replica):
+    with self._lock:
+      replica.in_flight -= 1
+
+  def _connection(self, replica):
+    """A kept-alive connection to `replica`, one per dispatcher thread."""
+    connections = self._local.__dict__.setdefault('connections', {})
+    if replica.index not in connections:
+      connections[replica.index] = http.client.HTTPConnection('127.0.0.1',
+                                                              replica.port)
+    return connections[replica.index]
+
+  def forward(self, method, path, body, headers):
+    """Forwards a request; returns the (status, headers, body) answer."""
+    replica = self._acquire()
+    start = time.time()
+    self.metrics.inc('requests')
+    try:
+      connection = self._connection(replica)
+      try:
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+      except (http.client.HTTPException, IOError):
+        # The replica closed the kept-alive connection; reconnect once.
+        connection.close()
+        connection.request(method, path, body, headers)
+        response = connection.getresponse()
+      answer = (response.status,
+                [(k, response.getheader(k)) for k in ('Content-Type',
+                                                      'Retry-After')
+                 if response.getheader(k)],
+                response.read())
+    finally:
+      self._release(replica)
+    self.metrics.observe('request_ms', 1e3 * (time.time() - start))
+    if answer[0] != 200:
+      self.metrics.inc('failed')
+    return answer
+
+  def broadcast(self, method, path, body, headers):
+    """Sends a request to every replica, e.g. a version pin.
+
+    Returns the first answer that is not 200, or else the last one.
+    """
+    answers = []
+    for replica in self.replicas:
+      request = urllib_request.Request(replica.url + path, data=body,
+                                       headers=headers, method=method)
+      try:
+        response = urllib_request.urlopen(request)
+        status = response.status
+      except urllib_error.HTTPError as e:
+        response, status = e, e.code
+      answers.append((status, [('Content-Type',
+                                response.headers.get('Content-Type'))],
+                      response.read()))
+    return next((a for a in answers if a[0] != 200), answers[-1])
+
+  def snapshot(self):
+    """The counters of all replicas added up, with the dispatcher metrics."""
+    replicas = [json.loads(urllib_request.urlopen(
+        replica.url + '/metrics?format=json').read().decode('utf-8'))
+                for replica in self.replicas]
+    snapshot = {name: sum(r.get(name, 0) for r in replicas)
+                for name in _COUNTERS}
+    snapshot['dispatcher'] = self.metrics.snapshot()
+    snapshot['replicas'] = replicas
+    return snapshot
+
+
+class _DispatchHandler(mnasnet_serve._RequestHandler):  # pylint: disable=protected-access
+  """Routes the requests of a dispatcher."""
+
+  def do_GET(self):  # pylint: disable=invalid-name
+    dispatcher = self.server.dispatcher
+    path, _, query = self.path.partition('?')
+    if path == '/metrics':
+      if query == 'format=json':
+        self._reply(200, dispatcher.snapshot())
+      else:
+        self._reply(200, dispatcher.metrics.prometheus_text().encode('utf-8'),
+                    content_type='text/plain; version=0.0.4')
+    else:
+      self._forward('GET', b'')
+
+  def do_POST(self):  # pylint: disable=invalid-name
+    self._forward('POST',
+                  self.rfile.read(int(self.headers.get('Content-Length', 0))),
+                  broadcast=self.path.endswith(':pin'))
+
+  def _forward(self, method, body, broadcast=False):
+    headers = {k: self.headers[k] for k in ('Content-Type', 'X-Timeout-Ms')
+               if self.headers.get(k)}
+    dispatcher = self.server.dispatcher
+    try:
+      status, answer_headers, answer = (
+          dispatcher.broadcast if broadcast else dispatcher.forward)(
+              method, self.path, body, headers)
+    except (http.client.HTTPException, IOError) as e:
+      self._error(502, str(e))
+      return
+    self.send_response(status)
+    for key, value in answer_headers:
+      self.send_header(key, value)
+    self.send_header('Content-Length', str(len(answer)))
+    self.end_headers()
+    self.wfile.write(answer)
+
+
+class DispatchHTTPServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+  """Serves a `Dispatcher`, one thread per connection."""
+
+  daemon_threads = True
+
+  def __init__(self, address, dispatcher):
+    http_server.HTTPServer.__init__(self, address, _DispatchHandler)
+    self.dispatcher = dispatcher
+
+  def start(self):
+    """Serves in a background thread."""
+    thread = threading.Thread(target=self.serve_forever, name='http')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def bindings_for(num_replicas):
+  return cpu_topology.replica_bindings(
+      cpu_topology.read_topology(), num_replicas, FLAGS.use_hyperthreads)
+
+
+@contextlib.contextmanager
+def serving(bindings, port):
+  """Starts replicas pinned to `bindings` and their dispatcher on `port`."""
+  replicas = [Replica(i, binding, FLAGS.replica_base_port + i)
+              for i, binding in enumerate(bindings)]
+  httpd = None
+  try:
+    for replica in replicas:
+      replica.start()
+    for replica in replicas:
+      replica.wait_ready(FLAGS.replica_start_timeout_secs)
+    httpd = DispatchHTTPServer((FLAGS.host, port), Dispatcher(replicas))
+    httpd.start()
+    tf.logging.info('Dispatching to %d replicas on port %d.', len(replicas),
+                    httpd.server_address[1])
+    yield httpd
+  finally:
+    if httpd:
+      httpd.shutdown()
+    for replica in replicas:
+      replica.stop()
+
+
+def auto_size(bodies):
+  """Loads every --replica_counts; returns the best count and all results."""
+  results = []
+  for num_replicas in [int(n) for n in FLAGS.replica_counts]:
+    try:
+      bindings = bindings_for(num_replicas)
+    except ValueError as e:
+      tf.logging.info('Skipping %d replicas: %s', num_replicas, e)
+      continue
+    with serving(bindings, port=0) as httpd:
+      url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+      levels = [benchmark_server.run_level(url, bodies, int(concurrency))
+                for concurrency in FLAGS.concurrency]
+    # The best level whose requests all succeeded within the SLO.
+    within_slo = [l for l in levels
+                  if list(l['statuses']) == ['200'] and
+                  l['latency_ms']['p99'] <= FLAGS.latency_slo_ms]
+    best = max(within_slo, key=lambda l: l['images_per_sec']) if (
+        within_slo) else None
+    result = {
+        'num_replicas': num_replicas,
+        'images_per_sec_within_slo': best['images_per_sec'] if best else 0.,
+        'concurrency': best['concurrency'] if best else None,
+        'levels': levels,
+    }
+    tf.logging.info('%d replicas: %.1f images/sec within a p99 of %g ms.',
+                    num_replicas, result['images_per_sec_within_slo'],
+                    FLAGS.latency_slo_ms)
+    results.append(result)
+  if not results or not max(r['images_per_sec_within_slo'] for r in results):
+    raise ValueError('No replica count meets --latency_slo_ms=%g.' %
+                     FLAGS.latency_slo_ms)
+  best = max(results, key=lambda r: r['images_per_sec_within_slo'])
+  return best['num_replicas'], results
+
+
+def main(unused_argv):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  num_replicas = FLAGS.num_replicas or len(
+      set(cpu.node for cpu in cpu_topology.read_topology()))
+  if FLAGS.auto_size:
+    bodies = benchmark_server.request_bodies()
+    num_replicas, results = auto_size(bodies)
+    tf.logging.info('Best: %d replicas.', num_replicas)
+    if FLAGS.results_file:
+      with tf.gfile.GFile(FLAGS.results_file, 'w') as f:
+        json.dump(results, f, indent=2)
+    if FLAGS.auto_size_only:
+      return
+
+  with serving(bindings_for(num_replicas), FLAGS.port) as httpd:
+    httpd.serve_forever()
+
+
+if __name__ == '__main__':
+  app.run(main)
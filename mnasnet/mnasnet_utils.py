@@ -77,3 +77,49 @@ def build_optimizer(learning_rate,
     tf.logging.fatal('Unknown optimizer:', optimizer_name)
 
   return optimizer
+
+
+def early_exit_loss(endpoints, onehot_labels, weights=1.0, label_smoothing=0.):
+  """Mean cross entropy of the early-exit logits of the model endpoints."""
+  exit_names = sorted(k for k in endpoints if k.startswith('exit_'))
+  losses = [
+      tf.losses.softmax_cross_entropy(
+          logits=tf.cast(endpoints[name], tf.float32),
+          onehot_labels=onehot_labels,
+          weights=weights,
+          label_smoothing=label_smoothing) for name in exit_names
+  ]
+  return tf.add_n(losses) / len(losses)
+
+
+def early_exit_variables():
+  """The trainable variables of the early-exit classifiers."""
+  return [v for v in tf.trainable_variables() if '/mnas_exit_' in v.name]
+
+
+def restore_model(sess, checkpoint_path, use_moving_average=True):
+  """Restores the model variables of the default graph for inference.
+
+  Args:
+    sess: the `Session` to restore into.
+    checkpoint_path: a checkpoint, or a directory of checkpoints.
+    use_moving_average: restore the moving averages of the variables that
+      have one in the checkpoint.
+
+  Returns:
+    The path of the restored checkpoint.
+  """
+  if tf.gfile.IsDirectory(checkpoint_path):
+    checkpoint_path = tf.train.latest_checkpoint(checkpoint_path)
+  variable_shape_map = tf.train.load_checkpoint(
+      checkpoint_path).get_variable_to_shape_map()
+  variables_to_restore = {}
+  for v in tf.global_variables():
+    name = v.op.name
+    if (use_moving_average and
+        name + '/ExponentialMovingAverage' in variable_shape_map):
+      name += '/ExponentialMovingAverage'
+    variables_to_restore[name] = v
+  tf.train.Saver(variables_to_restore).restore(sess, checkpoint_path)
+  tf.logging.info('Restored %s.', checkpoint_path)
+  return checkpoint_path
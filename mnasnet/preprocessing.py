@@ -17,11 +17,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 import tensorflow as tf
 
 IMAGE_SIZE = 224
 CROP_PADDING = 32
 
+MEAN_RGB = [0.485 * 255, 0.456 * 255, 0.406 * 255]
+STDDEV_RGB = [0.229 * 255, 0.224 * 255, 0.225 * 255]
+
 
 def distorted_bounding_box_crop(image_bytes,
                                 bbox,
@@ -132,18 +136,29 @@ def _flip(image):
   return image
 
 
-def preprocess_for_train(image_bytes, use_bfloat16, image_size=IMAGE_SIZE):
+def _to_uint8(image, image_size):
+  """Rounds a resized image back to uint8 for `augment_batch`."""
+  image.set_shape([image_size, image_size, 3])
+  return tf.saturate_cast(tf.round(image), tf.uint8)
+
+
+def preprocess_for_train(image_bytes, use_bfloat16, image_size=IMAGE_SIZE,
+                         defer_to_batch=False):
   """Preprocesses the given image for evaluation.
 
   Args:
     image_bytes: `Tensor` representing an image binary of arbitrary size.
     use_bfloat16: `bool` for whether to use bfloat16.
     image_size: image size.
+    defer_to_batch: if True, leave the flip and the dtype conversion to
+      `augment_batch` and return a uint8 image.
 
   Returns:
     A preprocessed image `Tensor`.
   """
   image = _decode_and_random_crop(image_bytes, image_size)
+  if defer_to_batch:
+    return _to_uint8(image, image_size)
   image = _flip(image)
   image = tf.reshape(image, [image_size, image_size, 3])
   image = tf.image.convert_image_dtype(
@@ -151,18 +166,23 @@ def preprocess_for_train(image_bytes, use_bfloat16, image_size=IMAGE_SIZE):
   return image
 
 
-def preprocess_for_eval(image_bytes, use_bfloat16, image_size=IMAGE_SIZE):
+def preprocess_for_eval(image_bytes, use_bfloat16, image_size=IMAGE_SIZE,
+                        defer_to_batch=False):
   """Preprocesses the given image for evaluation.
 
   Args:
     image_bytes: `Tensor` representing an image binary of arbitrary size.
     use_bfloat16: `bool` for whether to use bfloat16.
     image_size: image size.
+    defer_to_batch: if True, leave the dtype conversion to `augment_batch` and
+      return a uint8 image.
 
   Returns:
     A preprocessed image `Tensor`.
   """
   image = _decode_and_center_crop(image_bytes, image_size)
+  if defer_to_batch:
+    return _to_uint8(image, image_size)
   image = tf.reshape(image, [image_size, image_size, 3])
   image = tf.image.convert_image_dtype(
       image, dtype=tf.bfloat16 if use_bfloat16 else tf.float32)
@@ -172,7 +192,8 @@ def preprocess_for_eval(image_bytes, use_bfloat16, image_size=IMAGE_SIZE):
 def preprocess_image(image_bytes,
                      is_training=False,
                      use_bfloat16=False,
-                     image_size=IMAGE_SIZE):
+                     image_size=IMAGE_SIZE,
+                     defer_to_batch=False):
   """Preprocesses the given image.
 
   Args:
@@ -180,11 +201,74 @@ def preprocess_image(image_bytes,
     is_training: `bool` for whether the preprocessing is for training.
     use_bfloat16: `bool` for whether to use bfloat16.
     image_size: image size.
+    defer_to_batch: if True, return a uint8 image and leave the flip and the
+      dtype conversion to `augment_batch`.
 
   Returns:
     A preprocessed image `Tensor` with value range of [0, 255].
   """
   if is_training:
-    return preprocess_for_train(image_bytes, use_bfloat16, image_size)
+    return preprocess_for_train(image_bytes, use_bfloat16, image_size,
+                                defer_to_batch)
   else:
-    return preprocess_for_eval(image_bytes, use_bfloat16, image_size)
+    return preprocess_for_eval(image_bytes, use_bfloat16, image_size,
+                               defer_to_batch)
+
+
+def augment_batch(images,
+                  is_training,
+                  use_bfloat16=False,
+                  data_format='channels_last',
+                  mean_rgb=MEAN_RGB,
+                  stddev_rgb=STDDEV_RGB):
+  """Flips, converts and normalizes a whole batch at once.
+
+  Replaces the per-image flip and dtype conversion of `preprocess_image` and
+  the normalization and transpose of the model_fn with a handful of ops per
+  batch. It can run in the input pipeline or on the compute device.
+
+  Args:
+    images: `Tensor` of shape [batch, height, width, 3], usually uint8.
+    is_training: `bool` for whether to randomly flip the images.
+    use_bfloat16: `bool` for whether to return bfloat16 images.
+    data_format: `channels_last` or `channels_first` layout of the result.
+    mean_rgb: per-channel mean subtracted from the images.
+    stddev_rgb: per-channel standard deviation the images are divided by.
+
+  Returns:
+    The normalized batch in `data_format` layout.
+  """
+  with tf.name_scope('augment_batch', values=[images]):
+    if is_training:
+      # One random bit per image selects between the image and its mirror.
+      flip = tf.less(tf.random_uniform([tf.shape(images)[0]]), 0.5)
+      images = tf.where(flip, tf.reverse(images, axis=[2]), images)
+    images = tf.cast(images, tf.float32)
+    images -= tf.constant(mean_rgb, shape=[1, 1, 1, 3], dtype=tf.float32)
+    images *= tf.constant([1. / s for s in stddev_rgb], shape=[1, 1, 1, 3],
+                          dtype=tf.float32)
+    if data_format == 'channels_first':
+      images = tf.transpose(images, [0, 3, 1, 2])
+    if use_bfloat16:
+      images = tf.cast(images, tf.bfloat16)
+    return images
+
+
+def synthetic_jpegs(num_images, seed=0):
+  """Returns JPEG-encoded blocky noise images of ImageNet-like sizes."""
+  rng = np.random.RandomState(seed)
+  jpegs = []
+  with tf.Graph().as_default():
+    image = tf.placeholder(tf.uint8, [None, None, 3])
+    encoded = tf.image.encode_jpeg(image, quality=90)
+    with tf.Session() as sess:
+      for _ in range(num_images):
+        short_side = int(np.clip(rng.lognormal(np.log(360.), 0.25), 96, 1200))
+        long_side = int(short_side * rng.uniform(1., 1.5))
+        height, width = ((short_side, long_side) if rng.rand() < 0.7 else
+                         (long_side, short_side))
+        coarse = rng.randint(0, 256, size=(height // 16 + 1, width // 16 + 1, 3))
+        pixels = np.repeat(np.repeat(coarse, 16, axis=0), 16, axis=1)
+        pixels = pixels[:height, :width].astype(np.uint8)
+        jpegs.append(sess.run(encoded, {image: pixels}))
+  return jpegs
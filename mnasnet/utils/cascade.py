@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Confidence thresholds of a two-model cascade.
+
+A cascade runs a small model on every image and escalates to a large model
+the images whose confidence, under the small model, is below a threshold:
+
+  - 'max_softmax': the probability of the top class;
+  - 'margin': the probability of the top class minus that of the second.
+
+Both only need the top 2 probabilities, so they work on the top-k outputs of
+a server as well as on full softmax outputs.
+
+`calibrate` picks, on validation predictions of both models, the threshold
+escalating the fewest images while the cascade stays within a given top-1
+accuracy loss of the large model alone. `compute_saved` is the share of the
+cost of the large model the cascade saves, from the cost per image of each
+model and the escalation rate.
+
+Runs a self-check on synthetic predictions:
+
+    python utils/cascade.py
+"""
+
+import numpy as np
+
+__all__ = ["MEASURES", "confidence", "calibrate", "compute_saved"]
+
+MEASURES = ('max_softmax', 'margin')
+
+
+def confidence(probabilities, measure='max_softmax'):
+    """The confidence of every row of [batch, classes] probabilities."""
+    top_2 = np.sort(np.asarray(probabilities, dtype=np.float64), axis=1)[:, -2:]
+    if measure == 'max_softmax':
+        return top_2[:, -1]
+    if measure == 'margin':
+        return top_2[:, -1] - top_2[:, -2]
+    raise ValueError('Unknown confidence measure %s, not one of %s.' % (measure, MEASURES))
+
+
+def compute_saved(escalation_rate, small_cost, large_cost):
+    """The share of the cost of the large model alone saved by the cascade."""
+    return 1. - (small_cost + escalation_rate * large_cost) / large_cost
+
+
+def calibrate(small_probabilities, large_probabilities, labels, max_accuracy_loss,
+              measure='max_softmax'):
+    """Picks the threshold escalating the fewest images within an accuracy loss.
+
+    Images whose confidence is strictly below the threshold are escalated.
+
+    Args:
+        small_probabilities, large_probabilities: [batch, classes]
+            probabilities of the validation images under each model.
+        labels: [batch] labels of the images.
+        max_accuracy_loss: largest top-1 accuracy loss of the cascade against
+            the large model alone, e.g. 0.005 for half a point.
+        measure: one of `MEASURES`.
+
+    Returns:
+        A dict of the threshold, escalation rate and accuracies.
+    """
+    labels = np.asarray(labels)
+    small_correct = np.argmax(small_probabilities, axis=1) == labels
+    large_correct = np.argmax(large_probabilities, axis=1) == labels
+    scores = confidence(small_probabilities, measure)
+    order = np.argsort(scores, kind='stable')
+    scores = scores[order]
+    num_images = len(labels)
+    # Accuracy when the k least confident images are escalated, k = 0..n.
+    escalated_correct = np.concatenate([[0], np.cumsum(large_correct[order])])
+    kept_correct = np.concatenate([np.cumsum(small_correct[order][::-1])[::-1], [0]])
+    accuracies = (escalated_correct + kept_correct) / float(num_images)
+    large_accuracy = large_correct.mean()
+    for k in range(num_images + 1):
+        # A threshold escalates all the images of a confidence or none.
+        if 0 < k < num_images and scores[k - 1] == scores[k]:
+            continue
+        if large_accuracy - accuracies[k] <= max_accuracy_loss:
+            break
+    threshold = float(scores[k]) if k < num_images else float('inf')
+    return {
+        'measure': measure,
+        'threshold': threshold,
+        'max_accuracy_loss': max_accuracy_loss,
+        'escalation_rate': k / float(num_images),
+        'accuracy': float(accuracies[k]),
+        'accuracy_loss': float(large_accuracy - accuracies[k]),
+        'small_accuracy': float(small_correct.mean()),
+        'large_accuracy': float(large_accuracy),
+        'num_images': num_images,
+    }
+
+
+def _self_check(num_images=2000, num_classes=10):
+    rng = np.random.RandomState(0)
+    labels = rng.randint(num_classes, size=num_images)
+    # The small model is right on its confident images, and the large model
+    # on almost all of them.
+    easy = rng.rand(num_images) < 0.7
+    small = np.full((num_images, num_classes), 0.5 / (num_classes - 1))
+    small[np.arange(num_images), np.where(easy, labels, (labels + 1) % num_classes)] = 0.5
+    small[easy, labels[easy]] = 0.9
+    small /= small.sum(axis=1, keepdims=True)
+    large = np.full((num_images, num_classes), 0.01)
+    large_right = rng.rand(num_images) < 0.95
+    large[np.arange(num_images), np.where(large_right, labels, (labels + 2) % num_classes)] = 1.
+    for measure in MEASURES:
+        result = calibrate(small, large, labels, 0.01, measure)
+        assert result['accuracy_loss'] <= 0.01, result
+        assert abs(result['escalation_rate'] - (1 - easy.mean())) < 0.01, result
+        escalated = confidence(small, measure) < result['threshold']
+        assert escalated.mean() == result['escalation_rate'], result
+        assert calibrate(small, large, labels, 0., measure)['accuracy_loss'] <= 0.
+    assert calibrate(small, large, labels, 1.)['escalation_rate'] == 0.
+    assert abs(compute_saved(0.3, 1., 4.) - 0.45) < 1e-9
+    print('OK: %s' % result)
+
+
+if __name__ == '__main__':
+    _self_check()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""CPU topology of the host and core sets for pinned processes.
+
+`read_topology` parses `lscpu -p=CPU,CORE,SOCKET,NODE`, and `replica_bindings`
+splits the physical cores of the host, in (NUMA node, core) order, into equal
+contiguous core sets, each with the hyperthread siblings of its cores and the
+memory nodes of its cores. This is what ompi_bind_p3.sh writes by hand for the
+8 ranks of a p3.16xlarge: 4 cores and their siblings per rank, memory bound to
+the node of the cores.
+
+`numactl_prefix` turns a binding into the `numactl` prefix of a command, and
+`pin_current_process` applies the CPU part of it without numactl.
+
+Prints the bindings of this host as a self-check:
+
+    python utils/cpu_topology.py 4
+"""
+
+import collections
+import os
+import subprocess
+import sys
+
+__all__ = ["Cpu", "Binding", "read_topology", "replica_bindings", "numactl_prefix",
+           "pin_current_process"]
+
+Cpu = collections.namedtuple('Cpu', ['cpu', 'core', 'socket', 'node'])
+
+# `cpus` are the logical CPUs of the binding, `num_cores` its physical cores
+# and `nodes` the NUMA nodes of its memory.
+Binding = collections.namedtuple('Binding', ['cpus', 'num_cores', 'nodes'])
+
+
+def read_topology(lscpu_output=None):
+    """Returns the `Cpu`s of the host, from `lscpu -p` unless given its output."""
+    if lscpu_output is None:
+        try:
+            lscpu_output = subprocess.check_output(
+                ['lscpu', '-p=CPU,CORE,SOCKET,NODE']).decode('utf-8')
+        except (OSError, subprocess.CalledProcessError):
+            # No lscpu: every CPU is its own core, on node 0.
+            return [Cpu(i, i, 0, 0) for i in sorted(os.sched_getaffinity(0))]
+    cpus = []
+    for line in lscpu_output.splitlines():
+        if not line.strip() or line.startswith('#'):
+            continue
+        fields = [int(f) if f else 0 for f in line.split(',')]
+        cpus.append(Cpu(*fields[:4]))
+    return cpus
+
+
+def replica_bindings(cpus, num_replicas, use_hyperthreads=True):
+    """Splits the physical cores of `cpus` into `num_replicas` bindings.
+
+    Args:
+        cpus: `Cpu`s from `read_topology`.
+        num_replicas: number of core sets; the cores that do not divide evenly
+            are left unused.
+        use_hyperthreads: whether the bindings include the hyperthread siblings
+            of their cores.
+
+    Returns:
+        A list of `Binding`s.
+
+    Raises:
+        ValueError: there are fewer physical cores than replicas.
+    """
+    cores = collections.OrderedDict()
+    for cpu in sorted(cpus, key=lambda c: (c.node, c.socket, c.core, c.cpu)):
+        cores.setdefault((cpu.node, cpu.socket, cpu.core), []).append(cpu)
+    cores = list(cores.values())
+    cores_per_replica = len(cores) // num_replicas
+    if not cores_per_replica:
+        raise ValueError('%d replicas need at least as many cores, the host has %d.'
+                         % (num_replicas, len(cores)))
+    bindings = []
+    for i in range(num_replicas):
+        replica_cores = cores[i * cores_per_replica:(i + 1) * cores_per_replica]
+        replica_cpus = sorted(c.cpu for siblings in replica_cores
+                              for c in (siblings if use_hyperthreads else siblings[:1]))
+        nodes = sorted(set(siblings[0].node for siblings in replica_cores))
+        bindings.append(Binding(replica_cpus, cores_per_replica, nodes))
+    return bindings
+
+
+def _cpu_list(cpus):
+    """Formats CPUs as numactl ranges, e.g. '0-3,32-35'."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join('%d-%d' % (a, b) if a != b else '%d' % a for a, b in ranges)
+
+
+def numactl_prefix(binding):
+    """The numactl prefix running a command on `binding`."""
+    return ['numactl', '--physcpubind=' + _cpu_list(binding.cpus),
+            '--membind=' + ','.join(str(n) for n in binding.nodes)]
+
+
+def pin_current_process(binding):
+    """Pins the current process to the CPUs of `binding`, without memory binding."""
+    os.sched_setaffinity(0, binding.cpus)
+
+
+if __name__ == '__main__':
+    topology = read_topology()
+    print('%d CPUs, %d cores, %d NUMA nodes' % (
+        len(topology), len(set((c.node, c.socket, c.core) for c in topology)),
+        len(set(c.node for c in topology))))
+    for binding in replica_bindings(topology, int(sys.argv[1]) if len(sys.argv) > 1 else 1):
+        print('%d cores: %s' % (binding.num_cores, ' '.join(numactl_prefix(binding))))
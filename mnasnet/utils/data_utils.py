@@ -74,7 +74,8 @@ def get_synth_input_fn(batch_size, height, width, num_channels, data_format, num
     return data
 
 
-def get_tfrecords_input_fn(filenames, batch_size, height, width, training, distort_color, num_threads, deterministic):
+def get_tfrecords_input_fn(filenames, batch_size, height, width, training, distort_color, num_threads, deterministic,
+                           input_stats=None):
 
     shuffle_buffer_size = 4096
 
@@ -100,6 +101,8 @@ def get_tfrecords_input_fn(filenames, batch_size, height, width, training, disto
             prefetch_input_elements=16
         )
     )
+    if input_stats:
+        ds = input_stats.tap(ds, 'read')
 
     counter = tf.data.Dataset.range(sys.maxsize)
     ds = tf.data.Dataset.zip((ds, counter))
@@ -107,6 +110,9 @@ def get_tfrecords_input_fn(filenames, batch_size, height, width, training, disto
     def preproc_func(record, counter_):
         return image_processing.preprocess_image_record(record, height, width, _NUM_CHANNELS, training)
 
+    if input_stats:
+        preproc_func = input_stats.wrap('parse', preproc_func)
+
     ds = ds.cache()
     
     if training:
@@ -115,6 +121,8 @@ def get_tfrecords_input_fn(filenames, batch_size, height, width, training, disto
 
     else:
         ds = ds.repeat()
+    if input_stats:
+        ds = input_stats.tap(ds, 'shuffle')
 
     ds = ds.apply(
         tf.data.experimental.map_and_batch(
@@ -124,12 +132,17 @@ def get_tfrecords_input_fn(filenames, batch_size, height, width, training, disto
             drop_remainder=True,
         )
     )
+    if input_stats:
+        ds = input_stats.tap(ds, 'batch')
 
     ds = ds.prefetch(buffer_size=tf.contrib.data.AUTOTUNE)
+    if input_stats:
+        ds = input_stats.tap(ds, 'prefetch')
+        ds = input_stats.attach(ds)
 
     return ds
 
-def get_inference_input_fn(filenames, height, width, num_threads):
+def get_inference_input_fn(filenames, height, width, num_threads, batch_size=1):
     
     ds = tf.data.Dataset.from_tensor_slices(filenames)
 
@@ -143,7 +156,7 @@ def get_inference_input_fn(filenames, height, width, num_threads):
         tf.data.experimental.map_and_batch(
             map_func=preproc_func,
             num_parallel_calls=num_threads,
-            batch_size=1
+            batch_size=batch_size
         )
     )
 
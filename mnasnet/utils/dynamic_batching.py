@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Dynamic batching of concurrent inference requests.
+
+Requests are queued by `DynamicBatcher.submit` and coalesced by worker threads
+into one model call: a batch is run as soon as it holds `max(batch_sizes)`
+images, or when its first request has waited `max_queue_delay_ms`. Batches are
+padded, by repeating their last image, to the smallest of `batch_sizes` that
+fits, so the model only ever sees the few shapes it was warmed up with.
+
+Requests that are still queued at their deadline fail with
+`RequestTimeoutError` without being run, and `submit` raises `QueueFullError`
+once `max_queue_size` images are queued, so that an overloaded server sheds
+load instead of queueing without bound.
+
+`StagePool` runs an earlier stage of a request, such as decoding, on a pool
+of threads with a bounded queue of its own, so that the stage overlaps with
+the batches of the model instead of running inside them.
+
+`ServingMetrics` counts requests and tracks the queue depth, queueing, run and
+end-to-end latency, and renders them as JSON or in the Prometheus text format.
+
+Runs standalone as a self-check with a fake model:
+
+    python utils/dynamic_batching.py
+"""
+
+import bisect
+import collections
+import queue
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+
+__all__ = ["DynamicBatcher", "StagePool", "ServingMetrics", "prometheus_text",
+           "QueueFullError", "RequestTimeoutError"]
+
+
+class QueueFullError(Exception):
+    """The queue of the batcher or of a stage is full; retry later."""
+
+
+class RequestTimeoutError(Exception):
+    """The request did not complete before its deadline."""
+
+
+class _Histogram(object):
+    """Cumulative bucket counts, plus a window of recent values for percentiles."""
+
+    BUCKETS = (1., 2., 5., 10., 20., 50., 100., 200., 500., 1000., 2000., 5000.)
+
+    def __init__(self, window=4096):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.
+        self.count = 0
+        self.recent = collections.deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.BUCKETS, value)] += 1
+        self.total += value
+        self.count += 1
+        self.recent.append(value)
+
+    def snapshot(self):
+        if not self.recent:
+            return dict(count=self.count)
+        recent = np.array(self.recent)
+        return dict(count=self.count,
+                    mean=self.total / self.count,
+                    p50=float(np.percentile(recent, 50)),
+                    p90=float(np.percentile(recent, 90)),
+                    p99=float(np.percentile(recent, 99)))
+
+
+class ServingMetrics(object):
+    """Counters, gauges and latency histograms of a served model.
+
+    Args:
+        prefix: prefix of the Prometheus metric names.
+        labels: dict of labels added to every Prometheus sample.
+    """
+
+    COUNTERS = ('requests', 'images', 'batches', 'padded_images', 'rejected',
+                'timed_out', 'failed')
+    HISTOGRAMS = ('queue_ms', 'run_ms', 'request_ms', 'batch_size')
+
+    def __init__(self, prefix='mnasnet_serving', labels=None):
+        self.prefix = prefix
+        self.labels = dict(labels or {})
+        self._lock = threading.Lock()
+        self._counters = collections.OrderedDict((name, 0) for name in self.COUNTERS)
+        self._histograms = collections.OrderedDict(
+            (name, _Histogram()) for name in self.HISTOGRAMS)
+        self._gauges = collections.OrderedDict()
+
+    def inc(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = _Histogram()
+            self._histograms[name].observe(value)
+
+    def gauge(self, name, value_fn):
+        """Reports `value_fn()` as the gauge `name` whenever metrics are read."""
+        self._gauges[name] = value_fn
+
+    def snapshot(self):
+        with self._lock:
+            snapshot = dict(self._counters)
+            snapshot.update((name, h.snapshot()) for name, h in self._histograms.items())
+        snapshot.update((name, value_fn()) for name, value_fn in self._gauges.items())
+        return snapshot
+
+    def families(self):
+        """Yields the (name, type, samples) of every metric family."""
+        def sample(name, value, extra_labels=None):
+            labels = dict(self.labels, **(extra_labels or {}))
+            label_text = ','.join('%s="%s"' % kv for kv in sorted(labels.items()))
+            return '%s_%s%s %s' % (self.prefix, name,
+                                   '{%s}' % label_text if label_text else '', value)
+
+        with self._lock:
+            for name, value in self._counters.items():
+                yield ('%s_%s_total' % (self.prefix, name), 'counter',
+                       [sample(name + '_total', value)])
+            for name, histogram in self._histograms.items():
+                samples = []
+                cumulative = 0
+                for bound, count in zip(histogram.BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    samples.append(sample(name + '_bucket', cumulative, {'le': bound}))
+                samples.append(sample(name + '_sum', histogram.total))
+                samples.append(sample(name + '_count', histogram.count))
+                yield '%s_%s' % (self.prefix, name), 'histogram', samples
+        for name, value_fn in list(self._gauges.items()):
+            yield '%s_%s' % (self.prefix, name), 'gauge', [sample(name, value_fn())]
+
+    def prometheus_text(self):
+        """The metrics in the Prometheus text exposition format."""
+        return prometheus_text([self])
+
+
+def prometheus_text(metrics_list):
+    """The metrics of several `ServingMetrics`, each family under one TYPE line."""
+    families = collections.OrderedDict()
+    for metrics in metrics_list:
+        for name, metric_type, samples in metrics.families():
+            families.setdefault((name, metric_type), []).extend(samples)
+    lines = []
+    for (name, metric_type), samples in families.items():
+        lines.append('# TYPE %s %s' % (name, metric_type))
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
+
+
+class _Request(object):
+
+    def __init__(self, inputs, deadline):
+        self.inputs = inputs
+        self.size = len(inputs)
+        self.enqueue_time = time.time()
+        self.deadline = deadline
+        self.future = futures.Future()
+
+
+def _pad(inputs, batch_size):
+    """Pads `inputs` to `batch_size` rows by repeating its last row."""
+    if len(inputs) == batch_size:
+        return inputs
+    return np.concatenate([inputs, np.repeat(inputs[-1:], batch_size - len(inputs), axis=0)])
+
+
+class DynamicBatcher(object):
+    """Coalesces concurrent requests into padded batches of a model.
+
+    Args:
+        run_fn: runs the model on a [batch_size, ...] numpy array, with
+            batch_size one of `batch_sizes`, and returns a dict of numpy arrays
+            with batch_size rows.
+        batch_sizes: the batch sizes `run_fn` is called with; the largest is
+            the maximum batch size.
+        max_queue_delay_ms: longest time the first request of a batch waits for
+            more requests before the batch is run.
+        max_queue_size: most images queued at once; beyond it `submit` raises
+            `QueueFullError`.
+        timeout_ms: default deadline of a request, from its submission.
+        num_workers: number of batches run concurrently.
+        metrics: optional `ServingMetrics`.
+        run_slots: optional semaphore shared by the batchers of several models,
+            bounding the number of batches they run at once.
+    """
+
+    def __init__(self, run_fn, batch_sizes, max_queue_delay_ms=5., max_queue_size=256,
+                 timeout_ms=1000., num_workers=1, metrics=None, run_slots=None):
+        self.run_fn = run_fn
+        self.batch_sizes = sorted(int(b) for b in batch_sizes)
+        self.max_batch_size = self.batch_sizes[-1]
+        self.max_queue_delay = max_queue_delay_ms / 1e3
+        self.max_queue_size = max_queue_size
+        self.timeout = timeout_ms / 1e3
+        self.metrics = metrics or ServingMetrics()
+        self.metrics.gauge('queue_depth', self.queue_depth)
+        self._run_slots = run_slots
+        self._cond = threading.Condition()
+        self._queue = collections.deque()
+        self._queued_images = 0
+        self._stopped = False
+        self._workers = [threading.Thread(target=self._work, name='batcher-%d' % i)
+                         for i in range(num_workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def queue_depth(self):
+        """The number of images waiting to be batched."""
+        return self._queued_images
+
+    def submit(self, inputs, timeout_ms=None):
+        """Queues a [n, ...] numpy array; returns a future of its outputs.
+
+        Raises:
+            ValueError: the request holds more images than the largest batch.
+            QueueFullError: the queue is full; retry later.
+        """
+        if not 0 < len(inputs) <= self.max_batch_size:
+            raise ValueError('A request holds 1 to %d images, not %d.'
+                             % (self.max_batch_size, len(inputs)))
+        timeout = self.timeout if timeout_ms is None else timeout_ms / 1e3
+        request = _Request(inputs, time.time() + timeout)
+        with self._cond:
+            if self._stopped:
+                raise RuntimeError('The batcher is stopped.')
+            if self._queued_images + request.size > self.max_queue_size:
+                self.metrics.inc('rejected')
+                raise QueueFullError('%d images are already queued.' % self._queued_images)
+            self._queue.append(request)
+            self._queued_images += request.size
+            self._cond.notify()
+        self.metrics.inc('requests')
+        self.metrics.inc('images', request.size)
+        return request.future
+
+    def predict(self, inputs, timeout_ms=None):
+        """Like `submit`, but waits for the outputs of the request."""
+        timeout = self.timeout if timeout_ms is None else timeout_ms / 1e3
+        future = self.submit(inputs, timeout_ms)
+        try:
+            return future.result(timeout)
+        except futures.TimeoutError:
+            future.cancel()
+            self.metrics.inc('timed_out')
+            raise RequestTimeoutError('No result after %.0f ms.' % (1e3 * timeout))
+
+    def stop(self):
+        """Fails the queued requests and stops the workers."""
+        with self._cond:
+            self._stopped = True
+            while self._queue:
+                self._queue.popleft().future.set_exception(RuntimeError('The batcher is stopped.'))
+            self._queued_images = 0
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _next_batch(self):
+        """Waits for a batch of requests; returns None once stopped."""
+        with self._cond:
+            while not self._queue:
+                if self._stopped:
+                    return None
+                self._cond.wait()
+            batch_deadline = self._queue[0].enqueue_time + self.max_queue_delay
+            while self._queued_images < self.max_batch_size and not self._stopped:
+                remaining = batch_deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            now = time.time()
+            requests, size = [], 0
+            while self._queue and size + self._queue[0].size <= self.max_batch_size:
+                request = self._queue.popleft()
+                self._queued_images -= request.size
+                if not request.future.set_running_or_notify_cancel():
+                    continue
+                if request.deadline < now:
+                    self.metrics.inc('timed_out')
+                    request.future.set_exception(RequestTimeoutError('Expired in the queue.'))
+                    continue
+                requests.append(request)
+                size += request.size
+            if self._queue:
+                # Another worker picks up the rest.
+                self._cond.notify()
+            return requests
+
+    def _work(self):
+        while True:
+            requests = self._next_batch()
+            if requests is None:
+                return
+            if requests:
+                self._run(requests)
+
+    def _run(self, requests):
+        if self._run_slots is None:
+            self._run_batch(requests)
+        else:
+            with self._run_slots:
+                self._run_batch(requests)
+
+    def _run_batch(self, requests):
+        start = time.time()
+        inputs = np.concatenate([r.inputs for r in requests])
+        batch_size = self.batch_sizes[bisect.bisect_left(self.batch_sizes, len(inputs))]
+        try:
+            outputs = self.run_fn(_pad(inputs, batch_size))
+        except Exception as e:  # pylint: disable=broad-except
+            self.metrics.inc('failed', len(requests))
+            for request in requests:
+                request.future.set_exception(e)
+            return
+        end = time.time()
+        self.metrics.inc('batches')
+        self.metrics.inc('padded_images', batch_size - len(inputs))
+        self.metrics.observe('batch_size', len(inputs))
+        self.metrics.observe('run_ms', 1e3 * (end - start))
+        offset = 0
+        for request in requests:
+            request.future.set_result(
+                {k: v[offset:offset + request.size] for k, v in outputs.items()})
+            offset += request.size
+            self.metrics.observe('queue_ms', 1e3 * (start - request.enqueue_time))
+            self.metrics.observe('request_ms', 1e3 * (end - request.enqueue_time))
+
+
+class StagePool(object):
+    """Runs `fn` on the inputs of requests on a pool of threads.
+
+    Args:
+        fn: the stage, a function of the inputs of one request.
+        name: name of the stage in the metrics: `<name>_ms` is the run time of
+            `fn` and `<name>_queue_depth` the number of queued requests.
+        num_threads: number of threads running `fn`.
+        max_queue_size: most requests queued at once; beyond it `submit`
+            raises `QueueFullError`.
+        metrics: optional `ServingMetrics`.
+    """
+
+    def __init__(self, fn, name, num_threads=4, max_queue_size=64, metrics=None):
+        self.fn = fn
+        self.name = name
+        self.metrics = metrics or ServingMetrics()
+        self.metrics.gauge(name + '_queue_depth', self.queue_depth)
+        self._queue = queue.Queue(max_queue_size)
+        self._threads = [threading.Thread(target=self._work, name='%s-%d' % (name, i))
+                         for i in range(num_threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def submit(self, inputs):
+        """Queues the inputs of a request; returns a future of `fn(inputs)`."""
+        future = futures.Future()
+        try:
+            self._queue.put_nowait((inputs, future))
+        except queue.Full:
+            self.metrics.inc('rejected')
+            raise QueueFullError('%d requests are already queued for %s.'
+                                 % (self._queue.qsize(), self.name))
+        return future
+
+    def run(self, inputs, timeout_ms):
+        """Like `submit`, but waits for `fn(inputs)`."""
+        future = self.submit(inputs)
+        try:
+            return future.result(timeout_ms / 1e3)
+        except futures.TimeoutError:
+            future.cancel()
+            self.metrics.inc('timed_out')
+            raise RequestTimeoutError('No %s after %.0f ms.' % (self.name, timeout_ms))
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            inputs, future = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            start = time.time()
+            try:
+                outputs = self.fn(inputs)
+            except Exception as e:  # pylint: disable=broad-except
+                future.set_exception(e)
+                continue
+            self.metrics.observe(self.name + '_ms', 1e3 * (time.time() - start))
+            future.set_result(outputs)
+
+
+def _self_check(num_clients=16, requests_per_client=50):
+    """Serves a fake model to concurrent clients and checks every result."""
+    def run_fn(inputs):
+        time.sleep(0.002 + 0.0002 * len(inputs))
+        return {'outputs': inputs * 2}
+
+    batcher = DynamicBatcher(run_fn, [1, 2, 4, 8, 16], max_queue_delay_ms=2., max_queue_size=64)
+    errors = []
+
+    def client(seed):
+        rng = np.random.RandomState(seed)
+        for _ in range(requests_per_client):
+            inputs = rng.rand(rng.randint(1, 5), 3)
+            while True:
+                try:
+                    outputs = batcher.predict(inputs)
+                    break
+                except QueueFullError:
+                    time.sleep(0.001)
+            if not np.array_equal(outputs['outputs'], inputs * 2):
+                errors.append(seed)
+
+    clients = [threading.Thread(target=client, args=(i,)) for i in range(num_clients)]
+    for c in clients:
+        c.start()
+    for c in clients:
+        c.join()
+    batcher.stop()
+    print(batcher.metrics.prometheus_text())
+    snapshot = batcher.metrics.snapshot()
+    assert not errors, 'Wrong outputs for clients %s' % errors
+    assert snapshot['requests'] == num_clients * requests_per_client, snapshot
+    print('Served %d requests in %d batches.' % (snapshot['requests'], snapshot['batches']))
+
+
+if __name__ == '__main__':
+    _self_check()
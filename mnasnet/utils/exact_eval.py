@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Exact evaluation sharded across all ranks.
+
+Every rank evaluates its own slice of the validation records (see
+`ImageNetInput(exact_eval=True)`), with the last batch padded with label -1.
+`metric_fn` accumulates masked sums instead of means, and `evaluate` combines
+the sums of all ranks with a single MPI allreduce, so every validation image is
+counted exactly once.
+"""
+
+import numpy as np
+import tensorflow as tf
+
+__all__ = ["metric_fn", "evaluate"]
+
+_SUM_METRICS = ['top_1_correct', 'top_5_correct', 'num_examples', 'cross_entropy_sum']
+
+
+def _sum_metric(values, name):
+    """Streaming sum of `values`, as a (value, update_op) metric."""
+    with tf.variable_scope(name):
+        total = tf.get_variable(
+            'total', initializer=tf.zeros([], tf.float64), trainable=False,
+            collections=[tf.GraphKeys.LOCAL_VARIABLES, tf.GraphKeys.METRIC_VARIABLES])
+    update_op = tf.assign_add(total, tf.reduce_sum(tf.cast(values, tf.float64)))
+    return tf.identity(total), update_op
+
+
+def metric_fn(labels, logits):
+    """Masked sums of the evaluation metrics; padding has label -1."""
+    mask = tf.cast(tf.greater_equal(labels, 0), tf.float32)
+    safe_labels = tf.maximum(labels, 0)
+    predictions = tf.cast(tf.argmax(logits, axis=1), labels.dtype)
+    top_1 = tf.cast(tf.equal(predictions, safe_labels), tf.float32) * mask
+    top_5 = tf.cast(tf.nn.in_top_k(logits, safe_labels, 5), tf.float32) * mask
+    cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+        labels=safe_labels, logits=logits) * mask
+    return {
+        'top_1_correct': _sum_metric(top_1, 'top_1_correct'),
+        'top_5_correct': _sum_metric(top_5, 'top_5_correct'),
+        'num_examples': _sum_metric(mask, 'num_examples'),
+        'cross_entropy_sum': _sum_metric(cross_entropy, 'cross_entropy_sum'),
+    }
+
+
+def evaluate(estimator, input_fn, checkpoint_path=None, comm=None):
+    """Evaluates the local shard and allreduces the sums across ranks.
+
+    Must be called by every rank. Each rank runs until its shard is
+    exhausted, so ranks do not need to run the same number of steps.
+
+    Returns:
+        A dict with the global top-1/top-5 accuracy, mean cross entropy,
+        number of examples and the evaluated global step.
+    """
+    # Imported here so that the entry points only need mpi4py with --exact_eval.
+    from mpi4py import MPI  # pylint: disable=g-import-not-at-top
+    comm = comm or MPI.COMM_WORLD
+    results = estimator.evaluate(input_fn=input_fn, steps=None,
+                                 checkpoint_path=checkpoint_path)
+    local = np.array([results[name] for name in _SUM_METRICS], np.float64)
+    total = np.zeros_like(local)
+    comm.Allreduce(local, total, op=MPI.SUM)
+    sums = dict(zip(_SUM_METRICS, total))
+
+    num_examples = max(sums['num_examples'], 1.0)
+    return {
+        'top_1_accuracy': sums['top_1_correct'] / num_examples,
+        'top_5_accuracy': sums['top_5_correct'] / num_examples,
+        'cross_entropy': sums['cross_entropy_sum'] / num_examples,
+        'num_examples': int(sums['num_examples']),
+        'global_step': results['global_step'],
+    }
@@ -160,6 +160,8 @@ def preprocess_image_file(filename, height, width, num_channels, is_training=Fal
         
     if is_training:
         # For training, we want to randomize some of the distortions.
+        # A bare image file has no bounding boxes, so sample from the whole image.
+        bbox = tf.zeros([1, 0, 4], dtype=tf.float32)
         image = _crop_and_filp(image, bbox, num_channels)
         image = _resize_image(image, height, width)
     else:
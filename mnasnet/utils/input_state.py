@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Position of a resumable input pipeline, saved next to the checkpoints.
+
+A resumable pipeline reads every epoch in a fixed order derived from
+(seed, epoch): the files of a host are permuted and grouped into rounds of
+`files_per_round` files. Each round interleaves the records of its files in a
+random order drawn from (seed, epoch, round), see `round_order`. The position
+of a host is therefore fully described by the number of records it consumed.
+That number maps to (epoch, round, offset) through the per-file record counts,
+and the offset maps to the first unread record of every file of the round.
+Resuming skips whole epochs and rounds, and seeks every file of the current
+round to its first unread record through the record index, without reading
+the records before it.
+"""
+
+import collections
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+__all__ = ["InputPosition", "InputStateTracker", "InputStateHook", "epoch_rounds",
+           "round_order", "round_starts"]
+
+InputPosition = collections.namedtuple(
+    'InputPosition', ['records_consumed', 'epoch', 'round', 'offset'])
+
+
+def epoch_rounds(num_files, seed, epoch, files_per_round):
+    """Returns the file indices of every round of `epoch`."""
+    order = np.random.RandomState([seed, epoch]).permutation(num_files)
+    return [order[i:i + files_per_round].tolist()
+            for i in range(0, num_files, files_per_round)]
+
+
+def round_order(record_counts, seed, epoch, round_index):
+    """The file of every record of a round, as indices into `record_counts`.
+
+    Every file appears as many times as it has records, in a random order, so
+    the records of each file are read in file order and the files are mixed.
+    """
+    files = np.repeat(np.arange(len(record_counts), dtype=np.int64), record_counts)
+    return np.random.RandomState([seed, epoch, round_index]).permutation(files)
+
+
+def round_starts(order, offset, num_files):
+    """The number of records of each of `num_files` files read before `offset`."""
+    return np.bincount(order[:offset], minlength=num_files)
+
+
+class InputStateTracker(object):
+    """Tracks and persists the position of one host's input pipeline.
+
+    Args:
+        state_dir: directory where the per-checkpoint state files are written,
+            usually `<model_dir>/input_state`.
+        record_counts: record count of each file of this host, in the order
+            the files are given to the pipeline.
+        host_index: index of this host (rank).
+        num_hosts: total number of hosts.
+        seed: seed of the per-epoch file permutation.
+        files_per_round: number of files interleaved together.
+    """
+
+    def __init__(self, state_dir, record_counts, host_index, num_hosts, seed,
+                 files_per_round):
+        self.state_dir = state_dir
+        self.record_counts = list(record_counts)
+        self.host_index = host_index
+        self.num_hosts = num_hosts
+        self.seed = seed
+        self.files_per_round = files_per_round
+        self.epoch_records = sum(self.record_counts)
+        if not self.epoch_records:
+            raise ValueError('Host %d has no records to read.' % host_index)
+        self._start_step = 0
+        self._start_records = 0
+        self._batch_size = None
+
+    def state_file(self, global_step):
+        return os.path.join(self.state_dir,
+                            'step-%d.host-%d.json' % (global_step, self.host_index))
+
+    def locate(self, records_consumed):
+        """Maps a number of consumed records to an `InputPosition`."""
+        epoch, remainder = divmod(records_consumed, self.epoch_records)
+        rounds = epoch_rounds(len(self.record_counts), self.seed, epoch,
+                              self.files_per_round)
+        for round_index, files in enumerate(rounds):
+            round_records = sum(self.record_counts[i] for i in files)
+            if remainder < round_records:
+                return InputPosition(records_consumed, epoch, round_index, remainder)
+            remainder -= round_records
+        raise AssertionError('Position %d is past the end of epoch %d' %
+                             (records_consumed, epoch))
+
+    def _latest_state(self, global_step):
+        """Returns the most recent state saved at or before `global_step`."""
+        pattern = os.path.join(self.state_dir, 'step-*.host-%d.json' % self.host_index)
+        latest_step, latest_file = None, None
+        for state_file in tf.gfile.Glob(pattern):
+            step = int(os.path.basename(state_file).split('.')[0][len('step-'):])
+            if step <= global_step and (latest_step is None or step > latest_step):
+                latest_step, latest_file = step, state_file
+        if latest_file is None:
+            return None
+        with tf.gfile.GFile(latest_file, 'r') as f:
+            return json.load(f)
+
+    def restore(self, global_step, batch_size):
+        """Returns the position to resume from after `global_step` steps.
+
+        The latest state saved at or before `global_step` is extrapolated with
+        the batch size it was written with, which accounts for restarts with a
+        different batch size. Without a usable state the position is derived
+        from the step count.
+        """
+        records_consumed = global_step * batch_size
+        state = self._latest_state(global_step) if global_step else None
+        if state is None:
+            if global_step:
+                tf.logging.warning('No input state found for step %d, deriving the '
+                                   'position from the global step.', global_step)
+        elif (state['seed'] != self.seed or
+              state['num_hosts'] != self.num_hosts or
+              state['epoch_records'] != self.epoch_records or
+              state['files_per_round'] != self.files_per_round):
+            tf.logging.warning(
+                'Input state of step %d does not match the current input pipeline, '
+                'deriving the position from the global step.', state['global_step'])
+        else:
+            records_consumed = (state['records_consumed'] +
+                                (global_step - state['global_step']) * state['batch_size'])
+
+        self._start_step = global_step
+        self._start_records = records_consumed
+        self._batch_size = batch_size
+        position = self.locate(records_consumed)
+        tf.logging.info('Host %d resumes its input at epoch %d round %d offset %d.',
+                        self.host_index, position.epoch, position.round,
+                        position.offset)
+        return position
+
+    def position(self, global_step):
+        """Returns the position of the pipeline after `global_step` steps."""
+        consumed = (self._start_records +
+                    (global_step - self._start_step) * self._batch_size)
+        return self.locate(consumed)
+
+    def save(self, global_step):
+        position = self.position(global_step)
+        state = dict(position._asdict())
+        state.update(global_step=global_step,
+                     seed=self.seed,
+                     host_index=self.host_index,
+                     num_hosts=self.num_hosts,
+                     batch_size=self._batch_size,
+                     epoch_records=self.epoch_records,
+                     files_per_round=self.files_per_round)
+        if not tf.gfile.Exists(self.state_dir):
+            tf.gfile.MakeDirs(self.state_dir)
+        state_file = self.state_file(global_step)
+        tmp_file = state_file + '.tmp'
+        with tf.gfile.GFile(tmp_file, 'w') as f:
+            json.dump(state, f, sort_keys=True)
+        tf.gfile.Rename(tmp_file, state_file, overwrite=True)
+
+
+class InputStateHook(tf.train.SessionRunHook):
+    """Saves the input position at the steps at which checkpoints are written.
+
+    Only the chief writes checkpoints under Horovod, so every host runs this
+    hook with the checkpoint interval instead of listening to the saver.
+
+    Args:
+        get_tracker: callable returning the `InputStateTracker` of the current
+            input pipeline, or None if the pipeline is not resumable. It is
+            called once the input_fn of the current graph has run.
+        save_steps: checkpoint interval in steps.
+    """
+
+    def __init__(self, get_tracker, save_steps):
+        self._get_tracker = get_tracker
+        self._save_steps = save_steps
+        self._tracker = None
+        self._global_step_tensor = None
+        self._last_saved_step = None
+
+    def begin(self):
+        self._tracker = self._get_tracker()
+        self._global_step_tensor = tf.train.get_global_step()
+        if self._global_step_tensor is None:
+            raise RuntimeError('Global step should be created to use InputStateHook.')
+
+    def after_create_session(self, session, coord):
+        self._last_saved_step = session.run(self._global_step_tensor)
+
+    def before_run(self, run_context):
+        return tf.train.SessionRunArgs(self._global_step_tensor)
+
+    def after_run(self, run_context, run_values):
+        global_step = run_values.results + 1
+        if self._tracker and global_step >= self._last_saved_step + self._save_steps:
+            self._tracker.save(global_step)
+            self._last_saved_step = global_step
+
+    def end(self, session):
+        global_step = session.run(self._global_step_tensor)
+        if self._tracker and global_step != self._last_saved_step:
+            self._tracker.save(global_step)
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Opt-in per-stage instrumentation of the tf.data input pipelines.
+
+Stages are tapped by name (e.g. 'read', 'shuffle', 'parse', 'batch',
+'prefetch'). When the tf.data stats API is available each tap is a
+`latency_stats` node feeding a `StatsAggregator`, otherwise a wall-clock
+tap is used. The wall-clock taps make a Python call per element, so they
+only tap the batch stages, where that is one call per batch; the record
+stages ('read', 'shuffle') are only reported by the stats API. The prefetch
+buffer occupancy is derived from the element counts on either side of it,
+which both kinds of taps count exactly. `InputStatsHook` writes a summary per
+interval to `<log_dir>/input_stats_rank<rank>.jsonl`.
+"""
+
+import json
+import os
+import sys
+import threading
+import time
+
+import tensorflow as tf
+
+__all__ = ["InputPipelineStats", "InputStatsHook"]
+
+# Buffers whose occupancy is reported, as (buffer, upstream tap, downstream tap).
+# Both taps count the same elements, unlike the taps around a shuffle buffer,
+# which replays a cached epoch.
+_BUFFERS = [('prefetch', 'batch', 'prefetch')]
+
+# Stages of single records rather than batches.
+_RECORD_STAGES = ('read', 'shuffle')
+
+
+def _stats_api_available():
+    experimental = getattr(tf.data, 'experimental', None)
+    return (experimental is not None and
+            hasattr(experimental, 'StatsAggregator') and
+            hasattr(experimental, 'latency_stats'))
+
+
+class _StageCounter(object):
+    """Python-side accumulator for the sampled wall-clock taps."""
+
+    def __init__(self):
+        self.elements = 0
+        self.latency_secs = 0.0
+        self.latency_samples = 0
+        self.latency_max = 0.0
+        self.last_index = None
+        self.last_time = None
+
+    def snapshot(self):
+        return dict(elements=self.elements,
+                    latency_secs=self.latency_secs,
+                    latency_samples=self.latency_samples,
+                    latency_max=self.latency_max)
+
+
+class InputPipelineStats(object):
+    """Collects per-stage latency, throughput and buffer occupancy.
+
+    Args:
+        log_dir: directory for the JSON-lines summaries.
+        rank: rank of this process, used in the output file name.
+        batch_size: per-rank batch size, used for the images/sec figure.
+        sample_every: the map functions of `wrap` are timed one call out of
+            `sample_every`, which keeps their cost to a Python call every few
+            hundred records.
+        use_stats_api: force the tf.data stats API on or off. Defaults to
+            using it whenever this TensorFlow build provides it.
+    """
+
+    def __init__(self, log_dir, rank=0, batch_size=None, sample_every=256,
+                 use_stats_api=None):
+        self.log_dir = log_dir
+        self.rank = rank
+        self.batch_size = batch_size
+        self.sample_every = max(1, int(sample_every))
+        if use_stats_api is None:
+            use_stats_api = _stats_api_available()
+        self.use_stats_api = use_stats_api
+        self.summary_op = None
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    @property
+    def log_file(self):
+        return os.path.join(self.log_dir, 'input_stats_rank%d.jsonl' % self.rank)
+
+    def _tag(self, stage):
+        return 'input_pipeline/%s' % stage
+
+    def _counter(self, stage):
+        with self._lock:
+            if stage not in self._counters:
+                self._counters[stage] = _StageCounter()
+            return self._counters[stage]
+
+    def _record_arrival(self, stage):
+        counter = self._counter(stage)
+
+        def record(index):
+            now = time.time()
+            with self._lock:
+                index = int(index)
+                if counter.last_index is not None and index > counter.last_index:
+                    # Mean inter-arrival time over the elements since the last sample.
+                    latency = (now - counter.last_time) / (index - counter.last_index)
+                    counter.latency_secs += latency
+                    counter.latency_samples += 1
+                    counter.latency_max = max(counter.latency_max, latency)
+                counter.elements = max(counter.elements, index + 1)
+                counter.last_index = index
+                counter.last_time = now
+            return index
+
+        return record
+
+    def _record_duration(self, stage):
+        counter = self._counter(stage)
+
+        def record(duration):
+            duration = float(duration)
+            with self._lock:
+                counter.elements += self.sample_every
+                counter.latency_secs += duration
+                counter.latency_samples += 1
+                counter.latency_max = max(counter.latency_max, duration)
+            return duration
+
+        return record
+
+    def tap(self, dataset, stage):
+        """Records the element latency observed at the output of `stage`."""
+        if self.use_stats_api:
+            return dataset.apply(tf.data.experimental.latency_stats(self._tag(stage)))
+        if stage in _RECORD_STAGES:
+            # A sequential map per record would slow down the pipeline it measures.
+            return dataset
+
+        record = self._record_arrival(stage)
+
+        def _tap(element, index):
+            # Every batch is recorded: sampled counts would make the occupancy
+            # of the buffers between two taps a multiple of the sampling rate.
+            recorded = tf.py_func(record, [index], tf.int64, stateful=True)
+            with tf.control_dependencies([recorded]):
+                return tf.contrib.framework.nest.map_structure(tf.identity, element)
+
+        dataset = tf.data.Dataset.zip((dataset, tf.data.Dataset.range(sys.maxsize)))
+        return dataset.map(_tap)
+
+    def wrap(self, stage, map_fn):
+        """Wraps a `Dataset.map` function to time each call of it."""
+        record = self._record_duration(stage)
+        sample_rate = 1.0 / self.sample_every
+
+        def _timed_fn(*args):
+            start = tf.timestamp()
+            with tf.control_dependencies([start]):
+                outputs = map_fn(*args)
+            flat_outputs = tf.contrib.framework.nest.flatten(outputs)
+            with tf.control_dependencies(flat_outputs):
+                duration = tf.timestamp() - start
+            sampled = tf.cond(
+                tf.random_uniform([]) < sample_rate,
+                lambda: tf.py_func(record, [duration], tf.float64, stateful=True),
+                lambda: duration)
+            with tf.control_dependencies([sampled]):
+                return tf.contrib.framework.nest.map_structure(tf.identity, outputs)
+
+        return _timed_fn
+
+    def attach(self, dataset):
+        """Attaches the stats aggregator to the final dataset, if any."""
+        if not self.use_stats_api:
+            return dataset
+        aggregator = tf.data.experimental.StatsAggregator()
+        if hasattr(tf.data, 'Options'):
+            options = tf.data.Options()
+            options.experimental_stats.aggregator = aggregator
+            dataset = dataset.with_options(options)
+        else:
+            dataset = dataset.apply(tf.data.experimental.set_stats_aggregator(aggregator))
+        self.summary_op = aggregator.get_summary()
+        return dataset
+
+    def wall_clock_snapshot(self):
+        with self._lock:
+            return dict((stage, counter.snapshot())
+                        for stage, counter in self._counters.items())
+
+
+def _parse_stats_summary(serialized):
+    """Turns a serialized aggregator summary into the snapshot format."""
+    summary = tf.Summary()
+    summary.ParseFromString(serialized)
+    snapshot = {}
+    for value in summary.value:
+        if not value.tag.startswith('input_pipeline/') or not value.HasField('histo'):
+            continue
+        stage = value.tag.split('/', 1)[1]
+        # latency_stats records microseconds.
+        snapshot[stage] = dict(elements=int(value.histo.num),
+                               latency_secs=value.histo.sum * 1e-6,
+                               latency_samples=int(value.histo.num),
+                               latency_max=value.histo.max * 1e-6)
+    return snapshot
+
+
+class InputStatsHook(tf.train.SessionRunHook):
+    """Periodically writes the input pipeline statistics as JSON lines."""
+
+    def __init__(self, input_stats, every_secs=60):
+        self._stats = input_stats
+        self._every_secs = every_secs
+        self._summary_op = None
+        self._last_time = None
+        self._last_snapshot = {}
+        self._steps = 0
+
+    def begin(self):
+        self._summary_op = None
+        summary_op = self._stats.summary_op
+        if summary_op is not None and summary_op.graph is tf.get_default_graph():
+            self._summary_op = summary_op
+        if not tf.gfile.Exists(self._stats.log_dir):
+            tf.gfile.MakeDirs(self._stats.log_dir)
+
+    def after_create_session(self, session, coord):
+        self._last_time = time.time()
+        self._last_snapshot = self._snapshot(session)
+        self._steps = 0
+
+    def after_run(self, run_context, run_values):
+        self._steps += 1
+        now = time.time()
+        if now - self._last_time >= self._every_secs:
+            self._write(run_context.session, now)
+
+    def end(self, session):
+        if self._steps:
+            self._write(session, time.time())
+
+    def _snapshot(self, session):
+        snapshot = self._stats.wall_clock_snapshot()
+        if self._summary_op is not None:
+            snapshot.update(_parse_stats_summary(session.run(self._summary_op)))
+        return snapshot
+
+    def _write(self, session, now):
+        snapshot = self._snapshot(session)
+        interval = max(now - self._last_time, 1e-6)
+
+        stages = {}
+        for stage, current in snapshot.items():
+            previous = self._last_snapshot.get(stage, {})
+            elements = current['elements'] - previous.get('elements', 0)
+            samples = current['latency_samples'] - previous.get('latency_samples', 0)
+            latency = current['latency_secs'] - previous.get('latency_secs', 0.0)
+            stages[stage] = {
+                'elements': current['elements'],
+                'elements_per_sec': elements / interval,
+                'latency_ms_mean': 1e3 * latency / samples if samples else None,
+                'latency_ms_max': 1e3 * current['latency_max'],
+            }
+
+        buffers = {}
+        for name, upstream, downstream in _BUFFERS:
+            if upstream in snapshot and downstream in snapshot:
+                buffers[name] = {'occupancy': max(
+                    0, snapshot[upstream]['elements'] - snapshot[downstream]['elements'])}
+
+        record = {
+            'time': now,
+            'rank': self._stats.rank,
+            'interval_secs': interval,
+            'steps': self._steps,
+            'source': 'stats_api' if self._summary_op is not None else 'wall_clock',
+            'stages': stages,
+            'buffers': buffers,
+        }
+        if self._stats.batch_size:
+            record['images_per_sec'] = self._steps * self._stats.batch_size / interval
+
+        with tf.gfile.GFile(self._stats.log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        self._last_time = now
+        self._last_snapshot = snapshot
+        self._steps = 0
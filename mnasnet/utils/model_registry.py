@@ -0,0 +1,313 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Lazily loaded models of one serving process, evicted least recently used.
+
+`ModelRegistry.use(name)` loads a model with `load_fn(name)` the first time
+it is asked for, and the models stay loaded until the memory they take goes
+over the budget. Then the least recently used models that no request is using
+are closed, until the others fit in the budget.
+
+The memory of a model is the growth of the resident set size of the process
+while it loads and warms up; loads are serialized so that the growth of one
+load is not counted against another.
+
+`replace` loads a new version of a model in the background and swaps it in
+atomically: requests started before the swap finish on the old version, which
+is closed once the last of them is done. The number of requests of every model is
+kept in `stats_file`, saved every `stats_interval_secs` and on `close`, so that
+a restarted server can pre-load the models that were the most requested with
+`prewarm`.
+"""
+
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+import tensorflow as tf
+
+__all__ = ["ModelRegistry", "UnknownModelError", "rss_bytes"]
+
+
+class UnknownModelError(KeyError):
+    """The registry has no model of that name."""
+
+
+def rss_bytes():
+    """The resident set size of this process, 0 if it is unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+class _Entry(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.model = None
+        self.memory_bytes = 0
+        self.pinned = False
+        self.refs = 0
+        # Replaced by a new version, closed with its last request.
+        self.retired = False
+        self.load_lock = threading.Lock()
+
+
+class ModelRegistry(object):
+    """Loads models on demand and evicts them under a memory budget.
+
+    Args:
+        load_fn: loads and warms up the model of a name; the model has a
+            `close()` method.
+        names_fn: returns the names that can be loaded.
+        memory_budget_mb: memory the loaded models may take; 0 for no limit.
+        stats_file: optional JSON file of the number of requests per model.
+        metrics: optional `ServingMetrics` for the registry counters.
+        stats_interval_secs: seconds between saves of `stats_file`; 0 to only
+            save it on `close`.
+    """
+
+    def __init__(self, load_fn, names_fn, memory_budget_mb=0, stats_file=None, metrics=None,
+                 stats_interval_secs=0):
+        self.load_fn = load_fn
+        self.names_fn = names_fn
+        self.memory_budget = memory_budget_mb * 2**20
+        self.stats_file = stats_file
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        # Least recently used first.
+        self._entries = collections.OrderedDict()
+        self._requests = collections.Counter()
+        if stats_file and tf.gfile.Exists(stats_file):
+            with tf.gfile.GFile(stats_file) as f:
+                self._requests.update(json.load(f))
+        if metrics:
+            metrics.gauge('loaded_models', lambda: len(self._entries))
+            metrics.gauge('loaded_models_bytes', self.memory_bytes)
+        self._stop = threading.Event()
+        if stats_file and stats_interval_secs:
+            thread = threading.Thread(target=self._save_stats_every,
+                                      args=(stats_interval_secs,), name='model-stats')
+            thread.daemon = True
+            thread.start()
+
+    def memory_bytes(self):
+        with self._lock:
+            return sum(e.memory_bytes for e in self._entries.values())
+
+    def names(self):
+        with self._lock:
+            loaded = list(self._entries)
+        return sorted(set(loaded) | set(self.names_fn()))
+
+    def pin(self, name, model):
+        """Adds a loaded model that is never evicted."""
+        entry = _Entry(name)
+        entry.model = model
+        entry.pinned = True
+        with self._lock:
+            self._entries[name] = entry
+
+    @contextlib.contextmanager
+    def use(self, name):
+        """Yields the model `name`, loading it first if needed.
+
+        Raises:
+            UnknownModelError: there is no model `name`.
+        """
+        entry = self._acquire(name)
+        try:
+            if entry.model is None:
+                self._load(entry)
+            yield entry.model
+        finally:
+            self._release(entry)
+
+    def _acquire(self, name):
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                if name not in self.names_fn():
+                    raise UnknownModelError(name)
+                entry = self._entries[name] = _Entry(name)
+            self._entries.move_to_end(name)
+            entry.refs += 1
+            self._requests[name] += 1
+            return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.refs -= 1
+            close = entry.retired and not entry.refs
+        if close:
+            entry.model.close()
+
+    def peek(self, name):
+        """The loaded model `name`, or None; not counted as a request."""
+        with self._lock:
+            entry = self._entries.get(name)
+            return entry.model if entry else None
+
+    def replace(self, name, load_fn, check_fn=None):
+        """Loads a new model for `name` and swaps it in if `check_fn` accepts it.
+
+        Args:
+            name: the model to replace.
+            load_fn: loads and warms up the new model.
+            check_fn: optional function of the new model, returning a list of
+                problems; the new model is closed if there are any.
+
+        Returns:
+            The problems of the new model, empty if it was swapped in.
+        """
+        with self._load_lock:
+            rss = rss_bytes()
+            model = load_fn()
+            memory_bytes = max(rss_bytes() - rss, 0)
+        try:
+            problems = check_fn(model) if check_fn else []
+        except Exception:
+            model.close()
+            raise
+        if problems:
+            model.close()
+            return problems
+        entry = _Entry(name)
+        entry.model = model
+        entry.memory_bytes = memory_bytes
+        with self._lock:
+            old = self._entries.get(name)
+            if old:
+                entry.pinned = old.pinned
+                old.retired = True
+            self._entries[name] = entry
+            self._entries.move_to_end(name)
+            close = old is not None and old.model is not None and not old.refs
+        if close:
+            old.model.close()
+        self._evict(keep=name)
+        return []
+
+    def _load(self, entry):
+        with entry.load_lock:
+            if entry.model is not None:
+                return
+            with self._load_lock:
+                start, rss = time.time(), rss_bytes()
+                try:
+                    model = self.load_fn(entry.name)
+                except Exception:
+                    with self._lock:
+                        if self._entries.get(entry.name) is entry:
+                            del self._entries[entry.name]
+                    raise
+                entry.memory_bytes = max(rss_bytes() - rss, 0)
+                entry.model = model
+            tf.logging.info('Loaded %s in %.1fs, %.0f MB.', entry.name, time.time() - start,
+                            entry.memory_bytes / 2.**20)
+            if self.metrics:
+                self.metrics.inc('loads')
+                self.metrics.observe('load_ms', 1e3 * (time.time() - start))
+        self._evict(keep=entry.name)
+
+    def _evict(self, keep):
+        """Evicts idle models, least recently used first, down to the budget."""
+        if not self.memory_budget:
+            return
+        evicted = []
+        with self._lock:
+            used = sum(e.memory_bytes for e in self._entries.values())
+            for name, entry in list(self._entries.items()):
+                if used <= self.memory_budget:
+                    break
+                if name == keep or entry.pinned or entry.model is None or entry.refs:
+                    continue
+                del self._entries[name]
+                used -= entry.memory_bytes
+                evicted.append(entry)
+        for entry in evicted:
+            tf.logging.info('Evicting %s, %.0f MB.', entry.name, entry.memory_bytes / 2.**20)
+            entry.model.close()
+            if self.metrics:
+                self.metrics.inc('evictions')
+        if used > self.memory_budget:
+            tf.logging.warning('The loaded models take %.0f MB, over the budget of %.0f MB.',
+                               used / 2.**20, self.memory_budget / 2.**20)
+
+    def prewarm(self, names=(), top_k=0):
+        """Loads `names` and the `top_k` most requested models of the stats file."""
+        available = set(self.names_fn())
+        hottest = [n for n, _ in self._requests.most_common() if n in available][:top_k]
+        for name in list(names) + hottest:
+            with self.use(name):
+                pass
+
+    def loaded(self):
+        """The (name, model) pairs of the loaded models."""
+        with self._lock:
+            return [(name, e.model) for name, e in self._entries.items() if e.model is not None]
+
+    def status(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            requests = dict(self._requests)
+        return {
+            'memory_budget_mb': self.memory_budget / 2.**20,
+            'models': {
+                e.name: {
+                    'state': 'AVAILABLE' if e.model is not None else 'LOADING',
+                    'memory_mb': e.memory_bytes / 2.**20,
+                    'pinned': e.pinned,
+                    'requests': requests.get(e.name, 0),
+                } for e in entries},
+        }
+
+    def _save_stats_every(self, interval_secs):
+        while not self._stop.wait(interval_secs):
+            try:
+                self.save_stats()
+            except (IOError, OSError, tf.errors.OpError) as e:
+                tf.logging.warning('Saving %s failed: %s', self.stats_file, e)
+
+    def save_stats(self):
+        if not self.stats_file:
+            return
+        with self._lock:
+            requests = dict(self._requests)
+        # Written aside and renamed, so that a server killed while saving
+        # leaves the previous stats whole.
+        temp_file = '%s.tmp-%d' % (self.stats_file, os.getpid())
+        with tf.gfile.GFile(temp_file, 'w') as f:
+            json.dump(requests, f)
+        tf.gfile.Rename(temp_file, self.stats_file, overwrite=True)
+
+    def close(self):
+        self._stop.set()
+        self.save_stats()
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            if entry.model is not None:
+                entry.model.close()
@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Predictions of already seen images, keyed by the hash of their bytes.
+
+An image is keyed by the BLAKE2b digest of its encoded bytes and by the
+version of the model, so that a new export or checkpoint never answers with
+the predictions of the previous one. Predictions are JSON values, e.g. the
+{'classes': [...], 'probabilities': [...]} of mnasnet_serve.py and
+mnasnet_predict.py. Both put how the images reach the model in the version,
+so they share their entries only when they run the same model on the same
+preprocessing.
+
+`PredictionCache` keeps the most recently used predictions in memory and,
+with `disk_dir`, every prediction in one JSON file per image too, so that
+they outlive the process and are shared by the processes using the directory.
+The disk tier drops the oldest files beyond `disk_max_mb`, and both tiers
+ignore predictions older than `ttl_secs`. The files of the other processes
+are only seen when the directory is scanned, which happens whenever the
+bytes written since the last scan reach 1/16 of `disk_max_mb`. The directory
+can therefore overshoot the bound by 1/16 of it per process.
+
+Runs a self-check of both tiers:
+
+    python utils/prediction_cache.py
+"""
+
+import collections
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+__all__ = ["PredictionCache", "model_version"]
+
+# The directory is rescanned every time this fraction of the disk bound is
+# written.
+_RESCAN_FRACTION = 1. / 16
+
+
+def model_version(*parts):
+    """A short version tag of a model, from what identifies it and its outputs."""
+    return hashlib.blake2b('|'.join(str(p) for p in parts).encode('utf-8'),
+                           digest_size=8).hexdigest()
+
+
+class PredictionCache(object):
+    """In-memory LRU of predictions, over an optional directory of them.
+
+    Args:
+        max_entries: number of predictions kept in memory.
+        disk_dir: optional directory of the disk tier.
+        disk_max_mb: size of the disk tier, beyond which its oldest
+            predictions are deleted; 0 for no limit.
+        ttl_secs: age beyond which predictions are ignored; 0 for no limit.
+        metrics: optional `ServingMetrics` for the hit and miss counters.
+    """
+
+    def __init__(self, max_entries=10000, disk_dir=None, disk_max_mb=0, ttl_secs=0,
+                 metrics=None):
+        self.max_entries = max_entries
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_mb * 2**20
+        self.ttl_secs = ttl_secs
+        self.metrics = metrics
+        self._lock = threading.Lock()
+        # key -> (time written, prediction), least recently used first.
+        self._memory = collections.OrderedDict()
+        # path -> size of the disk tier files, oldest first.
+        self._files = collections.OrderedDict()
+        self._disk_bytes = 0
+        # Bytes written since the last scan of the directory.
+        self._unscanned_bytes = 0
+        self._scan_lock = threading.Lock()
+        self._stats = collections.Counter()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._files, self._disk_bytes = self._scan_disk()
+        if metrics:
+            metrics.gauge('cache_hit_rate', self.hit_rate)
+            metrics.gauge('cache_entries', lambda: len(self._memory))
+            metrics.gauge('cache_disk_bytes', lambda: self._disk_bytes)
+
+    @staticmethod
+    def key(data, version):
+        """The key of the encoded image `data` for the model `version`."""
+        return '%s-%s' % (version, hashlib.blake2b(data, digest_size=16).hexdigest())
+
+    def _scan_disk(self):
+        """The (path -> size, oldest first; total size) of the disk tier files."""
+        files = []
+        for dirname, _, basenames in os.walk(self.disk_dir):
+            for basename in basenames:
+                path = os.path.join(dirname, basename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        index = collections.OrderedDict()
+        for _, path, size in sorted(files):
+            index[path] = size
+        return index, sum(index.values())
+
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key[-2:], key + '.json')
+
+    def _expired(self, written):
+        return self.ttl_secs and time.time() - written > self.ttl_secs
+
+    def _count(self, name, value=1):
+        self._stats[name] += value
+        if self.metrics:
+            self.metrics.inc(name, value)
+
+    def get(self, key, num_bytes=0):
+        """The prediction of `key`, or None.
+
+        `num_bytes`, the size of the encoded image, counts as saved on a hit.
+        """
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._memory[key]
+                entry = None
+            if entry is not None:
+                self._memory.move_to_end(key)
+                self._count('cache_hits')
+                self._count('cache_bytes_saved', num_bytes)
+                return entry[1]
+        prediction = self._get_disk(key)
+        with self._lock:
+            if prediction is None:
+                self._count('cache_misses')
+                return None
+            self._put_memory(key, prediction)
+            self._count('cache_hits')
+            self._count('cache_disk_hits')
+            self._count('cache_bytes_saved', num_bytes)
+        return prediction
+
+    def _get_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            if self._expired(os.path.getmtime(path)):
+                self._remove_file(path)
+                return None
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            # Missing, or deleted or being replaced by another process.
+            return None
+
+    def put(self, key, prediction):
+        with self._lock:
+            self._put_memory(key, prediction)
+        if self.disk_dir:
+            self._put_disk(key, prediction)
+
+    def _put_memory(self, key, prediction):
+        self._memory[key] = (time.time(), prediction)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _put_disk(self, key, prediction):
+        path = self._path(key)
+        data = json.dumps(prediction).encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            return
+        with self._lock:
+            self._disk_bytes += len(data) - self._files.pop(path, 0)
+            self._files[path] = len(data)
+            self._unscanned_bytes += len(data)
+            rescan = (self.disk_max_bytes and self._unscanned_bytes >=
+                      _RESCAN_FRACTION * self.disk_max_bytes)
+        if rescan and self._scan_lock.acquire(False):
+            # Counts the files of the other processes sharing the directory.
+            try:
+                files, disk_bytes = self._scan_disk()
+                with self._lock:
+                    self._files, self._disk_bytes = files, disk_bytes
+                    self._unscanned_bytes = 0
+            finally:
+                self._scan_lock.release()
+        with self._lock:
+            evicted = []
+            while self.disk_max_bytes and self._disk_bytes > self.disk_max_bytes:
+                old_path, size = self._files.popitem(last=False)
+                self._disk_bytes -= size
+                evicted.append(old_path)
+        for old_path in evicted:
+            self._remove_file(old_path, indexed=False)
+
+    def _remove_file(self, path, indexed=True):
+        if indexed:
+            with self._lock:
+                self._disk_bytes -= self._files.pop(path, 0)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def hit_rate(self):
+        with self._lock:
+            lookups = self._stats['cache_hits'] + self._stats['cache_misses']
+            return self._stats['cache_hits'] / lookups if lookups else 0.
+
+    def stats(self):
+        """The hit and miss counts, hit rate and size of both tiers."""
+        stats = {name: self._stats[name] for name in (
+            'cache_hits', 'cache_disk_hits', 'cache_misses', 'cache_bytes_saved')}
+        stats['cache_hit_rate'] = self.hit_rate()
+        with self._lock:
+            stats['cache_entries'] = len(self._memory)
+            stats['cache_disk_bytes'] = self._disk_bytes
+        return stats
+
+
+def _self_check():
+    disk_dir = tempfile.mkdtemp()
+    try:
+        version = model_version('/export/mnasnet-a1/1560000000', 5)
+        cache = PredictionCache(max_entries=2, disk_dir=disk_dir, disk_max_mb=1)
+        images = [('image %d' % i).encode('utf-8') * 100 for i in range(3)]
+        keys = [cache.key(image, version) for image in images]
+        assert cache.key(images[0], model_version('other', 5)) != keys[0]
+        for i, key in enumerate(keys):
+            assert cache.get(key, len(images[i])) is None
+            cache.put(key, {'classes': [i], 'probabilities': [1.]})
+        # The first image left the memory tier but is still on disk.
+        assert list(cache._memory) == keys[1:]
+        assert cache.get(keys[0], len(images[0]))['classes'] == [0]
+        assert cache.get(keys[2], len(images[2]))['classes'] == [2]
+        stats = cache.stats()
+        assert stats['cache_hits'] == 2 and stats['cache_disk_hits'] == 1, stats
+        assert stats['cache_bytes_saved'] == len(images[0]) + len(images[2]), stats
+
+        # A new process finds the disk tier, within its size and age limits.
+        reopened = PredictionCache(max_entries=2, disk_dir=disk_dir, ttl_secs=3600)
+        assert reopened.get(keys[1])['classes'] == [1]
+        small = PredictionCache(max_entries=2, disk_dir=disk_dir, disk_max_mb=1e-4)
+        small.put(keys[0], {'classes': [0], 'probabilities': [1.]})
+        assert small.stats()['cache_disk_bytes'] <= 1e-4 * 2**20
+        # A second process filling the directory is seen by the next scan.
+        shared = PredictionCache(max_entries=2, disk_dir=disk_dir, disk_max_mb=2e-3)
+        other = PredictionCache(max_entries=2, disk_dir=disk_dir)
+        for i in range(50):
+            other.put(cache.key(b'other %d' % i, version), {'classes': [i] * 10})
+        # Over 1/16 of the bound, so that it rescans.
+        shared.put(keys[1], {'classes': list(range(40))})
+        assert shared._scan_disk()[1] <= 2e-3 * 2**20, shared._scan_disk()[1]
+        expired = PredictionCache(max_entries=2, disk_dir=disk_dir, ttl_secs=1e-9)
+        assert expired.get(keys[0]) is None
+        print('OK: %s' % json.dumps(stats))
+    finally:
+        shutil.rmtree(disk_dir)
+
+
+if __name__ == '__main__':
+    _self_check()
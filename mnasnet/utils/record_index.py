@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Per-file record counts of TFRecord shards.
+
+Counts come from the DALI index files when they exist (one line per record,
+see create_dali_idx_files.py), otherwise the shard is read once. Counts are
+cached in a JSON file keyed by shard name so later runs start instantly.
+
+The byte offsets of the index files also let `read_records` start a shard at
+any record without reading the records before it.
+"""
+
+import json
+import os
+import struct
+
+import tensorflow as tf
+
+__all__ = ["count_records", "load_record_counts", "read_records", "record_offset",
+           "shard_records"]
+
+# A TFRecord is a uint64 length and its uint32 CRC, the data and its uint32 CRC.
+_HEADER_BYTES = 12
+_FOOTER_BYTES = 4
+
+
+def count_records(filename):
+    count = 0
+    for _ in tf.python_io.tf_record_iterator(filename):
+        count += 1
+    return count
+
+
+def _count_from_index(index_file):
+    with tf.gfile.GFile(index_file, 'r') as f:
+        return sum(1 for line in f if line.strip())
+
+
+def load_record_counts(filenames, index_dir=None, cache_file=None):
+    """Returns the number of records of every file in `filenames`.
+
+    Args:
+        filenames: list of TFRecord file paths.
+        index_dir: optional directory holding `<basename>.idx` DALI index files.
+        cache_file: optional JSON file used to read and persist the counts.
+
+    Returns:
+        A list of record counts, in the order of `filenames`.
+    """
+    cached = {}
+    if cache_file and tf.gfile.Exists(cache_file):
+        with tf.gfile.GFile(cache_file, 'r') as f:
+            cached = json.load(f)
+
+    counts = []
+    updated = False
+    for filename in filenames:
+        name = os.path.basename(filename)
+        if name not in cached:
+            index_file = os.path.join(index_dir, name + '.idx') if index_dir else None
+            if index_file and tf.gfile.Exists(index_file):
+                cached[name] = _count_from_index(index_file)
+            else:
+                tf.logging.info('Counting records of %s', filename)
+                cached[name] = count_records(filename)
+            updated = True
+        counts.append(cached[name])
+
+    if cache_file and updated:
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir and not tf.gfile.Exists(cache_dir):
+            tf.gfile.MakeDirs(cache_dir)
+        tmp_file = cache_file + '.tmp'
+        with tf.gfile.GFile(tmp_file, 'w') as f:
+            json.dump(cached, f, sort_keys=True)
+        tf.gfile.Rename(tmp_file, cache_file, overwrite=True)
+
+    return counts
+
+
+def record_offset(filename, record, index_dir=None):
+    """The byte offset of record `record` of `filename`.
+
+    The offset is the first field of line `record` of the DALI index file
+    when there is one, otherwise the length headers of the records before it
+    are read, without their data.
+    """
+    if not record:
+        return 0
+    index_file = (os.path.join(index_dir, os.path.basename(filename) + '.idx')
+                  if index_dir else None)
+    if index_file and tf.gfile.Exists(index_file):
+        with tf.gfile.GFile(index_file, 'r') as f:
+            lines = (line for line in f if line.strip())
+            for i, line in enumerate(lines):
+                if i == record:
+                    return int(line.split()[0])
+        raise ValueError('%s has no record %d.' % (index_file, record))
+    offset = 0
+    with tf.gfile.GFile(filename, 'rb') as f:
+        for _ in range(record):
+            f.seek(offset)
+            header = f.read(_HEADER_BYTES)
+            if len(header) < _HEADER_BYTES:
+                raise ValueError('%s has no record %d.' % (filename, record))
+            length, = struct.unpack('<Q', header[:8])
+            offset += _HEADER_BYTES + length + _FOOTER_BYTES
+    return offset
+
+
+def read_records(filename, offset=0):
+    """Yields the serialized records of a TFRecord file from byte `offset`."""
+    with tf.gfile.GFile(filename, 'rb') as f:
+        f.seek(offset)
+        while True:
+            header = f.read(_HEADER_BYTES)
+            if len(header) < _HEADER_BYTES:
+                return
+            length, = struct.unpack('<Q', header[:8])
+            data = f.read(length)
+            f.read(_FOOTER_BYTES)
+            yield data
+
+
+def shard_records(record_counts, index, num_shards):
+    """Splits the records of all files into `num_shards` contiguous ranges.
+
+    Shard sizes differ by at most one record, so every record belongs to
+    exactly one shard.
+
+    Returns:
+        The `(file_index, skip, take)` segments of shard `index`.
+    """
+    base, extra = divmod(sum(record_counts), num_shards)
+    start = index * base + min(index, extra)
+    end = start + base + (1 if index < extra else 0)
+
+    segments = []
+    offset = 0
+    for file_index, count in enumerate(record_counts):
+        first, last = max(start, offset), min(end, offset + count)
+        if first < last:
+            segments.append((file_index, first - offset, last - first))
+        offset += count
+    return segments
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Resolution buckets of variable-resolution inference.
+
+A bucket is the (height, width) of the images a graph of static shapes runs.
+Buckets are given as:
+
+  - '<height>x<width>', e.g. '256x320', or '<size>' for a square;
+  - '<height>:<width>', an aspect ratio, e.g. '3:4', sized to about the pixel
+    count of the native resolution of the model, so that the same buckets fit
+    the 224 models and mnasnet-d1-320.
+
+Both sides are rounded to multiples of 32, the output stride of MnasNet.
+
+An image is routed to the bucket nearest to its aspect ratio, and then to its
+pixel count. It is either center-cropped to the aspect ratio of its bucket,
+with the margin of evaluation, and resized to it (`crop_window`), or
+letterboxed: resized to fit the bucket, preserving its aspect ratio, and
+padded (`letterbox`).
+
+Runs a self-check:
+
+    python utils/resolution_buckets.py
+"""
+
+import math
+
+__all__ = ["parse_buckets", "aspect_bucket", "nearest_bucket", "crop_window", "letterbox"]
+
+
+def _round(value, multiple):
+    return max(multiple, int(round(value / multiple)) * multiple)
+
+
+def aspect_bucket(height, width, image_size, multiple=32):
+    """The bucket of the aspect ratio `height`:`width` for a model of `image_size`."""
+    ratio = math.sqrt(float(height) / width)
+    return _round(image_size * ratio, multiple), _round(image_size / ratio, multiple)
+
+
+def parse_buckets(specs, image_size, multiple=32):
+    """The sorted, distinct (height, width) buckets of `specs` for a model of `image_size`."""
+    buckets = set()
+    for spec in specs:
+        spec = spec.strip()
+        try:
+            if ':' in spec:
+                height, width = (float(s) for s in spec.split(':'))
+            else:
+                sides = [int(s) for s in spec.split('x')]
+                height, width = sides if len(sides) == 2 else sides * 2
+        except ValueError:
+            raise ValueError('Bad resolution bucket %r, not <height>x<width>, <size>'
+                             ' or <height>:<width>.' % spec)
+        if min(height, width) <= 0:
+            raise ValueError('Bad resolution bucket %r.' % spec)
+        if ':' in spec:
+            buckets.add(aspect_bucket(height, width, image_size, multiple))
+        else:
+            buckets.add((_round(height, multiple), _round(width, multiple)))
+    return sorted(buckets)
+
+
+def nearest_bucket(height, width, buckets):
+    """The bucket of an image: the nearest in aspect ratio, then in pixel count."""
+    aspect = math.log(float(height) / width)
+    area = math.log(float(height) * width)
+    return min(buckets, key=lambda b: (
+        round(abs(aspect - math.log(float(b[0]) / b[1])), 6),
+        abs(area - math.log(float(b[0]) * b[1]))))
+
+
+def crop_window(height, width, bucket, crop_padding=32):
+    """The (offset_y, offset_x, height, width) of the center crop of an image.
+
+    The crop has the aspect ratio of `bucket` and the margin of evaluation:
+    for a square bucket of size s, it is the center square of s / (s +
+    crop_padding) of the short side, as in `preprocessing`.
+    """
+    bucket_height, bucket_width = bucket
+    short_side = min(bucket_height, bucket_width)
+    scale = float(short_side) / (short_side + crop_padding)
+    crop_height = scale * min(height, width * float(bucket_height) / bucket_width)
+    crop_width = crop_height * bucket_width / bucket_height
+    crop_height = min(height, max(1, int(crop_height)))
+    crop_width = min(width, max(1, int(crop_width)))
+    return ((height - crop_height + 1) // 2, (width - crop_width + 1) // 2,
+            crop_height, crop_width)
+
+
+def letterbox(height, width, bucket):
+    """The size an image is resized to in `bucket`, and its padding.
+
+    Returns:
+        (height, width), ((top, bottom), (left, right)).
+    """
+    bucket_height, bucket_width = bucket
+    scale = min(float(bucket_height) / height, float(bucket_width) / width)
+    resized_height = min(bucket_height, max(1, int(round(height * scale))))
+    resized_width = min(bucket_width, max(1, int(round(width * scale))))
+    top = (bucket_height - resized_height) // 2
+    left = (bucket_width - resized_width) // 2
+    return ((resized_height, resized_width),
+            ((top, bucket_height - resized_height - top),
+             (left, bucket_width - resized_width - left)))
+
+
+def _self_check():
+    specs = ['1:1', '3:4', '4:3', '9:16', '16:9']
+    buckets = parse_buckets(specs, 224)
+    assert buckets == [(160, 288), (192, 256), (224, 224), (256, 192), (288, 160)], buckets
+    assert parse_buckets(specs, 320)[2] == (320, 320)
+    assert parse_buckets(['320', '256x320', '1:1'], 320) == [(256, 320), (320, 320)]
+    for spec in ['0x224', 'big', '3:0']:
+        try:
+            parse_buckets([spec], 224)
+        except ValueError:
+            continue
+        raise AssertionError(spec)
+    assert nearest_bucket(480, 640, buckets) == (192, 256)
+    assert nearest_bucket(1080, 1920, buckets) == (160, 288)
+    assert nearest_bucket(500, 500, buckets + [(320, 320)]) == (320, 320)
+    assert nearest_bucket(100, 100, buckets + [(320, 320)]) == (224, 224)
+    # A square bucket crops as the evaluation preprocessing does.
+    assert crop_window(375, 500, (224, 224)) == (24, 86, 328, 328)
+    offset_y, offset_x, crop_height, crop_width = crop_window(480, 640, (192, 256))
+    assert (crop_height, crop_width) == (411, 548) and offset_y + crop_height <= 480
+    size, padding = letterbox(1080, 1920, (192, 256))
+    assert size == (144, 256) and padding == ((24, 24), (0, 0)), (size, padding)
+    size, padding = letterbox(100, 30, (224, 224))
+    assert size == (224, 67) and sum(padding[1]) == 224 - 67, (size, padding)
+    print('OK: %s' % buckets)
+
+
+if __name__ == '__main__':
+    _self_check()
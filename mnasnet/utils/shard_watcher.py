@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Continuous training input that picks up newly arriving shards.
+
+`ShardWatcher` tracks the training shards of a data directory, or of an
+append-only manifest listing one shard per line. At every epoch boundary of a
+host's input pipeline it looks for new shards, counts their records (only
+the new ones, through the cached per-file counts of `record_index`) and merges
+them into the next epoch, so every record seen so far is sampled uniformly.
+Shards are dealt to hosts round-robin in the order they arrived: their line in
+the manifest, or their modification time. A new shard therefore never moves
+the shards before it to another host, whenever each host notices it.
+
+The training graph is not rebuilt. The current epoch is computed from a
+local `steps_per_epoch` variable that `StepsPerEpochHook` updates whenever the
+watcher has found new records; under Horovod, rank 0 decides the value and
+broadcasts it to every rank at the same global step. The learning rate
+schedule keeps the epoch length the job started with, so that its staircase
+decay never steps back up when the epochs grow.
+"""
+
+import os
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from utils import record_index
+
+__all__ = ["ShardWatcher", "StepsPerEpochHook", "steps_per_epoch_variable"]
+
+STEPS_PER_EPOCH_COLLECTION = 'steps_per_epoch'
+
+
+class ShardWatcher(object):
+    """Discovers new training shards and keeps their record counts.
+
+    Args:
+        data_dir: directory holding the `train-*` shards.
+        manifest: optional append-only file listing one shard per line,
+            relative to `data_dir` or absolute. When set, the directory itself
+            is not listed.
+        index_dir: optional directory of DALI index files used for counting.
+        cache_file: optional JSON file persisting the record counts.
+        settle_secs: when listing the directory, shards modified more recently
+            than this are assumed to be still being written and are left for
+            the next refresh. Shards listed in a manifest are taken as complete.
+        poll_secs: how often to look again while a host has no shard at all.
+    """
+
+    def __init__(self, data_dir, manifest=None, index_dir=None, cache_file=None,
+                 settle_secs=60, poll_secs=30):
+        self.data_dir = data_dir
+        self.manifest = manifest
+        self.index_dir = index_dir
+        self.cache_file = cache_file
+        self.settle_secs = settle_secs
+        self.poll_secs = poll_secs
+        self._lock = threading.Lock()
+        self._record_counts = {}
+        self._filenames = []
+        # Filename -> arrival order key: line of the manifest, or (mtime, name).
+        self._arrival = {}
+        self.version = 0
+
+    @property
+    def num_records(self):
+        with self._lock:
+            return sum(self._record_counts.values())
+
+    def _list_manifest(self):
+        if not tf.gfile.Exists(self.manifest):
+            return []
+        with tf.gfile.GFile(self.manifest, 'r') as f:
+            lines = f.read().split('\n')
+        # The last line is only complete once its newline has been written.
+        filenames = []
+        for line_index, line in enumerate(lines[:-1]):
+            line = line.strip()
+            if line and not line.startswith('#'):
+                filenames.append(((line_index,), os.path.join(self.data_dir, line)))
+        return filenames
+
+    def _list_data_dir(self):
+        now_nanos = time.time() * 1e9
+        filenames = []
+        for filename in tf.gfile.Glob(os.path.join(self.data_dir, 'train-*')):
+            if filename.endswith('.tmp'):
+                continue
+            mtime_nanos = tf.gfile.Stat(filename).mtime_nanos
+            if now_nanos - mtime_nanos < self.settle_secs * 1e9:
+                continue
+            # A shard is only listed once it has settled, so the shards listed
+            # later were modified later.
+            filenames.append(((mtime_nanos, os.path.basename(filename)), filename))
+        return filenames
+
+    def refresh(self):
+        """Looks for new shards; returns the list of shards that were added."""
+        listed = self._list_manifest() if self.manifest else self._list_data_dir()
+        arrival = {}
+        for key, filename in listed:
+            arrival.setdefault(filename, key)
+        with self._lock:
+            new_files = sorted(set(f for f in arrival if f not in self._record_counts))
+        if not new_files:
+            return []
+
+        counts = record_index.load_record_counts(
+            new_files, index_dir=self.index_dir, cache_file=self.cache_file)
+        with self._lock:
+            for filename, count in zip(new_files, counts):
+                if count:
+                    self._record_counts[filename] = count
+                    self._filenames.append(filename)
+                    self._arrival[filename] = arrival[filename]
+            self.version += 1
+        tf.logging.info('Found %d new training shards with %d records, %d records '
+                        'in total.', len(new_files), sum(counts), self.num_records)
+        return new_files
+
+    def host_files(self, index, num_hosts):
+        """Returns the shards of host `index`, waiting until there is one.
+
+        Shards go to hosts round-robin in their order of arrival, so every
+        host has a shard once there are as many shards as hosts. Hosts that
+        have seen different numbers of shards agree on the hosts of the shards
+        they have both seen: a new shard comes after them. It is read from the
+        next epoch of its host that sees it, and by no other host.
+        """
+        while True:
+            self.refresh()
+            with self._lock:
+                files = sorted(self._filenames, key=self._arrival.get)[index::num_hosts]
+            if files:
+                return files
+            tf.logging.info('No training shards for host %d yet (%d shards for %d '
+                            'hosts), checking again in %d seconds.', index,
+                            len(self._filenames), num_hosts, self.poll_secs)
+            time.sleep(self.poll_secs)
+
+    def epoch_filenames(self, index, num_hosts, seed=0):
+        """Yields the shards of host `index` forever, one shuffled epoch at a time."""
+        epoch = 0
+        while True:
+            files = self.host_files(index, num_hosts)
+            for i in np.random.RandomState([seed, epoch]).permutation(len(files)):
+                yield files[i]
+            epoch += 1
+
+
+def steps_per_epoch_variable(initial_value):
+    """Returns a local variable holding the current number of steps per epoch."""
+    variable = tf.get_variable(
+        'steps_per_epoch', initializer=float(initial_value), trainable=False,
+        collections=[tf.GraphKeys.LOCAL_VARIABLES, STEPS_PER_EPOCH_COLLECTION])
+    return variable
+
+
+class StepsPerEpochHook(tf.train.SessionRunHook):
+    """Keeps the `steps_per_epoch` variable in line with the watched shards.
+
+    Args:
+        watcher: the `ShardWatcher` of the training input.
+        global_batch_size: number of records consumed per step by all hosts.
+        broadcast: optional function returning the value of a tensor on the
+            root rank, e.g. `lambda t: hvd.broadcast(t, 0)`. When set, every
+            rank runs it when its session is created and then every
+            `sync_steps` global steps, and assigns the value of the root rank.
+        sync_steps: global steps between two broadcasts.
+    """
+
+    def __init__(self, watcher, global_batch_size, broadcast=None, sync_steps=100):
+        self._watcher = watcher
+        self._global_batch_size = global_batch_size
+        self._broadcast = broadcast
+        self._sync_steps = sync_steps
+        self._assign_op = None
+        self._value = None
+        self._global_step = None
+        self._steps_per_epoch = None
+        self._version = None
+
+    def begin(self):
+        variables = tf.get_collection(STEPS_PER_EPOCH_COLLECTION)
+        if not variables:
+            raise RuntimeError('steps_per_epoch_variable() should be called in the '
+                               'model_fn to use StepsPerEpochHook.')
+        self._value = tf.placeholder(tf.float32, [])
+        value = self._value
+        if self._broadcast is not None:
+            value = self._broadcast(value)
+        self._assign_op = variables[0].assign(value)
+        self._global_step = tf.train.get_global_step()
+        self._version = None
+
+    def _update(self, session):
+        version = self._watcher.version
+        if version == self._version and self._broadcast is None:
+            return
+        steps_per_epoch = max(1, self._watcher.num_records // self._global_batch_size)
+        steps_per_epoch = session.run(self._assign_op,
+                                      feed_dict={self._value: steps_per_epoch})
+        if steps_per_epoch != self._steps_per_epoch:
+            tf.logging.info('Steps per epoch is now %d.', steps_per_epoch)
+        self._steps_per_epoch = steps_per_epoch
+        self._version = version
+
+    def after_create_session(self, session, coord):
+        self._update(session)
+
+    def before_run(self, run_context):
+        if self._broadcast is not None:
+            return tf.train.SessionRunArgs(self._global_step)
+        return None
+
+    def after_run(self, run_context, run_values):
+        if self._broadcast is None:
+            self._update(run_context.session)
+        elif run_values.results % self._sync_steps == 0:
+            # The ranks step in lockstep, so they all broadcast at this step.
+            self._update(run_context.session)
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Warm-up requests of a SavedModel, in the format of TensorFlow Serving.
+
+TensorFlow Serving replays the records of
+<SavedModel>/assets.extra/tf_serving_warmup_requests before it serves a
+model version. Every record is a serialized `PredictionLog` holding a
+`PredictRequest`, whose inputs are serialized `TensorProto`s.
+
+`encode` and `decode` write and read those messages by their protobuf wire
+format, so that neither the writer (export()) nor the readers
+(mnasnet_serve.py, mnasnet_predict.py) depend on the tensorflow-serving-api
+package; the tensors are (de)serialized with TensorFlow, and the records are
+framed as TFRecords.
+
+Runs a self-check of the encoding:
+
+    python utils/warmup_requests.py
+"""
+
+import os
+
+__all__ = ["FILENAME", "path", "encode", "decode"]
+
+FILENAME = 'tf_serving_warmup_requests'
+
+# Field numbers of tensorflow_serving/apis/{prediction_log,predict,model}.proto.
+_PREDICTION_LOG_PREDICT_LOG = 6
+_PREDICT_LOG_REQUEST = 1
+_REQUEST_MODEL_SPEC = 1
+_REQUEST_INPUTS = 2
+_MODEL_SPEC_NAME = 1
+_MODEL_SPEC_SIGNATURE_NAME = 3
+_MAP_ENTRY_KEY = 1
+_MAP_ENTRY_VALUE = 2
+
+# The signature of a request without a signature name.
+_DEFAULT_SIGNATURE = 'serving_default'
+
+
+def path(saved_model_dir):
+    """The warm-up requests file of a SavedModel."""
+    return os.path.join(saved_model_dir, 'assets.extra', FILENAME)
+
+
+def _varint(value):
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if not value:
+            encoded.append(byte)
+            return bytes(encoded)
+        encoded.append(byte | 0x80)
+
+
+def _field(number, payload):
+    """A length-delimited field: a message, string or bytes."""
+    return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+
+
+def _read_varint(data, pos):
+    value, shift = 0, 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def _fields(data):
+    """Yields the (number, payload) of the length-delimited fields of a message."""
+    pos = 0
+    while pos < len(data):
+        key, pos = _read_varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            _, pos = _read_varint(data, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 5:
+            pos += 4
+        elif wire_type == 2:
+            length, pos = _read_varint(data, pos)
+            yield number, data[pos:pos + length]
+            pos += length
+        else:
+            raise ValueError('Unsupported protobuf wire type %d.' % wire_type)
+
+
+def encode(inputs, signature_name=_DEFAULT_SIGNATURE, model_name=''):
+    """A serialized `PredictionLog` of a `PredictRequest`.
+
+    Args:
+        inputs: dict of input name -> serialized `TensorProto`.
+        signature_name: the signature the request runs.
+        model_name: optional name of the model; TensorFlow Serving ignores
+            it when warming up.
+    """
+    model_spec = b''
+    if model_name:
+        model_spec += _field(_MODEL_SPEC_NAME, model_name.encode('utf-8'))
+    model_spec += _field(_MODEL_SPEC_SIGNATURE_NAME, signature_name.encode('utf-8'))
+    request = _field(_REQUEST_MODEL_SPEC, model_spec)
+    for name in sorted(inputs):
+        request += _field(_REQUEST_INPUTS,
+                          _field(_MAP_ENTRY_KEY, name.encode('utf-8')) +
+                          _field(_MAP_ENTRY_VALUE, inputs[name]))
+    return _field(_PREDICTION_LOG_PREDICT_LOG, _field(_PREDICT_LOG_REQUEST, request))
+
+
+def decode(record):
+    """The (signature name, inputs) of a serialized `PredictionLog`.
+
+    The inputs are a dict of input name -> serialized `TensorProto`. Returns
+    None for the logs of other requests than predict ones.
+    """
+    for number, predict_log in _fields(record):
+        if number != _PREDICTION_LOG_PREDICT_LOG:
+            continue
+        for number, request in _fields(predict_log):
+            if number != _PREDICT_LOG_REQUEST:
+                continue
+            signature_name, inputs = _DEFAULT_SIGNATURE, {}
+            for number, value in _fields(request):
+                if number == _REQUEST_MODEL_SPEC:
+                    for spec_number, spec_value in _fields(value):
+                        if spec_number == _MODEL_SPEC_SIGNATURE_NAME and spec_value:
+                            signature_name = spec_value.decode('utf-8')
+                elif number == _REQUEST_INPUTS:
+                    # Proto3 leaves out empty keys and values.
+                    entry = dict(_fields(value))
+                    inputs[entry.get(_MAP_ENTRY_KEY, b'').decode('utf-8')] = entry.get(
+                        _MAP_ENTRY_VALUE, b'')
+            return signature_name, inputs
+    return None
+
+
+def _self_check():
+    tensor = b'\x08\x07\x12\x04\x12\x02\x08\x02' + b'\x42\x03abc' * 2 + b'\x42' + _varint(300) + b'x' * 300
+    record = encode({'image_bytes': tensor}, 'classify', 'mnasnet')
+    assert decode(record) == ('classify', {'image_bytes': tensor}), decode(record)
+    assert decode(encode({})) == (_DEFAULT_SIGNATURE, {})
+    # A PredictionLog of a classify request, with log metadata and varints.
+    assert decode(b'\x0a\x02\x08\x01' + _field(2, b'\x08\x96\x01')) is None
+    assert _read_varint(_varint(2**40 + 5), 0) == (2**40 + 5, 6)
+    try:
+        from tensorflow_serving.apis import prediction_log_pb2  # pylint: disable=g-import-not-at-top
+    except ImportError:
+        print('OK, without tensorflow_serving to compare with.')
+        return
+    log = prediction_log_pb2.PredictionLog.FromString(record)
+    assert log.predict_log.request.model_spec.signature_name == 'classify'
+    assert log.predict_log.request.inputs['image_bytes'].SerializeToString() == tensor
+    assert log.SerializeToString(deterministic=True) == record
+    print('OK')
+
+
+if __name__ == '__main__':
+    _self_check()
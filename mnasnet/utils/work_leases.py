@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Copyright 2019 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of
+# the Software, and to permit persons to whom the Software is furnished to do so.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS
+# FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR
+# COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER
+# IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+"""Dynamic file assignment across ranks with leases handed out by rank 0.
+
+Instead of a static `shard(size, rank)`, every rank asks the coordinator on
+rank 0 for the next file whenever its reader needs one, so ranks that read
+faster simply read more files. The coordinator hands out each file exactly
+once per epoch, in a permutation seeded by (seed, epoch), and moves on to the
+next epoch when the current one is exhausted.
+
+A lease is outstanding from the moment it is granted until the reader has
+gone past the last record of its file, marked by an end-of-file element of
+`make_leased_dataset`, and `window` more files of the rank have ended, which
+covers the records still in the shuffle and prefetch buffers. Its state
+(epoch, pending and outstanding files) is saved with the checkpoints and
+outstanding leases are handed out again after a restart, so a file that was
+being read when the job stopped is read again rather than lost.
+
+Runs standalone as a self-check on localhost:
+
+    mpirun -np 4 python utils/work_leases.py
+"""
+
+import atexit
+import collections
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+__all__ = ["LeaseCoordinator", "LeaseClient", "start", "make_leased_dataset"]
+
+_REQUEST_TAG = 77
+_REPLY_TAG = 78
+
+Lease = collections.namedtuple('Lease', ['lease_id', 'epoch', 'file_index'])
+
+
+class LeaseCoordinator(object):
+    """Hands out file leases; lives on rank 0.
+
+    Args:
+        num_files: number of files in the dataset.
+        seed: seed of the per-epoch file permutation.
+        state_dir: directory for the checkpointed lease state.
+    """
+
+    def __init__(self, num_files, seed, state_dir=None):
+        self.num_files = num_files
+        self.seed = seed
+        self.state_dir = state_dir
+        self._lock = threading.Lock()
+        self._epoch = -1
+        self._pending = collections.deque()
+        self._outstanding = collections.OrderedDict()
+        self._next_lease_id = 0
+        self._granted = collections.Counter()
+        self._start_epoch(0)
+
+    def _start_epoch(self, epoch):
+        self._epoch = epoch
+        order = np.random.RandomState([self.seed, epoch]).permutation(self.num_files)
+        self._pending.extend(order.tolist())
+
+    def acquire(self, rank, done=()):
+        """Completes the leases in `done` and grants the next one to `rank`."""
+        with self._lock:
+            for lease_id in done:
+                self._outstanding.pop(lease_id, None)
+            if not self._pending:
+                self._start_epoch(self._epoch + 1)
+            lease = Lease(self._next_lease_id, self._epoch, self._pending.popleft())
+            self._next_lease_id += 1
+            self._outstanding[lease.lease_id] = (rank, lease.epoch, lease.file_index)
+            self._granted[rank] += 1
+            return lease
+
+    def release(self, rank):
+        """Returns the outstanding leases of `rank`, e.g. when its reader restarts.
+
+        Files of the current epoch are handed out again first; files of an
+        epoch that is already exhausted cannot be re-read in that epoch.
+        """
+        with self._lock:
+            released = [lease_id for lease_id, (owner, _, _) in self._outstanding.items()
+                        if owner == rank]
+            for lease_id in reversed(released):
+                _, epoch, file_index = self._outstanding.pop(lease_id)
+                if epoch == self._epoch:
+                    self._pending.appendleft(file_index)
+                else:
+                    tf.logging.warning('Dropping released lease of file %d from epoch %d.',
+                                       file_index, epoch)
+
+    def granted(self):
+        with self._lock:
+            return dict(self._granted)
+
+    def state(self):
+        with self._lock:
+            outstanding = [(epoch, file_index)
+                           for _, epoch, file_index in self._outstanding.values()]
+            return dict(epoch=self._epoch,
+                        seed=self.seed,
+                        num_files=self.num_files,
+                        pending=list(self._pending),
+                        outstanding=outstanding)
+
+    def load_state(self, state):
+        if state['seed'] != self.seed or state['num_files'] != self.num_files:
+            tf.logging.warning('Lease state does not match the dataset, starting a new epoch.')
+            return
+        with self._lock:
+            self._epoch = state['epoch']
+            current = [file_index for epoch, file_index in state['outstanding']
+                       if epoch == self._epoch]
+            self._pending = collections.deque(current + state['pending'])
+            self._outstanding.clear()
+
+    def state_file(self, global_step):
+        return os.path.join(self.state_dir, 'leases-step-%d.json' % global_step)
+
+    def save(self, global_step):
+        """Saves the lease state; called at the checkpoint steps."""
+        if not tf.gfile.Exists(self.state_dir):
+            tf.gfile.MakeDirs(self.state_dir)
+        state_file = self.state_file(global_step)
+        with tf.gfile.GFile(state_file + '.tmp', 'w') as f:
+            json.dump(self.state(), f)
+        tf.gfile.Rename(state_file + '.tmp', state_file, overwrite=True)
+
+    def restore(self, global_step):
+        """Loads the latest lease state saved at or before `global_step`."""
+        latest_step, latest_file = None, None
+        for state_file in tf.gfile.Glob(os.path.join(self.state_dir, 'leases-step-*.json')):
+            step = int(os.path.basename(state_file)[len('leases-step-'):-len('.json')])
+            if step <= global_step and (latest_step is None or step > latest_step):
+                latest_step, latest_file = step, state_file
+        if latest_file is None:
+            return
+        with tf.gfile.GFile(latest_file, 'r') as f:
+            self.load_state(json.load(f))
+        tf.logging.info('Restored file leases of step %d: epoch %d, %d files pending.',
+                        latest_step, self._epoch, len(self._pending))
+
+    def serve(self, comm, stop_event, poll_secs=0.0005):
+        """Answers lease requests from the other ranks until `stop_event` is set."""
+        from mpi4py import MPI  # pylint: disable=g-import-not-at-top
+        status = MPI.Status()
+        while not stop_event.is_set():
+            if not comm.Iprobe(source=MPI.ANY_SOURCE, tag=_REQUEST_TAG, status=status):
+                time.sleep(poll_secs)
+                continue
+            source = status.Get_source()
+            command, done = comm.recv(source=source, tag=_REQUEST_TAG)
+            if command == 'acquire':
+                comm.send(tuple(self.acquire(source, done)), dest=source, tag=_REPLY_TAG)
+            elif command == 'release':
+                self.release(source)
+                comm.send(None, dest=source, tag=_REPLY_TAG)
+
+
+class LeaseClient(object):
+    """Requests file leases from the coordinator.
+
+    Args:
+        comm: communicator shared with the coordinator.
+        coordinator: the `LeaseCoordinator` on rank 0, None on other ranks.
+        window: number of leases of read files kept outstanding, for the
+            records of those files still buffered downstream of the reader.
+    """
+
+    def __init__(self, comm, coordinator=None, window=8):
+        self.comm = comm
+        self.rank = comm.Get_rank()
+        self.coordinator = coordinator
+        self.window = window
+        self._lock = threading.Lock()
+        self._finished = collections.deque()
+
+    def _request(self, command, done=()):
+        if self.coordinator is not None:
+            if command == 'acquire':
+                return self.coordinator.acquire(self.rank, done)
+            return self.coordinator.release(self.rank)
+        self.comm.send((command, list(done)), dest=0, tag=_REQUEST_TAG)
+        reply = self.comm.recv(source=0, tag=_REPLY_TAG)
+        return Lease(*reply) if reply is not None else None
+
+    def acquire(self):
+        done = []
+        with self._lock:
+            while len(self._finished) > self.window:
+                done.append(self._finished.popleft())
+        return self._request('acquire', done)
+
+    def finish(self, lease_id):
+        """Records that the file of a lease has been read to its end."""
+        with self._lock:
+            self._finished.append(int(lease_id))
+
+    def release(self):
+        with self._lock:
+            self._finished.clear()
+        self._request('release')
+
+
+def start(comm, num_files, seed=0, state_dir=None, restore_step=0, window=8):
+    """Sets up dynamic file assignment; must be called by every rank.
+
+    Returns:
+        The `LeaseClient` of this rank. On rank 0 `client.coordinator` is the
+        coordinator, whose `save` method is meant to run at checkpoint steps.
+    """
+    # Imported here so that importing this module, e.g. through imagenet_input,
+    # neither needs mpi4py nor initializes MPI.
+    from mpi4py import MPI  # pylint: disable=g-import-not-at-top
+    if MPI.Query_thread() < MPI.THREAD_MULTIPLE:
+        raise RuntimeError('Dynamic file assignment needs MPI_THREAD_MULTIPLE.')
+    lease_comm = comm.Dup()
+    coordinator = None
+    if lease_comm.Get_rank() == 0:
+        coordinator = LeaseCoordinator(num_files, seed, state_dir)
+        if state_dir and restore_step:
+            coordinator.restore(restore_step)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=coordinator.serve,
+                                  args=(lease_comm, stop_event),
+                                  name='lease_coordinator')
+        thread.daemon = True
+        thread.start()
+        # Stop polling before MPI is finalized at exit.
+        atexit.register(lambda: (stop_event.set(), thread.join()))
+    lease_comm.Barrier()
+    return LeaseClient(lease_comm, coordinator, window)
+
+
+def make_leased_dataset(client, filenames, cycle_length=16, buffer_size=8 * 1024 * 1024):
+    """Makes a dataset of serialized records from files leased by `client`."""
+
+    def leased_files():
+        # Leases still held from a previous reader of this rank are handed back.
+        client.release()
+        while True:
+            lease = client.acquire()
+            yield lease.lease_id, filenames[lease.file_index]
+
+    def finish(lease_id):
+        client.finish(lease_id)
+        return b''
+
+    def fetch_dataset(lease_id, filename):
+        records = tf.data.TFRecordDataset(filename, buffer_size=buffer_size)
+        # An element past the last record completes the lease and is filtered
+        # out; the records themselves go through no extra op.
+        end_of_file = tf.data.Dataset.from_tensors(lease_id).map(
+            lambda i: tf.py_func(finish, [i], tf.string, stateful=True))
+        return records.concatenate(end_of_file.filter(lambda _: tf.constant(False)))
+
+    dataset = tf.data.Dataset.from_generator(
+        leased_files, (tf.int64, tf.string), (tf.TensorShape([]), tf.TensorShape([])))
+    return dataset.apply(
+        tf.contrib.data.parallel_interleave(
+            fetch_dataset, cycle_length=cycle_length, sloppy=True,
+            prefetch_input_elements=cycle_length))
+
+
+def _self_check(num_files=64, epochs=3):
+    """Checks on localhost that every file is read once per epoch."""
+    from mpi4py import MPI  # pylint: disable=g-import-not-at-top
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    client = start(comm, num_files, seed=1, window=1)
+    # Rank 1 plays the slow disk.
+    delay = 0.02 if rank == 1 else 0.002
+    seen = []
+    while True:
+        lease = client.acquire()
+        if lease.epoch >= epochs:
+            break
+        seen.append((lease.epoch, lease.file_index))
+        time.sleep(delay * random.random())
+        client.finish(lease.lease_id)
+
+    all_seen = comm.gather(seen, root=0)
+    if rank == 0:
+        per_epoch = collections.defaultdict(list)
+        for rank_seen in all_seen:
+            for epoch, file_index in rank_seen:
+                per_epoch[epoch].append(file_index)
+        for epoch in range(epochs):
+            assert sorted(per_epoch[epoch]) == list(range(num_files)), \
+                'epoch %d not read exactly once' % epoch
+        print('Files read per rank: %s' % [len(s) for s in all_seen])
+        print('OK: %d epochs of %d files read exactly once.' % (epochs, num_files))
+    comm.Barrier()
+
+
+if __name__ == '__main__':
+    _self_check(*[int(arg) for arg in sys.argv[1:]])